@@ -0,0 +1,324 @@
+import argparse
+import base64
+import json
+import random
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+TWITTER_EPOCH = 1288834974657
+MAX_TIMELINE_TWEETS = 3200
+
+# titles of the errors Twitter returns with status 200 for single users
+USER_ERRORS = {
+    'not_found': 'Not Found Error',
+    'forbidden': 'Forbidden',
+    'unauthorized': 'Authorization Error',
+}
+
+
+def make_tweet_id(timestamp_ms, sequence):
+    return ((timestamp_ms - TWITTER_EPOCH) << 22) | (sequence & 0x3FFFFF)
+
+
+def user_hash(user_id, seed):
+    # stable pseudo random number in [0, 1) per user
+    return zlib.crc32(f'{seed}:{user_id}'.encode()) / 2 ** 32
+
+
+class MockTwitterServer:
+
+    # Stand-in for GET /2/users/:id/tweets of the Twitter API v2 (and POST /oauth2/token).
+    #
+    # Every user has a timeline of about tweets_per_user tweets, one every few minutes to
+    # days depending on the user, with real snowflake ids. New tweets keep coming in while
+    # the server runs, so repeated polls find something new for active users. Pagination
+    # works with next_token, since_id and max_results like the real endpoint.
+    #
+    # errors maps error types to probabilities: not_found, forbidden and unauthorized are
+    # drawn once per user, rate_limit (429) and server_error (503) per request.
+    # With rate_limit_per_window, x-rate-limit-* headers are sent and 429 is returned
+    # once the window of window_seconds is used up. Every bearer token has its own window.
+    #
+    # POST /oauth2/token hands out the token mock_bearer_token_CONSUMER_KEY. Consumer keys in
+    # revoked_consumer_keys get 403 there, and 401 for requests with their token.
+
+    def __init__(self, host='127.0.0.1', port=0, tweets_per_user=250, latency=0.0, jitter=0.0,
+                 errors=None, rate_limit_per_window=None, window_seconds=900, text_length=140, seed=0):
+
+        self.tweets_per_user = tweets_per_user
+        self.latency = latency
+        self.jitter = jitter
+        self.errors = errors or {}
+        self.rate_limit_per_window = rate_limit_per_window
+        self.window_seconds = window_seconds
+        self.text_length = text_length
+        self.seed = seed
+        self.start = int(time.time() * 1000)
+
+        self.windows = {}  # bearer token: [reset, requests]
+        self.revoked_consumer_keys = set()
+        self.stats = {'requests': 0, 'pages': 0, 'tweets': 0, 'bytes': 0, 'status': {}}
+
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+            # headers and body are sent separately, avoid delayed ACK stalls on keep-alive connections
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                server.handle_get(self)
+
+            def do_POST(self):
+                server.handle_post(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f'http://{host}:{self.httpd.server_address[1]}'
+        self._thread = None
+
+    def __enter__(self):
+        self.start_thread()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start_thread(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def timeline(self, user_id):
+
+        # timestamps in ms of all tweets of a user up to now, newest first
+        h = user_hash(user_id, self.seed)
+        interval = int(60_000 * 10 ** (h * 4))  # one tweet per minute up to one per week
+        count = int(self.tweets_per_user * (0.5 + h))
+        now = int(time.time() * 1000)
+        newest = self.start + (now - self.start) // interval * interval
+
+        timestamps = [newest - k * interval for k in range(count + (newest - self.start) // interval)]
+
+        return timestamps[:MAX_TIMELINE_TWEETS]
+
+    def user_error(self, user_id):
+
+        h = user_hash(user_id, self.seed + 1)
+        threshold = 0
+
+        for error, title in USER_ERRORS.items():
+            threshold += self.errors.get(error, 0)
+            if h < threshold:
+                return title
+
+        return None
+
+    def tweet(self, user_id, timestamp):
+
+        tweet_id = str(make_tweet_id(timestamp, int(user_id)))
+        text = f'Tweet {tweet_id} by {user_id} ' + 'x' * self.text_length
+
+        return {
+            'id': tweet_id,
+            'text': text[:self.text_length],
+            'author_id': user_id,
+            'conversation_id': tweet_id,
+            'created_at': datetime.fromtimestamp(timestamp / 1000, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            'lang': 'en',
+            'public_metrics': {'retweet_count': 0, 'reply_count': 0, 'like_count': 1, 'quote_count': 0},
+        }
+
+    def timeline_page(self, user_id, query):
+
+        since_id = int(query.get('since_id', ['0'])[0])
+        max_results = int(query.get('max_results', ['10'])[0])
+        offset = int(query.get('pagination_token', ['0'])[0])
+
+        tweets = [
+            timestamp for timestamp in self.timeline(user_id)
+            if make_tweet_id(timestamp, int(user_id)) > since_id
+        ]
+
+        page = [self.tweet(user_id, timestamp) for timestamp in tweets[offset:offset + max_results]]
+
+        meta = {'result_count': len(page)}
+
+        if page:
+            meta['newest_id'] = page[0]['id']
+            meta['oldest_id'] = page[-1]['id']
+
+        if offset + max_results < len(tweets):
+            meta['next_token'] = str(offset + max_results)
+
+        if not page:
+            return {'meta': meta}
+
+        return {
+            'data': page,
+            'includes': {'users': [{'id': user_id, 'username': f'user_{user_id}', 'name': f'User {user_id}'}]},
+            'meta': meta
+        }
+
+    def rate_limit_headers(self, token):
+
+        if self.rate_limit_per_window is None:
+            return {}, False
+
+        with self._lock:
+
+            window = self.windows.setdefault(token, [time.time() + self.window_seconds, 0])
+
+            if time.time() >= window[0]:
+                window[:] = [time.time() + self.window_seconds, 0]
+
+            window[1] += 1
+            remaining = self.rate_limit_per_window - window[1]
+            reset = window[0]
+
+        headers = {
+            'x-rate-limit-limit': str(self.rate_limit_per_window),
+            'x-rate-limit-remaining': str(max(remaining, 0)),
+            'x-rate-limit-reset': str(int(reset)),
+        }
+
+        return headers, remaining < 0
+
+    def handle_get(self, handler):
+
+        url = urlparse(handler.path)
+        parts = url.path.strip('/').split('/')
+
+        if self.latency or self.jitter:
+            time.sleep(self.latency + self._random.random() * self.jitter)
+
+        if len(parts) != 4 or parts[:2] != ['2', 'users'] or parts[3] != 'tweets':
+            return self.respond(handler, 404, {'title': 'Not Found'})
+
+        user_id = parts[2]
+        token = handler.headers.get('Authorization', '').replace('Bearer ', '', 1)
+
+        if token in {f'mock_bearer_token_{consumer_key}' for consumer_key in self.revoked_consumer_keys}:
+            return self.respond(handler, 401, {'title': 'Unauthorized', 'status': 401})
+
+        headers, rate_limited = self.rate_limit_headers(token)
+
+        with self._lock:
+            draw = self._random.random()
+
+        if rate_limited or draw < self.errors.get('rate_limit', 0):
+            return self.respond(handler, 429, {'title': 'Too Many Requests', 'status': 429}, headers)
+
+        if draw < self.errors.get('rate_limit', 0) + self.errors.get('server_error', 0):
+            return self.respond(handler, 503, {'title': 'Service Unavailable', 'status': 503}, headers)
+
+        error = self.user_error(user_id)
+
+        if error is not None:
+            body = {'errors': [{'title': error, 'detail': f'Mock {error} for {user_id}.', 'value': user_id}]}
+            return self.respond(handler, 200, body, headers)
+
+        body = self.timeline_page(user_id, parse_qs(url.query))
+
+        with self._lock:
+            self.stats['pages'] += 1
+            self.stats['tweets'] += body['meta']['result_count']
+
+        return self.respond(handler, 200, body, headers)
+
+    def handle_post(self, handler):
+
+        handler.rfile.read(int(handler.headers.get('Content-Length', 0)))
+
+        if urlparse(handler.path).path.strip('/') == 'oauth2/token':
+
+            credentials = base64.b64decode(handler.headers.get('Authorization', '').replace('Basic ', '', 1))
+            consumer_key = credentials.decode('utf8').split(':')[0]
+
+            if consumer_key in self.revoked_consumer_keys:
+                error = {'code': 99, 'message': 'Unable to verify your credentials'}
+                return self.respond(handler, 403, {'errors': [error]})
+
+            token = {'token_type': 'bearer', 'access_token': f'mock_bearer_token_{consumer_key}'}
+            return self.respond(handler, 200, token)
+
+        return self.respond(handler, 404, {'title': 'Not Found'})
+
+    def respond(self, handler, status, body, headers=None):
+
+        content = json.dumps(body).encode('utf8')
+
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json; charset=utf-8')
+        handler.send_header('Content-Length', str(len(content)))
+        for header, value in (headers or {}).items():
+            handler.send_header(header, value)
+        handler.end_headers()
+        handler.wfile.write(content)
+
+        with self._lock:
+            self.stats['requests'] += 1
+            self.stats['bytes'] += len(content)
+            self.stats['status'][status] = self.stats['status'].get(status, 0) + 1
+
+
+def add_server_arguments(parser):
+
+    parser.add_argument('--tweets_per_user', type=int, default=250,
+                        help='Average number of tweets in the timeline of a user. Default: 250')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds to wait before answering a request. Default: 0')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Up to this many seconds are added to the latency at random. Default: 0')
+    parser.add_argument('--rate_limit', type=int,
+                        help='Requests per window before answering with 429. Default: no rate limit')
+    parser.add_argument('--window', type=int, default=900,
+                        help='Length of a rate limit window in seconds. Default: 900')
+    for error in list(USER_ERRORS) + ['rate_limit_errors', 'server_errors']:
+        parser.add_argument(f'--{error}', type=float, default=0.0,
+                            help=f'Share of {"requests" if error.endswith("errors") else "users"} '
+                                 f'answered with {error.replace("_", " ")}. Default: 0')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for all random choices. Default: 0')
+
+
+def server_from_arguments(args, host='127.0.0.1', port=0):
+
+    errors = {error: getattr(args, error) for error in USER_ERRORS}
+    errors['rate_limit'] = args.rate_limit_errors
+    errors['server_error'] = args.server_errors
+
+    return MockTwitterServer(
+        host=host, port=port, tweets_per_user=args.tweets_per_user, latency=args.latency, jitter=args.jitter,
+        errors=errors, rate_limit_per_window=args.rate_limit, window_seconds=args.window, seed=args.seed
+    )
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Mock of the user timeline endpoint of the Twitter API v2.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    server = server_from_arguments(args, args.host, args.port)
+    print(f'Serving mock Twitter API at {server.url} …')
+
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,181 @@
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from contextlib import nullcontext
+
+import yaml
+from loguru import logger
+from twacapic.collect import UserGroup
+from twacapic.profiling import Profiler
+
+from benchmarks.mock_server import add_server_arguments, server_from_arguments
+
+FIRST_USER_ID = 1_000_000
+
+
+def directory_size(path):
+
+    size = 0
+
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            try:
+                size += os.path.getsize(os.path.join(root, file))
+            except FileNotFoundError:
+                pass
+
+    return size
+
+
+def peak_rss():
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def write_setup(directory, server_url, users, credentials=1):
+
+    consumer_keys = ['mock'] + [f'mock_{number}' for number in range(2, credentials + 1)]
+
+    with open(f'{directory}/twitter_keys.yaml', 'w') as f:
+        yaml.dump({
+            'search_tweets_v2': [
+                {
+                    'endpoint': 'https://api.twitter.com/2/tweets/search/all',
+                    'consumer_key': consumer_key,
+                    'consumer_secret': 'mock',
+                    'bearer_token': f'mock_bearer_token_{consumer_key}',
+                }
+                for consumer_key in consumer_keys
+            ],
+            'connection': {'api_url': server_url},
+        }, f)
+
+    with open(f'{directory}/users.csv', 'w') as f:
+        for user_id in range(FIRST_USER_ID, FIRST_USER_ID + users):
+            f.write(f'{user_id}\n')
+
+
+def run_benchmark(args):
+
+    server = server_from_arguments(args)
+    server.start_thread()
+
+    write_setup('.', server.url, args.users, args.credentials)
+
+    sink_options = {'compression': args.compression} if args.sink == 'jsonl' else None
+
+    results = []
+
+    try:
+
+        for cycle in range(1, args.cycles + 1):
+
+            requests_before = server.stats['requests']
+            pages_before = server.stats['pages']
+            tweets_before = server.stats['tweets']
+            bytes_before = directory_size('results')
+
+            start = time.perf_counter()
+
+            user_group = UserGroup(
+                path='users.csv' if cycle == 1 else None, name='benchmark',
+                get_all_the_tweets=args.get_all_the_tweets and cycle == 1,
+                sink=args.sink, sink_options=sink_options, dedup=args.dedup
+            )
+            profiler = Profiler(f'benchmark-{cycle}', 'profiles', args.profile) if args.profile else nullcontext()
+
+            with profiler:
+                user_group.collect(workers=args.workers)
+
+            seconds = time.perf_counter() - start
+
+            result = {
+                'cycle': cycle,
+                'users': args.users,
+                'seconds': round(seconds, 3),
+                'users_per_second': round(args.users / seconds, 1),
+                'requests': server.stats['requests'] - requests_before,
+                'pages': server.stats['pages'] - pages_before,
+                'pages_per_second': round((server.stats['pages'] - pages_before) / seconds, 1),
+                'tweets': server.stats['tweets'] - tweets_before,
+                'bytes_written': directory_size('results') - bytes_before,
+                'peak_rss_bytes': peak_rss(),
+                'status_codes': dict(server.stats['status']),
+            }
+
+            results.append(result)
+            print_result(result)
+
+    finally:
+        server.stop()
+
+    return results
+
+
+def print_result(result):
+
+    print(
+        f"cycle {result['cycle']}: {result['users']} users in {result['seconds']} s "
+        f"({result['users_per_second']} users/s), "
+        f"{result['pages']} pages ({result['pages_per_second']} pages/s), "
+        f"{result['tweets']} tweets, "
+        f"{result['bytes_written'] / 1024 ** 2:.1f} MB written, "
+        f"peak RSS {result['peak_rss_bytes'] / 1024 ** 2:.1f} MB, "
+        f"status codes so far {result['status_codes']}"
+    )
+
+
+def run():
+
+    parser = argparse.ArgumentParser(
+        description='Measure the throughput of UserGroup.collect against a local mock of the Twitter API.'
+    )
+    parser.add_argument('--users', type=int, default=1000,
+                        help='Number of users in the synthetic group. Default: 1000')
+    parser.add_argument('--cycles', type=int, default=2,
+                        help='Number of collection runs, the first one creates the group. Default: 2')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of users to collect concurrently. Default: 1')
+    parser.add_argument('-a', '--get_all_the_tweets', action='store_true',
+                        help='Backfill all tweets of every user in the first cycle.')
+    parser.add_argument('--credentials', type=int, default=1,
+                        help='Number of credentials to spread the users over. Default: 1')
+    parser.add_argument('--sink', choices=['files', 'jsonl'], default='files', help='Default: files')
+    parser.add_argument('--compression', choices=['gzip', 'zstd'], default='gzip', help='Default: gzip')
+    parser.add_argument('--dedup', choices=['includes', 'all'], help='Leave out tweets that are already stored.')
+    parser.add_argument('--profile', choices=['sampling', 'deterministic'],
+                        help='Profile every cycle, files are written to profiles/ in the working directory.')
+    parser.add_argument('--directory',
+                        help='Working directory for results. Default: a new temporary directory')
+    parser.add_argument('--json', help='Also write the results as JSON to this path.')
+    parser.add_argument('-l', '--log_level', default='ERROR', help='Default: ERROR')
+    add_server_arguments(parser)
+
+    args = parser.parse_args()
+
+    logger.add(sys.stderr, level=args.log_level)
+
+    directory = args.directory or tempfile.mkdtemp(prefix='twacapic_benchmark_')
+    os.makedirs(directory, exist_ok=True)
+    print(f'Working directory: {directory}')
+
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    os.chdir(directory)
+    results = run_benchmark(args)
+
+    if json_path is not None:
+        with open(json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+
+    run()
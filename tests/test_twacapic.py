@@ -1,11 +1,18 @@
 # pylint: disable=W1514,W0621,C0116
 
+import asyncio
+import itertools
 import json
+import multiprocessing
 import os
+import pstats
 import random
 import shutil
 import sys
+import threading
 import time
+import urllib.request
+from datetime import datetime
 from glob import glob
 from pathlib import Path
 from unittest.mock import Mock, patch
@@ -14,12 +21,28 @@ import pytest
 import twacapic
 import twacapic.templates
 import yaml
+from benchmarks.mock_server import MockTwitterServer
+from benchmarks.run import write_setup
 from loguru import logger
 from requests.exceptions import ConnectionError
 from twacapic import __version__
-from twacapic.auth import read_credentials, save_credentials
+from twacapic.auth import ApiPool, get_api, read_credentials, save_credentials
 from twacapic.collect import UserGroup
-from twacapic.utils import get_date_from_tweet_id
+from twacapic.config import ConfigError, GroupConfig
+from twacapic.dedup import DedupSink, SeenIndex
+from twacapic.export import export_group
+from twacapic.metrics import serve
+from twacapic.pageindex import PageIndex
+from twacapic.pages import Page
+from twacapic.profiling import Profiler
+from twacapic.reader import iter_tweets
+from twacapic.priority import RECHECK_INTERVALS, schedule_next_poll
+from twacapic.ratelimit import RateLimiter, get_rate_limiter
+from twacapic.scheduler import Scheduler
+from twacapic.sinks import FileSink, JsonlSink, PageWriter, read_segments, segment_end, segment_paths
+from twacapic.state import StateStore
+from twacapic.utils import get_date_from_tweet_id, get_dates_from_tweet_ids, get_id_bounds, get_tweet_id_from_timestamp
+from twacapic.workqueue import WorkQueue, work
 from TwitterAPI import TwitterResponse
 from TwitterAPI.TwitterError import TwitterConnectionError
 
@@ -83,16 +106,10 @@ def user_group_with_old_meta_file(user_group_with_tweets):
 
     user_group = UserGroup(name='users_with_meta')
 
-    for user_id in user_group.user_ids:
-        meta_file_path = f'{user_group.path}/{user_id}/meta.yaml'
-
-        with open(meta_file_path, 'r') as f:
-            metadata = yaml.safe_load(f)
+    for user_id, metadata in user_group.meta.items():
+        user_group.state.update(user_id, newest_id=str(int(metadata['newest_id']) - 1))
 
-        metadata['newest_id'] = str(int(metadata['newest_id']) - 1)
-
-        with open(meta_file_path, 'w') as f:
-            yaml.dump(metadata, f)
+    user_group.state.flush()
 
     yield user_group
 
@@ -108,10 +125,9 @@ def user_group_with_very_old_tweets(user_group_with_tweets, user_group):
 
     for user_id in user_group_with_tweets.user_ids:
         metadata = user_group_with_tweets.meta[user_id]
-        metadata['newest_id'] = metadata['oldest_id']
+        user_group.state.update(user_id, newest_id=metadata['oldest_id'], oldest_id=metadata['oldest_id'])
 
-        with open(f'{user_group.path}/{user_id}/meta.yaml', 'w') as f:
-            yaml.dump(metadata, f)
+    user_group.state.flush()
 
     yield user_group
 
@@ -181,6 +197,17 @@ def failed_response_mock():
     yield TwitterResponse(mock_response, options)
 
 
+@pytest.fixture
+def mock_twitter_server(tmp_path, monkeypatch):
+
+    with MockTwitterServer(tweets_per_user=120, errors={'not_found': 0.25}) as server:
+
+        monkeypatch.chdir(tmp_path)
+        write_setup('.', server.url, 10)
+
+        yield server
+
+
 @pytest.fixture
 def minimal_config_path():
     path = 'minimal_config.yaml'
@@ -311,6 +338,61 @@ def test_can_create_credential_yaml(tmp_path):
             assert expected == actual
 
 
+def test_api_reuses_pooled_session(successful_empty_response_mock):
+
+    api = twacapic.auth.TwitterAPI(oauth2_access_token='<TOKEN>', auth_type='oAuth2User', api_version='2')
+    api.REST_TIMEOUT = 42
+
+    with patch.object(api.session, 'get', return_value=successful_empty_response_mock.response) as mocked_get:
+
+        for user_id in ['11', '36476777']:
+            response = api.request(f'users/:{user_id}/tweets', {'max_results': 100})
+            assert response.status_code == 200
+
+        assert mocked_get.call_count == 2
+        assert mocked_get.call_args.args[0] == 'https://api.twitter.com/2/users/36476777/tweets'
+        assert mocked_get.call_args.kwargs['timeout'][1] == 42
+
+
+@pytest.fixture
+def credentials_with_bearer_token(tmp_path):
+
+    path = tmp_path/'twitter_keys.yaml'
+    save_credentials(path, '<CONSUMER_KEY>', '<CONSUMER_SECRET>', '<CACHED_TOKEN>')
+
+    yield path
+
+
+def test_cached_bearer_token_skips_handshake(credentials_with_bearer_token):
+
+    with patch.object(twacapic.auth.CachedBearerAuth, '_get_access_token') as mocked_handshake:
+
+        api = get_api(credentials_with_bearer_token)
+
+        assert not mocked_handshake.called
+        assert api.auth.bearer_token == '<CACHED_TOKEN>'
+
+
+def test_bearer_token_refreshed_on_401(credentials_with_bearer_token, successful_empty_response_mock):
+
+    unauthorized_response = Mock()
+    unauthorized_response.status_code = 401
+
+    api = get_api(credentials_with_bearer_token)
+
+    with patch.object(twacapic.auth.CachedBearerAuth, '_get_access_token', return_value='<NEW_TOKEN>'):
+        with patch.object(api.session, 'get',
+                          side_effect=[unauthorized_response, successful_empty_response_mock.response]) as mocked_get:
+
+            response = api.request('users/:11/tweets', {'max_results': 100})
+
+            assert response.status_code == 200
+            assert mocked_get.call_count == 2
+
+    assert read_credentials(credentials_with_bearer_token)['bearer_token'] == '<NEW_TOKEN>'
+    assert api.session.auth.bearer_token == '<NEW_TOKEN>'
+
+
 def test_can_read_credentials():
 
     credentials = read_credentials('tests/mock_files/mock_credentials.yaml')
@@ -319,12 +401,15 @@ def test_can_read_credentials():
     assert credentials['consumer_secret'] == '<CONSUMER_SECRET>'
 
 
-def test_user_group_creates_directories(user_group):
+def test_user_group_indexes_users_without_creating_directories(user_group):
 
     with open('tests/mock_files/users.csv') as file:
-        for line in file:
-            path = f'results/test_users/{line.strip()}'
-            assert os.path.isdir(path), f"Could not find directory for user in {path}"
+        user_ids = [line.strip() for line in file if line.strip()]
+
+    assert list(user_group.user_ids) == user_ids
+    assert len(user_group.user_ids) == len(user_ids)
+    assert list(UserGroup(name='test_users').user_ids) == user_ids
+    assert glob(f'{user_group.path}/*/') == []
 
 
 def test_can_retrieve_tweets_from_user_timeline(user_group_with_tweets):
@@ -341,18 +426,13 @@ def test_can_retrieve_tweets_from_user_timeline(user_group_with_tweets):
             assert len(tweets['data']) > 90, 'not retrieving maximum of tweets per request'
 
 
-def test_user_in_group_has_meta_file(user_group_with_tweets):
+def test_user_in_group_has_meta_data(user_group_with_tweets):
 
-    folders = glob(f'{user_group_with_tweets.path}/*/')
-
-    for folder in folders:
-
-        meta_file_path = f'{folder}/meta.yaml'
+    for user_id in user_group_with_tweets.user_ids:
 
-        with open(meta_file_path, 'r') as metafile:
-            meta_data = yaml.safe_load(metafile)
+        meta_data = user_group_with_tweets.meta[user_id]
 
-        files = glob(f'{folder}/*.json')
+        files = glob(f'{user_group_with_tweets.path}/{user_id}/*.json')
         with open(files[0], 'r') as tweetfile:
             tweet_data = json.load(tweetfile)
 
@@ -374,12 +454,26 @@ def test_collect_only_new_tweets(user_group_with_old_meta_file):
         with open(files[0], 'r') as f:
             oldest_collected_id = json.load(f)['meta']['oldest_id']
 
-        with open(f'{user_group_with_old_meta_file.path}/{user_id}/meta.yaml') as f:
-            oldest_meta_id = yaml.safe_load(f)['oldest_id']
+        oldest_meta_id = user_group_with_old_meta_file.meta[user_id]['oldest_id']
 
         assert oldest_collected_id > oldest_meta_id
 
 
+def test_collect_concurrently(user_group_with_old_meta_file):
+
+    user_group_with_old_meta_file.collect(workers=4)
+
+    for user_id in user_group_with_old_meta_file.user_ids:
+        files = glob(f'{user_group_with_old_meta_file.path}/{user_id}/*.json')
+
+        assert len(files) == 2
+
+        files.sort(reverse=True)
+        newest_collected_id = files[0].split('/')[-1].split('_')[0]
+
+        assert user_group_with_old_meta_file.meta[user_id]['newest_id'] == newest_collected_id
+
+
 def test_no_new_tweets(user_group_with_tweets):
 
     user_group_with_tweets.collect()
@@ -483,6 +577,91 @@ def test_stops_after_10_connection_errors(user_group, failed_response_mock):
             assert mocked_request_method.call_count == 11
 
 
+def rate_limited_response(remaining, reset, status_code=200):
+
+    mock_response = Mock()
+    mock_response.status_code = status_code
+    mock_response.headers = {
+        'x-rate-limit-remaining': str(remaining),
+        'x-rate-limit-reset': str(int(reset))
+    }
+
+    return TwitterResponse(mock_response, Mock())
+
+
+def test_rate_limiter_paces_requests():
+
+    rate_limiter = RateLimiter(burst=2)
+    rate_limiter.update(rate_limited_response(100, time.time() + 100))
+
+    with patch.object(twacapic.ratelimit.time, 'sleep') as mocked_sleep:
+
+        assert rate_limiter.wait() == 0
+        assert rate_limiter.wait() == 0
+        assert 0.5 < rate_limiter.wait() <= 1.1
+
+        assert mocked_sleep.call_count == 1
+
+
+def test_rate_limiter_waits_for_reset_of_exhausted_window():
+
+    rate_limiter = RateLimiter()
+    rate_limiter.update(rate_limited_response(10, time.time() + 60, status_code=429))
+
+    with patch.object(twacapic.ratelimit.time, 'sleep') as mocked_sleep:
+
+        assert rate_limiter.wait() > 55
+        mocked_sleep.assert_called_once()
+
+
+def test_rate_limiter_ignores_responses_without_headers(successful_empty_response_mock):
+
+    rate_limiter = RateLimiter()
+    rate_limiter.update(successful_empty_response_mock)
+
+    assert rate_limiter.wait() == 0
+
+
+def test_scheduler_runs_groups_independently_and_skips_overrunning_runs():
+
+    runs = {'slow': 0, 'fast': 0}
+
+    def slow():
+        runs['slow'] += 1
+        time.sleep(0.35)
+
+    def fast():
+        runs['fast'] += 1
+
+    scheduler = Scheduler()
+    scheduler.every(0.1, slow)
+    scheduler.every(0.1, fast, jitter=0.01)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(asyncio.wait_for(scheduler.run(), 0.75))
+
+    slow_status, fast_status = scheduler.status()
+
+    # the slow job does not hold up the fast one, and skips the runs due while it is running
+    assert runs['fast'] >= 6
+    assert runs['slow'] == 2
+    assert slow_status['skipped'] >= 4
+    assert fast_status['skipped'] == 0
+    assert fast_status['lag'] < 0.1
+    assert 0 <= fast_status['next_run_in'] <= 0.11
+
+    def failing():
+        raise ValueError('boom')
+
+    scheduler = Scheduler()
+    scheduler.every(0.1, failing)
+
+    with pytest.raises(ValueError):
+        asyncio.run(scheduler.run())
+
+    assert scheduler.status()[0]['error'] == "ValueError('boom')"
+
+
 def test_can_import_group_config():
     group_config = twacapic.templates.group_config
 
@@ -524,6 +703,53 @@ def test_group_retains_config(group_with_minimal_config, successful_response_moc
             assert config['fields'] == {}
 
 
+def test_config_is_checked_once_and_reloaded_after_changes(group_with_minimal_config):
+
+    user_group = group_with_minimal_config
+    path = f'{user_group.path}/group_config.yaml'
+
+    assert user_group.config.params == {'tweet.fields': '', 'expansions': '', 'user.fields': ''}
+
+    with patch('twacapic.config.yaml.safe_load', side_effect=yaml.safe_load) as safe_load:
+        config = user_group.config
+        assert user_group.config is config
+        assert safe_load.call_count == 0
+
+        time.sleep(0.01)
+        with open(path, 'w') as f:
+            config = {'expansions': {}, 'fields': {'author_id': True, 'lang': True, 'geo': False}, 'user.fields': {}}
+            yaml.dump(config, f)
+
+        assert user_group.config.params['tweet.fields'] == 'author_id,lang'
+        assert safe_load.call_count == 1
+
+    for malformed in ('fields: [author_id\n', {'fields': {1: True}, 'expansions': {}, 'user.fields': {}},
+                      {'fields': {'author_id': 'maybe'}, 'expansions': {}, 'user.fields': {}}, {'fields': {}}):
+
+        with open('malformed_config.yaml', 'w') as f:
+            f.write(malformed) if isinstance(malformed, str) else yaml.dump(malformed, f)
+
+        with pytest.raises(ConfigError):
+            UserGroup('tests/mock_files/users.csv', name='test_users_with_min_config', config='malformed_config.yaml')
+
+    os.remove('malformed_config.yaml')
+
+    # the config of the group is left as it was
+    assert user_group.config.params['tweet.fields'] == 'author_id,lang'
+
+    # names the template does not know yet, e.g. new ones of the API, are sent with a warning
+    warnings = []
+    handler = logger.add(warnings.append, level='WARNING')
+
+    config = GroupConfig({'fields': {'edit_history_tweet_ids': True, 'lang': True}, 'expansions': {},
+                          'user.fields': {}})
+
+    logger.remove(handler)
+
+    assert config.params['tweet.fields'] == 'edit_history_tweet_ids,lang'
+    assert len(warnings) == 1 and 'edit_history_tweet_ids' in warnings[0]
+
+
 def test_fields_in_tweets(user_group_with_tweets):
 
     user_group = user_group_with_tweets
@@ -566,7 +792,8 @@ def test_non_reachable_users(user_group_with_deleted_protected_accounts):
     print(user_group_with_deleted_protected_accounts.user_ids)
 
     for item in os.listdir(user_group_with_deleted_protected_accounts.path):
-        assert item in ['group_config.yaml', '2530965517', '557558765', '11']
+        assert item in ['group_config.yaml', 'state.sqlite', 'state.sqlite-wal', 'state.sqlite-shm',
+                        '2530965517', '557558765', '11']
 
     user_group_with_deleted_protected_accounts.collect()  # check second time for errors because of missing metadata etc.
 
@@ -579,15 +806,878 @@ def test_non_reachable_users(user_group_with_deleted_protected_accounts):
 def test_user_group_setup_for_getting_all_the_tweets(user_group_to_get_all_the_tweets):
 
     for user_id in user_group_to_get_all_the_tweets.user_ids:
-        meta_file_path = f'{user_group_to_get_all_the_tweets.path}/{user_id}/meta.yaml'
-
-        with open(meta_file_path, 'r') as f:
-            metadata = yaml.safe_load(f)
+        metadata = user_group_to_get_all_the_tweets.meta[user_id]
 
         assert metadata['newest_id'] == metadata['oldest_id']
         assert metadata['newest_id'] == '0'
 
 
+def test_state_store_migrates_meta_yaml_files():
+
+    user_id_1, user_id_2 = '11', '36476777'
+
+    for user_id, newest_id in ((user_id_1, '100'), (user_id_2, '200')):
+        os.makedirs(f'results/test_migration/{user_id}')
+        with open(f'results/test_migration/{user_id}/meta.yaml', 'w') as f:
+            yaml.dump({'newest_id': newest_id, 'oldest_id': '1'}, f)
+
+    user_group = UserGroup(name='test_migration')
+
+    assert user_group.meta == {
+        user_id_1: {'newest_id': '100', 'oldest_id': '1'},
+        user_id_2: {'newest_id': '200', 'oldest_id': '1'}
+    }
+    assert glob(f'{user_group.path}/*/meta.yaml') == []
+
+    user_group.state.update(user_id_1, newest_id='150')
+    user_group.state.close()
+
+    user_group = UserGroup(name='test_migration')
+
+    assert user_group.meta[user_id_1] == {'newest_id': '150', 'oldest_id': '1'}
+
+    shutil.rmtree(user_group.path)
+
+
+def test_state_store_writes_in_batches(tmp_path):
+
+    state = StateStore(tmp_path/'state.sqlite', batch_size=3)
+
+    state.update('1', newest_id='10')
+    state.update('2', newest_id='20')
+
+    assert StateStore(tmp_path/'state.sqlite').all() == {}
+    assert state.get('1') == {'newest_id': '10'}
+
+    state.update('3', newest_id='30', oldest_id='3')
+
+    assert StateStore(tmp_path/'state.sqlite').all() == {
+        '1': {'newest_id': '10'},
+        '2': {'newest_id': '20'},
+        '3': {'newest_id': '30', 'oldest_id': '3'}
+    }
+
+    # members added again with -a start over from the first tweet, but keep the rest of their state
+    state.update('1', tweet_rate=0.5, unreachable_reason='forbidden')
+    state.flush()
+    state.add_members(['1', '4'], newest_id='0', oldest_id='0')
+
+    assert state.get('1') == {'newest_id': '0', 'oldest_id': '0', 'tweet_rate': 0.5, 'unreachable_reason': 'forbidden'}
+    assert state.get('4') == {'newest_id': '0', 'oldest_id': '0'}
+
+
+def test_jsonl_sink_rotates_and_reads_back_segments(tmp_path):
+
+    page = {
+        'data': [{'id': '2', 'text': 'Grüße'}, {'id': '1', 'text': '…'}],
+        'includes': {'users': [{'id': '11'}]},
+        'meta': {'newest_id': '2', 'oldest_id': '1', 'result_count': 2}
+    }
+
+    sink = JsonlSink(tmp_path, segment_size=300, buffer_size=1)
+
+    for user_id in ['11', '12', '13']:
+        sink.write_page(user_id, page)
+
+    sink.close()
+
+    assert len(segment_paths(tmp_path)) > 1
+    assert [record['user_id'] for record in read_segments(tmp_path)] == ['11', '12', '13']
+    assert next(read_segments(tmp_path))['page'] == page
+
+    # a segment of a previous run is continued only if its uncompressed JSON is smaller than segment_size
+    long_page = dict(page, data=[{'id': '2', 'text': 'a' * 2000}])
+
+    for run in range(2):
+        sink = JsonlSink(tmp_path/'long', segment_size=1000)
+        sink.write_page('11', long_page)
+        sink.close()
+
+    assert len(segment_paths(tmp_path/'long')) == 2
+
+    sink = JsonlSink(tmp_path/'tweets', records='tweets')
+    sink.write_page('11', page)
+
+    assert list(read_segments(tmp_path/'tweets')) == []
+
+    sink.flush()
+
+    assert list(read_segments(tmp_path/'tweets')) == [
+        {'user_id': '11', 'tweet': page['data'][0]},
+        {'user_id': '11', 'tweet': page['data'][1]},
+        {'user_id': '11', 'includes': page['includes']}
+    ]
+
+
+def test_tweet_ids_are_decoded_in_batches_like_one_by_one():
+
+    numpy = pytest.importorskip('numpy')
+
+    tweet_ids = ['1366176354923446272', '20', '1377410378757046271', '1500000000000000000']
+
+    decoded = get_dates_from_tweet_ids(tweet_ids, fields=True)
+
+    assert decoded['timestamp'].tolist() == [get_date_from_tweet_id(tweet_id)['timestamp'] for tweet_id in tweet_ids]
+    assert numpy.datetime_as_string(decoded['date']).tolist() == [
+        get_date_from_tweet_id(tweet_id)['date'] for tweet_id in tweet_ids
+    ]
+    assert decoded['sequence'][1] == 20
+    assert decoded['worker'][0] == decoded['datacenter'][0] == 0
+
+    bounds = get_id_bounds(datetime(2021, 3, 1), datetime(2021, 4, 1))
+
+    assert get_date_from_tweet_id(int(bounds['since_id']) + 1)['date'] == '2021-03-01'
+    assert get_date_from_tweet_id(int(bounds['since_id']))['date'] == '2021-02-28'
+    assert get_date_from_tweet_id(int(bounds['until_id']) - 1)['date'] == '2021-03-31'
+    assert get_date_from_tweet_id(int(bounds['until_id']))['date'] == '2021-04-01'
+
+
+def test_pages_are_saved_without_decoding(tmp_path):
+
+    text = (
+        '{"data":[{"id":"2","text":"Gr\\u00fc\\u00dfe","meta":{"nested":true}}],'
+        '"meta":{"newest_id":"2","oldest_id":"2","result_count":1}}'
+    )
+
+    with patch.object(twacapic.pages, 'loads', side_effect=AssertionError('page was decoded')):
+
+        page = Page(text)
+
+        assert page.meta == {'newest_id': '2', 'oldest_id': '2', 'result_count': 1}
+
+        os.makedirs(tmp_path/'11')
+        sink = FileSink(tmp_path)
+        sink.write_page('11', page)
+        sink.flush()
+
+        JsonlSink(tmp_path).write_page('11', page)
+
+    assert (tmp_path/'11'/'2_2.json').read_text(encoding='utf8') == text
+
+    errors = Page('{"errors":[{"title":"Not Found Error","value":"11"}]}')
+
+    assert errors.has_errors
+    assert errors.meta is None
+    assert errors.data['errors'][0]['value'] == '11'
+
+
+def test_tweets_stored_by_any_group_are_left_out(tmp_path):
+
+    def page(tweet_ids, included_ids):
+        return {
+            'data': [{'id': tweet_id, 'text': 'hi'} for tweet_id in tweet_ids],
+            'includes': {'tweets': [{'id': tweet_id, 'text': 'quoted'} for tweet_id in included_ids]},
+            'meta': {'newest_id': tweet_ids[0], 'oldest_id': tweet_ids[-1], 'result_count': len(tweet_ids)},
+        }
+
+    index = SeenIndex(str(tmp_path/'seen_tweets.sqlite'), capacity=1000)
+
+    first = DedupSink(FileSink(tmp_path/'first'), index, 'first', timeline=True)
+    first.write_page('11', page(['5', '4'], ['1', '2']))
+    first.close()
+
+    second = DedupSink(FileSink(tmp_path/'second'), index, 'second', timeline=True)
+    second.write_page('11', page(['6', '5'], ['2', '3']))
+    second.write_page('12', page(['7'], ['3', '6']))
+    second.close()
+
+    saved = json.loads((tmp_path/'second'/'11'/'6_5.json').read_text())
+
+    assert [tweet['id'] for tweet in saved['data']] == ['6']
+    assert [tweet['id'] for tweet in saved['includes']['tweets']] == ['3']
+    assert saved['meta']['stored_tweet_ids'] == ['5']
+
+    saved = json.loads((tmp_path/'second'/'12'/'7_7.json').read_text())
+
+    assert saved['includes']['tweets'] == []
+
+    # the Bloom filter is rebuilt from the exact store if it is lost
+    os.remove(tmp_path/'seen_tweets.bloom')
+    index = SeenIndex(str(tmp_path/'seen_tweets.sqlite'), capacity=1000)
+
+    assert index.count() == 7
+    assert index.stored(['1', '6', '8']) == {1, 6}
+
+
+def test_tweets_are_read_back_with_what_they_refer_to(tmp_path):
+
+    def tweet_id(day):
+        return str(get_tweet_id_from_timestamp(datetime(2021, 1, day)) + 1)
+
+    def page(days, author_id):
+        ids = [tweet_id(day) for day in days]
+        return {
+            'data': [
+                {'id': id, 'text': 'hi', 'author_id': author_id, 'referenced_tweets': [{'type': 'quoted', 'id': '1'}]}
+                for id in ids
+            ],
+            'includes': {'users': [{'id': author_id, 'username': 'author'}, {'id': '99', 'username': 'quoted'},
+                                   {'id': '98', 'username': 'other'}],
+                         'tweets': [{'id': '1', 'text': 'quoted', 'author_id': '99'}]},
+            'meta': {'newest_id': ids[0], 'oldest_id': ids[-1], 'result_count': len(ids)},
+        }
+
+    group_path = str(tmp_path/'group')
+
+    files = FileSink(group_path)
+    files.write_page('11', page([9, 8], '11'))
+    files.write_page('11', page([3, 2], '11'))
+    files.write_page('12', page([5], '12'))
+    files.close()
+
+    segments = JsonlSink(group_path, records='tweets')
+    segments.write_page('13', page([6, 4], '13'))
+    segments.write_page('14', page([7], '14'))
+    segments.close()
+
+    records = list(iter_tweets(group_path))
+
+    assert len(records) == 8
+    assert [record['tweet']['id'] for record in records if record['user_id'] == '13'] == [tweet_id(6), tweet_id(4)]
+    assert records[-1]['includes'] == {
+        'users': [{'id': '14', 'username': 'author'}, {'id': '99', 'username': 'quoted'}],
+        'tweets': [{'id': '1', 'text': 'quoted', 'author_id': '99'}],
+    }
+
+    window = list(iter_tweets(group_path, start=datetime(2021, 1, 4), end=datetime(2021, 1, 9), fields=['text'],
+                              includes=False))
+
+    assert sorted(get_date_from_tweet_id(record['tweet']['id'])['date'] for record in window) == [
+        '2021-01-04', '2021-01-05', '2021-01-06', '2021-01-07', '2021-01-08']
+    assert all(record['tweet'].keys() == {'id', 'text'} and 'includes' not in record for record in window)
+
+    # page files outside of the time window are not opened
+    with patch('builtins.open', wraps=open) as opened:
+        records = list(iter_tweets(group_path, user_ids=['11', 13], start=datetime(2021, 1, 7)))
+
+    assert [record['user_id'] for record in records] == ['11', '11']
+    assert [call.args[0] for call in opened.call_args_list if call.args[0].endswith('.json')] == [
+        f'{group_path}/11/{tweet_id(9)}_{tweet_id(8)}.json']
+
+
+def test_page_writer_saves_pages_in_background(tmp_path):
+
+    pages = []
+    sink = Mock()
+    sink.write_page.side_effect = lambda user_id, page: time.sleep(0.01) or pages.append((user_id, page))
+
+    writer = PageWriter(sink, max_queued_pages=2)
+    writer.start()
+
+    batch = writer.batch()
+    for number in range(5):
+        batch.write('11', {'number': number})
+    batch.wait()
+
+    assert pages == [('11', {'number': number}) for number in range(5)]
+
+    sink.write_page.side_effect = OSError('disk full')
+
+    batch = writer.batch()
+    batch.write('11', {'number': 5})
+
+    with pytest.raises(OSError):
+        batch.wait()
+
+    writer.close()
+
+
+def test_crashed_collection_leaves_only_complete_files(tmp_path, monkeypatch, script_runner):
+
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('results/crashed/11')
+
+    sink = FileSink('results/crashed')
+    sink.write_page('11', {'data': [{'id': '2'}], 'meta': {'newest_id': '2', 'oldest_id': '2', 'result_count': 1}})
+
+    # pages only get their names once committed
+    assert os.listdir('results/crashed/11') == ['2_2.json.tmp']
+
+    segments = JsonlSink('results/crashed')
+    sizes = []
+    for number in range(3):
+        segments.write_page('11', {'data': [{'id': str(number)}], 'meta': {'result_count': 1}})
+        segments.flush()
+        sizes.append(os.path.getsize(segment_paths('results/crashed')[0]))
+
+    # the last chunk is cut off by the crash
+    os.truncate(segment_paths('results/crashed')[0], (sizes[1] + sizes[2]) // 2)
+
+    with open('results/crashed/11/1_1.json', 'w') as f:
+        f.write('{"data": [{"id": "1"}], "met')
+
+    state = StateStore('results/crashed/state.sqlite')
+    state.set_info('collecting', '1')
+    state.close()
+
+    user_group = UserGroup(name='crashed', sink='jsonl')
+
+    assert sorted(os.listdir('results/crashed/11')) == ['1_1.json']
+    assert user_group.state.get_info('collecting') is None
+
+    # the repaired segment can be continued
+    user_group.sink.write_page('11', {'data': [{'id': '3'}], 'meta': {'result_count': 1}})
+    user_group.sink.close()
+
+    assert [record['page']['data'][0]['id'] for record in read_segments('results/crashed')] == ['0', '1', '3']
+
+    # pages written in place by older versions are only found by a full check, and 3 was written after the
+    # end of the segments was last saved with the state
+    ret = script_runner.run(['twacapic', 'check', '-g', 'crashed'])
+
+    assert ret.returncode == 1
+    assert '1 corrupt pages' in ret.stdout
+    assert '1 uncommitted segments' in ret.stdout
+
+    ret = script_runner.run(['twacapic', 'check', '-g', 'crashed', '--repair'])
+
+    assert ret.success
+    assert os.listdir('results/crashed/11') == ['1_1.json.corrupt']
+    assert [record['page']['data'][0]['id'] for record in read_segments('results/crashed')] == ['0', '1']
+    assert user_group.state.get_info('segment_end') == segment_end('results/crashed')
+
+
+def test_page_index_finds_pages_by_user_and_time(tmp_path, monkeypatch, script_runner):
+
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('results/indexed')
+
+    def page(newest_id, count):
+        ids = [str(newest_id - number) for number in range(count)]
+        return {
+            'data': [{'id': id, 'text': 'héllo'} for id in ids],
+            'includes': {'users': [{'id': '1', 'username': 'ünïcode'}]},
+            'meta': {'newest_id': ids[0], 'oldest_id': ids[-1], 'result_count': count},
+        }
+
+    index = PageIndex('results/indexed')
+    assert index.complete
+
+    files = FileSink('results/indexed', index=index)
+    files.write_page('11', page(900, 3))
+    files.write_page('11', page(500, 3))
+    files.close()
+
+    # two gzip members, two pages of tweet records in one zstd frame
+    pages = JsonlSink('results/indexed', index=index)
+    pages.write_page('12', page(800, 2))
+    pages.flush()
+    pages.write_page('12', page(300, 2))
+    pages.close()
+
+    tweets = JsonlSink('results/indexed', compression='zstd', records='tweets', index=index)
+    tweets.write_page('13', page(700, 2))
+    tweets.write_page('13', page(200, 2))
+    tweets.close()
+
+    assert [row[:2] for row in index.pages(since_id=450, until_id=750)] == [
+        ('11', '11/500_498.json'), ('13', 'segments/segment-000000.jsonl.zst')]
+
+    def tweet_ids(**filters):
+        return [record['tweet']['id'] for record in iter_tweets('results/indexed', **filters)]
+
+    assert tweet_ids(since_id=450, until_id=750) == ['500', '499', '498', '700', '699']
+    assert tweet_ids(user_ids=['12', '13'], since_id=250) == ['800', '799', '300', '299', '700', '699']
+
+    # an incomplete index is not used
+    index.set_complete(False)
+    assert tweet_ids(user_ids=['12', '13'], since_id=250) == ['800', '799', '300', '299', '700', '699']
+
+    written = list(index.pages())
+    index.close()
+
+    ret = script_runner.run(['twacapic', 'index', '-g', 'indexed'])
+
+    assert ret.success
+    assert 'Indexed 6 pages of indexed' in ret.stdout
+
+    index = PageIndex('results/indexed')
+
+    assert index.complete
+    assert list(index.pages()) == written
+
+
+def test_export_to_parquet(tmp_path, script_runner):
+
+    pyarrow_dataset = pytest.importorskip('pyarrow.dataset')
+
+    ret = script_runner.run(['twacapic', 'export', '-g', 'missing'])
+
+    assert not ret.success
+    assert 'There is no group folder results/missing.' in ret.stdout
+
+    group_path = tmp_path/'results'/'test_export'
+    os.makedirs(group_path/'11')
+    shutil.copy('twacapic/templates/group_config.yaml', group_path)
+
+    page = {
+        'data': [
+            {'id': '1364000000000000001', 'text': 'Grüße', 'created_at': '2021-02-23T00:00:00.000Z',
+             'public_metrics': {'like_count': 3}, 'referenced_tweets': [{'type': 'quoted', 'id': '1'}]},
+        ],
+        'includes': {
+            'users': [{'id': '11', 'username': 'eleven', 'public_metrics': {'followers_count': 5}}],
+            'tweets': [{'id': '1364000000000000000', 'text': 'quoted'}],
+        },
+        'meta': {'newest_id': '1364000000000000001', 'oldest_id': '1364000000000000001', 'result_count': 1}
+    }
+
+    with open(group_path/'11'/'1364000000000000001_1364000000000000001.json', 'w') as f:
+        json.dump(page, f)
+
+    # parts written before a crash are only kept once the manifest saved them
+    with patch('twacapic.export.ExportManifest.save', side_effect=KeyboardInterrupt):
+        with pytest.raises(KeyboardInterrupt):
+            export_group(group_path, tmp_path/'export')
+
+    assert glob(f'{tmp_path}/export/*/month=*/*.tmp')
+
+    assert export_group(group_path, tmp_path/'export') == 3
+    assert export_group(group_path, tmp_path/'export') == 0
+    assert not glob(f'{tmp_path}/export/*/month=*/*.tmp')
+
+    tweets = pyarrow_dataset.dataset(tmp_path/'export'/'tweets', partitioning='hive').to_table().to_pylist()
+    users = pyarrow_dataset.dataset(tmp_path/'export'/'users', partitioning='hive').to_table().to_pylist()
+
+    tweets.sort(key=lambda tweet: tweet['id'])
+
+    assert [tweet['is_included'] for tweet in tweets] == [True, False]
+    assert tweets[1]['like_count'] == 3
+    assert tweets[1]['created_at'].year == 2021
+    assert json.loads(tweets[1]['referenced_tweets']) == page['data'][0]['referenced_tweets']
+    assert users[0]['followers_count'] == 5
+    assert users[0]['month'] == '2021-02'
+
+
+def test_collect_from_mock_server(mock_twitter_server):
+
+    user_group = UserGroup('users.csv', name='mock', get_all_the_tweets=True)
+    user_group.collect(max_results_per_call=50, workers=3)
+
+    reachable_user_ids = [
+        user_id for user_id in user_group.user_ids if mock_twitter_server.user_error(user_id) is None
+    ]
+
+    assert 0 < len(reachable_user_ids) < len(user_group.user_ids)
+
+    for user_id in set(user_group.user_ids) - set(reachable_user_ids):
+        assert user_group.meta[user_id]['newest_id'] == '0'
+        assert user_group.tweet_files[user_id] == []
+
+    for user_id in reachable_user_ids:
+
+        tweet_ids = set()
+        for file in user_group.tweet_files[user_id]:
+            with open(file, 'r') as f:
+                tweet_ids.update(tweet['id'] for tweet in json.load(f)['data'])
+
+        assert len(tweet_ids) == len(mock_twitter_server.timeline(user_id))
+        assert user_group.meta[user_id]['newest_id'] == max(tweet_ids, key=int)
+
+    pages = mock_twitter_server.stats['pages']
+
+    UserGroup(name='mock').collect(workers=3)
+
+    assert mock_twitter_server.stats['pages'] == pages + len(reachable_user_ids)
+
+
+def test_collection_reports_metrics(mock_twitter_server):
+
+    user_group = UserGroup('users.csv', name='metrics', get_all_the_tweets=True)
+    summary = user_group.collect(max_results_per_call=50, workers=2)
+
+    unreachable = sum(mock_twitter_server.user_error(user_id) is not None for user_id in user_group.user_ids)
+
+    assert summary['users'] == 10
+    assert summary['unreachable_users'] == unreachable
+    assert summary['pages'] == mock_twitter_server.stats['pages']
+    assert summary['tweets'] == mock_twitter_server.stats['tweets']
+    assert summary['requests'] == mock_twitter_server.stats['requests']
+    assert 0 < summary['request_p50'] <= summary['request_p95']
+
+    get_rate_limiter('metrics').update(Mock(status_code=200, headers={
+        'x-rate-limit-remaining': '42', 'x-rate-limit-reset': str(int(time.time()) + 60)
+    }))
+
+    server = serve(0)
+
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{server.server_port}/metrics') as response:
+            metrics = response.read().decode('utf8')
+    finally:
+        server.shutdown()
+
+    assert '# TYPE twacapic_http_request_seconds histogram' in metrics
+    assert 'twacapic_http_request_seconds_bucket{group="metrics",status="200",le="+Inf"}' in metrics
+    assert f'twacapic_users_total{{group="metrics",outcome="unreachable"}} {unreachable}' in metrics
+    assert 'twacapic_rate_limit_remaining{credential="metrics"} 42' in metrics
+
+
+def test_profiles_show_where_a_run_spends_its_time(mock_twitter_server):
+
+    with Profiler('sampled', 'profiles', 'sampling', allocations=True, interval=0.001) as profiler:
+        UserGroup('users.csv', name='profiled', get_all_the_tweets=True).collect(max_results_per_call=20, workers=2)
+
+    assert profiler.report['span_seconds']['network'] > 0
+    assert profiler.report['allocations']
+
+    with open(f'{profiler.path}.folded') as f:
+        stacks = [line.rsplit(' ', 1) for line in f]
+
+    assert all(int(count) > 0 for stack, count in stacks)
+    assert any(';span:network;' in stack and 'collect:request_tweets' in stack for stack, count in stacks)
+
+    with open(f'{profiler.path}.json') as f:
+        assert json.load(f)['span_seconds'] == profiler.report['span_seconds']
+
+    with Profiler('traced', 'profiles', 'deterministic') as profiler:
+        UserGroup(name='profiled').collect(workers=2)
+
+    assert 'request_tweets' in {function for file, line, function in pstats.Stats(f'{profiler.path}.pstats').stats}
+
+
+def test_groups_scheduled_at_once_are_profiled_each(mock_twitter_server):
+
+    for mode in ('sampling', 'deterministic'):
+
+        profilers = {}
+        both_started = threading.Barrier(2, timeout=5)
+        requests = mock_twitter_server.stats['requests']
+
+        def group_run(groupname):
+
+            def run_group():
+                with Profiler(groupname, 'profiles', mode, interval=0.001) as profiler:
+                    both_started.wait()
+                    profiler.summary = UserGroup('users.csv', name=groupname, get_all_the_tweets=True).collect(
+                        max_results_per_call=20, workers=2)
+                profilers[groupname] = profiler
+
+            return run_group
+
+        scheduler = Scheduler()
+
+        for groupname in (f'{mode}_1', f'{mode}_2'):
+            scheduler.every(3600, group_run(groupname), name=groupname)
+
+        async def run_until_profiled():
+            run = asyncio.create_task(scheduler.run())
+            while len(profilers) < 2 and all(job.error is None for job in scheduler.jobs):
+                await asyncio.sleep(0.05)
+            run.cancel()
+
+        asyncio.run(asyncio.wait_for(run_until_profiled(), 30))
+
+        assert [job.error for job in scheduler.jobs] == [None, None]
+
+        # the summary of each group only counts its own requests
+        assert sum(profiler.summary['requests'] for profiler in profilers.values()) == (
+            mock_twitter_server.stats['requests'] - requests)
+
+        for profiler in profilers.values():
+
+            assert profiler.report['summary']['pages'] > 0
+            assert profiler.report['span_seconds']['network'] > 0
+
+            if mode == 'sampling':
+                with open(f'{profiler.path}.folded') as f:
+                    assert any(';span:network;' in line and 'collect:request_tweets' in line for line in f)
+            else:
+                stats = pstats.Stats(f'{profiler.path}.pstats').stats
+                assert 'request_tweets' in {function for file, line, function in stats}
+
+
+def test_credential_pool_shards_users_and_drops_rejected_credentials(mock_twitter_server):
+
+    write_setup('.', mock_twitter_server.url, 30, credentials=3)
+    api = get_api('twitter_keys.yaml')
+
+    assert isinstance(api, ApiPool)
+
+    resources = [f'users/:{user_id}/tweets' for user_id in range(1_000_000, 1_000_030)]
+    assigned = {resource: api.choose(resource).consumer_key for resource in resources}
+
+    assert set(assigned.values()) == {'mock', 'mock_2', 'mock_3'}
+
+    # users of a credential with a used up rate limit window go to the others meanwhile
+    throttled = api.apis[2]
+    throttled.rate_limiter.remaining, throttled.rate_limiter.reset = 0, time.time() + 60
+
+    assert throttled not in [api.choose(resource) for resource in resources]
+
+    throttled.rate_limiter.remaining, throttled.rate_limiter.reset = None, None
+
+    # a revoked credential fails with its token and can not get a new one
+    mock_twitter_server.revoked_consumer_keys.add('mock_2')
+
+    user_group = UserGroup('users.csv', name='mock')
+    user_group.collect(api=api, workers=3)
+
+    assert [pooled_api.consumer_key for pooled_api in api.apis] == ['mock', 'mock_3']
+    assert len(user_group.meta) == 30
+
+    for resource, consumer_key in assigned.items():
+        if consumer_key != 'mock_2':
+            assert api.choose(resource).consumer_key == consumer_key
+
+
+def test_adaptive_collection_polls_active_users_first(mock_twitter_server):
+
+    user_group = UserGroup('users.csv', name='mock')
+    user_group.collect(adaptive=True)
+
+    requests = mock_twitter_server.stats['requests']
+    user_group.collect(adaptive=True)
+
+    # nobody is due right after being polled
+    assert mock_twitter_server.stats['requests'] == requests
+
+    meta = user_group.meta
+    unreachable_user_ids = [user_id for user_id in meta if mock_twitter_server.user_error(user_id) is not None]
+
+    assert unreachable_user_ids
+    for user_id in unreachable_user_ids:
+        assert 'next_poll_at' not in meta[user_id]
+        assert meta[user_id]['recheck_at'] - meta[user_id]['last_polled_at'] == RECHECK_INTERVALS['not_found']
+
+    due_user_ids = user_group.state.due_members(time.time() + 3600)
+    tweet_rates = [meta[user_id]['tweet_rate'] for user_id in due_user_ids]
+
+    assert due_user_ids
+    assert not set(due_user_ids) & set(unreachable_user_ids)
+    assert tweet_rates == sorted(tweet_rates, reverse=True)
+
+    # a poll without new tweets halves the estimated rate, i.e. doubles the interval
+    now = time.time()
+    schedule = schedule_next_poll({'newest_id': '1', 'last_polled_at': now - 60, 'tweet_rate': 0.01}, 0, None, now)
+
+    assert schedule['tweet_rate'] == 0.005
+    assert schedule['next_poll_at'] == now + 200
+
+    # unreachable users are due at their recheck, whatever their tweet rate
+    for user_id in unreachable_user_ids:
+        user_group.state.update(user_id, recheck_at=time.time() - 1)
+
+    assert set(unreachable_user_ids) <= set(user_group.state.due_members(time.time()))
+
+    requests = mock_twitter_server.stats['requests']
+    user_group.collect(adaptive=True)
+
+    assert mock_twitter_server.stats['requests'] == requests + len(unreachable_user_ids)
+
+    for user_id, metadata in user_group.state.unreachable(time.time()).items():
+        assert metadata['unreachable_checks'] == 2
+        assert 'next_poll_at' not in metadata
+
+
+def test_unreachable_users_are_skipped_until_recheck(mock_twitter_server, script_runner):
+
+    user_group = UserGroup('users.csv', name='mock')
+    user_group.collect()
+
+    unreachable = user_group.state.unreachable(time.time())
+
+    assert set(unreachable) == {
+        user_id for user_id in user_group.user_ids if mock_twitter_server.user_error(user_id) is not None
+    }
+    for metadata in unreachable.values():
+        assert metadata['unreachable_reason'] == 'not_found'
+        assert metadata['recheck_at'] - metadata['unreachable_since'] == RECHECK_INTERVALS['not_found']
+
+    requests = mock_twitter_server.stats['requests']
+    user_group.collect()
+
+    assert mock_twitter_server.stats['requests'] == requests + len(user_group.user_ids) - len(unreachable)
+
+    ret = script_runner.run('twacapic', 'unreachable', '-g', 'mock')
+
+    assert ret.success
+    assert sorted(line.split('\t')[1] for line in ret.stdout.splitlines()[1:]) == sorted(unreachable)
+
+    # still unreachable at the recheck: the interval doubles
+    for user_id in unreachable:
+        user_group.state.update(user_id, recheck_at=time.time() - 1)
+    user_group.collect()
+
+    for user_id, metadata in user_group.state.unreachable(time.time()).items():
+        assert metadata['unreachable_checks'] == 2
+        assert metadata['recheck_at'] - metadata['last_polled_at'] == 2 * RECHECK_INTERVALS['not_found']
+
+    # found again at the recheck: the user is polled normally again
+    mock_twitter_server.errors = {}
+    for user_id in unreachable:
+        user_group.state.update(user_id, recheck_at=time.time() - 1)
+    user_group.collect()
+
+    assert user_group.state.unreachable() == {}
+    for user_id in unreachable:
+        assert 'newest_id' in user_group.meta[user_id]
+
+
+def test_interrupted_backfill_resumes_after_last_saved_page(mock_twitter_server):
+
+    user_id = next(user_id for user_id in map(str, range(1_000_000, 1_000_010))
+                   if mock_twitter_server.user_error(user_id) is None)
+
+    with open('user.csv', 'w') as f:
+        f.write(user_id)
+
+    api = get_api('twitter_keys.yaml')
+    request = api.request
+    requested_params = []
+
+    class Crash(Exception):
+        pass
+
+    def crashing_request(resource, params=None, **kwargs):
+        if len(requested_params) == 5:
+            raise Crash()
+        requested_params.append(dict(params))
+        return request(resource, params, **kwargs)
+
+    api.request = crashing_request
+    user_group = UserGroup('user.csv', name='backfill', get_all_the_tweets=True)
+
+    with pytest.raises(Crash):
+        user_group.collect(api=api, max_results_per_call=10)
+
+    checkpoint = UserGroup(name='backfill').state.get(user_id)
+
+    assert checkpoint['newest_id'] == '0'
+    assert checkpoint['pagination_tweet_count'] == 50
+    assert len(glob(f'{user_group.path}/{user_id}/*.json')) == 5
+
+    requested_params.clear()
+    requests = mock_twitter_server.stats['requests']
+
+    api.request = lambda resource, params=None, **kwargs: requested_params.append(dict(params)) or request(
+        resource, params, **kwargs)
+
+    # the same command again keeps the checkpoint, and the query it was saved for is used, not that of the run
+    UserGroup('user.csv', name='backfill', get_all_the_tweets=True).collect(api=api, max_results_per_call=20)
+
+    # the resumed run starts with the page after the last saved one
+    assert requested_params[0] == dict(json.loads(checkpoint['pagination_query']),
+                                       pagination_token=checkpoint['pagination_token'])
+    assert requested_params[0]['max_results'] == 10
+    assert mock_twitter_server.stats['requests'] - requests == len(requested_params)
+
+    metadata = UserGroup(name='backfill').state.get(user_id)
+    tweet_ids = [
+        tweet['id'] for path in glob(f'{user_group.path}/{user_id}/*.json')
+        for tweet in json.load(open(path))['data']
+    ]
+
+    assert not {'pagination_token', 'pagination_tweet_count'} & set(metadata)
+    assert len(tweet_ids) == len(set(tweet_ids)) == len(mock_twitter_server.timeline(user_id))
+    assert metadata['newest_id'] == checkpoint['pagination_newest_id'] == max(tweet_ids, key=int)
+
+    # checkpoints are buffered like other updates, but saved at least every checkpoint_pages pages
+    state = StateStore(f'{user_group.path}/state.sqlite', checkpoint_pages=3, checkpoint_seconds=3600)
+    saved = []
+
+    for tweet_count in range(10, 70, 10):
+        state.checkpoint(user_id, pagination_token=str(tweet_count), pagination_tweet_count=tweet_count)
+        saved.append(StateStore(state.path).get(user_id).get('pagination_tweet_count'))
+
+    assert saved == [None, None, 30, 30, 30, 60]
+
+
+def test_killed_jsonl_backfill_stores_every_tweet_once(mock_twitter_server):
+
+    user_ids = [user_id for user_id in map(str, range(1_000_000, 1_000_010))
+                if mock_twitter_server.user_error(user_id) is None][:2]
+
+    with open('users.csv', 'w') as f:
+        f.write('\n'.join(user_ids))
+
+    def killed_collection():
+
+        api = get_api('twitter_keys.yaml')
+        request = api.request
+        requests = itertools.count()
+
+        def killing_request(resource, params=None, **kwargs):
+            if next(requests) == 30:
+                os._exit(1)
+            return request(resource, params, **kwargs)
+
+        api.request = killing_request
+        # every page goes to a segment of its own, so the pages after the checkpoint are on disk when killed
+        user_group = UserGroup('users.csv', name='killed', get_all_the_tweets=True, sink='jsonl',
+                               sink_options={'buffer_size': 1, 'segment_size': 1})
+        user_group.collect(api=api, max_results_per_call=5)
+
+    process = multiprocessing.get_context('fork').Process(target=killed_collection)
+    process.start()
+    process.join()
+
+    assert process.exitcode == 1
+
+    # the pages written after the last saved checkpoint are cut off again, and collected once more
+    checkpoint = StateStore('results/killed/state.sqlite').all()
+    assert any('pagination_token' in metadata for metadata in checkpoint.values())
+
+    UserGroup('users.csv', name='killed', get_all_the_tweets=True, sink='jsonl').collect(max_results_per_call=5)
+
+    tweet_ids = [record['page']['data'] for record in read_segments('results/killed')]
+    tweet_ids = [tweet['id'] for page in tweet_ids for tweet in page]
+
+    assert len(tweet_ids) == len(set(tweet_ids)) == sum(
+        len(mock_twitter_server.timeline(user_id)) for user_id in user_ids)
+
+
+def test_workers_share_a_group_through_leases(mock_twitter_server, script_runner):
+
+    ret = script_runner.run('twacapic', 'coordinate', '-g', 'mock', '-u', 'users.csv')
+
+    assert ret.success
+    assert WorkQueue('results/mock/queue.sqlite').stats() == {'queued': 10, 'leased': 0, 'expired': 0}
+
+    # a worker that crashed while holding leases, which expire right away
+    crashed_user_ids = WorkQueue('results/mock/queue.sqlite', lease_seconds=0).lease('crashed', 3)
+
+    collected = []
+
+    def worker():
+        queue = WorkQueue('results/mock/queue.sqlite')
+        user_group = UserGroup(name='mock', shared=True)
+        collected.append(work(user_group, queue, get_api('twitter_keys.yaml'), batch_size=2))
+
+    threads = [threading.Thread(target=worker) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sum(collected) == 10
+    assert WorkQueue('results/mock/queue.sqlite').stats() == {'queued': 0, 'leased': 0, 'expired': 0}
+
+    state = StateStore('results/mock/state.sqlite', shared=True)
+
+    for user_id in crashed_user_ids:
+        assert 'last_polled_at' in state.get(user_id)
+
+    # a worker that finishes a user after another one must not set newest_id back
+    user_id = next(user_id for user_id, metadata in state.all().items() if 'newest_id' in metadata)
+    newest_id = state.get(user_id)['newest_id']
+
+    state.update(user_id, newest_id=str(int(newest_id) - 1), tweet_rate=1.0)
+    state.flush()
+
+    assert StateStore('results/mock/state.sqlite').get(user_id)['newest_id'] == newest_id
+    assert StateStore('results/mock/state.sqlite').get(user_id)['tweet_rate'] == 1.0
+
+    # records of several workers appending to one segment would interleave
+    ret = script_runner.run(['twacapic', '--sink', 'jsonl', 'work', '-g', 'mock'])
+
+    assert not ret.success
+    assert 'Workers can not share jsonl segments' in ret.stderr
+
+    with pytest.raises(ValueError):
+        UserGroup(name='mock', sink='jsonl', shared=True)
+
+
 def test_collect_only_tweets_of_last_x_days(user_group_to_get_all_the_tweets):
 
     days = random.randint(1, 14)
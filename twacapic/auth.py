@@ -1,5 +1,242 @@
+import socket
+import ssl
+import threading
+import time
+import zlib
+
+import requests
 import yaml
-from TwitterAPI import TwitterAPI
+from loguru import logger
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, ReadTimeout, SSLError
+from twacapic.durable import write_atomically
+from twacapic.metrics import HTTP_REQUESTS, current_group
+from twacapic.profiling import span
+from twacapic.ratelimit import get_rate_limiter
+from TwitterAPI import TwitterAPI as BaseTwitterAPI
+from TwitterAPI import TwitterResponse
+from TwitterAPI.BearerAuth import OAUTH2_ENDPOINT, BearerAuth
+from TwitterAPI.constants import DOMAIN, ENDPOINTS, PROTOCOL
+from TwitterAPI.TwitterAPI import HydrateType, OAuthType
+from TwitterAPI.TwitterError import TwitterConnectionError
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+
+CONNECTION_DEFAULTS = {
+    'connect_timeout': BaseTwitterAPI.CONNECTION_TIMEOUT,
+    'read_timeout': BaseTwitterAPI.REST_TIMEOUT,
+    'pool_size': 10,
+    'api_url': None
+}
+
+
+class CachedBearerAuth(BearerAuth):
+
+    # Like TwitterAPI's BearerAuth, but starts from a known bearer token if there is one
+    # and can fetch a new one when Twitter does not accept the current one anymore.
+
+    def __init__(self, consumer_key, consumer_secret, bearer_token=None, proxies=None, user_agent=None,
+                 api_url=None):
+
+        self._consumer_key = consumer_key
+        self._consumer_secret = consumer_secret
+        self.proxies = proxies
+        self.user_agent = user_agent
+        self.api_url = api_url
+        self._bearer_token = bearer_token or self._get_access_token()
+        self._lock = threading.Lock()
+
+    @property
+    def bearer_token(self):
+        return self._bearer_token
+
+    def refresh(self, rejected_token):
+
+        with self._lock:
+            # several workers can get a 401 for the same token, fetch a new one only once
+            if self._bearer_token == rejected_token:
+                logger.info('Bearer token was rejected, requesting a new one …')
+                try:
+                    self._bearer_token = self._get_access_token()
+                except Exception as e:
+                    raise CredentialRevoked(f'{self._consumer_key}: {e}')
+
+        return self._bearer_token
+
+    def _get_access_token(self):
+
+        if self.api_url is None:
+            return super()._get_access_token()
+
+        # same request as TwitterAPI's, sent to the replacement of https://api.twitter.com
+        try:
+            response = requests.post(
+                f'{self.api_url.rstrip("/")}/{OAUTH2_ENDPOINT}',
+                data={'grant_type': 'client_credentials'},
+                auth=(self._consumer_key, self._consumer_secret),
+                headers={'User-Agent': self.user_agent},
+                proxies=self.proxies
+            )
+            return response.json()['access_token']
+        except Exception as e:
+            raise Exception(f'Error requesting bearer access token: {e}')
+
+
+class CredentialRevoked(Exception):
+    pass
+
+
+class NoCredentialsLeft(Exception):
+    pass
+
+
+class TwitterAPI(BaseTwitterAPI):
+
+    # TwitterAPI opens a new session, i.e. a new TLS connection, for every request.
+    # This keeps one pooled session with keep-alive connections per API object instead.
+    # Anything but plain GET requests of the REST API is left to TwitterAPI.
+    # With oAuth2, a cached bearer token can be passed to skip the token request;
+    # on_token_change is called with every newly fetched token, e.g. to cache it.
+    # api_url replaces https://api.twitter.com, e.g. to talk to a local mock server.
+
+    def __init__(self, consumer_key=None, consumer_secret=None, auth_type=OAuthType.OAUTH1, bearer_token=None,
+                 on_token_change=None, pool_size=CONNECTION_DEFAULTS['pool_size'], api_url=None, **kwargs):
+
+        oauth2 = auth_type in (OAuthType.OAUTH2, 'oAuth2')
+
+        if oauth2:
+            # TwitterAPI only gets a placeholder, the bearer token is managed by CachedBearerAuth below
+            super().__init__(oauth2_access_token=bearer_token or '-', auth_type=OAuthType.OAUTH2USER, **kwargs)
+        else:
+            super().__init__(consumer_key, consumer_secret, auth_type=auth_type, **kwargs)
+
+        self.on_token_change = on_token_change
+
+        if oauth2:
+            self.auth = CachedBearerAuth(consumer_key, consumer_secret, bearer_token,
+                                         proxies=self.proxies, user_agent=self.USER_AGENT, api_url=api_url)
+
+            if bearer_token != self.auth.bearer_token and on_token_change is not None:
+                on_token_change(self.auth.bearer_token)
+
+        self.consumer_key = consumer_key
+        self.api_url = api_url
+
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.session.auth = self.auth
+        self.session.headers['User-Agent'] = self.USER_AGENT
+
+    def request(self, resource, params=None, files=None, method_override=None, hydrate_type=HydrateType.NONE):
+
+        bearer_token = getattr(self.auth, 'bearer_token', None)
+
+        response = self._request(resource, params, files, method_override, hydrate_type)
+
+        if response.status_code == 401 and bearer_token is not None:
+
+            if self.auth.refresh(bearer_token) != bearer_token and self.on_token_change is not None:
+                self.on_token_change(self.auth.bearer_token)
+
+            response = self._request(resource, params, files, method_override, hydrate_type)
+
+        return response
+
+    def _prepare_url(self, subdomain, path):
+
+        url = super()._prepare_url(subdomain, path)
+
+        if self.api_url is not None:
+            url = url.replace(f'{PROTOCOL}://{subdomain}.{DOMAIN}', self.api_url.rstrip('/'), 1)
+
+        return url
+
+    def _request(self, resource, params=None, files=None, method_override=None, hydrate_type=HydrateType.NONE):
+
+        path, endpoint = self._get_endpoint(resource)
+        method, subdomain = ENDPOINTS.get(endpoint, (None, None))
+
+        if method != 'GET' or files is not None or method_override is not None or path.endswith('/stream'):
+            return super().request(resource, params, files, method_override, hydrate_type)
+
+        start = time.perf_counter()
+
+        try:
+            with span('network'):
+                response = self.session.get(
+                    self._prepare_url(subdomain, path),
+                    params=params,
+                    timeout=(self.CONNECTION_TIMEOUT, self.REST_TIMEOUT),
+                    proxies=self.proxies
+                )
+        except (ConnectionError, ProtocolError, ReadTimeout, ReadTimeoutError,
+                SSLError, ssl.SSLError, socket.error) as e:
+            HTTP_REQUESTS.observe(time.perf_counter() - start, group=current_group(), status='error')
+            raise TwitterConnectionError(e)
+
+        HTTP_REQUESTS.observe(time.perf_counter() - start, group=current_group(), status=response.status_code)
+
+        return TwitterResponse(response, {'api_version': self.version, 'is_stream': False,
+                                          'hydrate_type': hydrate_type})
+
+
+class ApiPool:
+
+    # Spreads requests over the APIs of several credentials, each with its own rate limiter.
+    # Every resource (i.e. user timeline) is assigned to a credential by rendezvous hashing, so
+    # that taking a credential out of rotation only reassigns the users of that credential.
+    # While the rate limit window of a credential is used up, its users go to the next credential
+    # that still has requests left. Credentials that Twitter rejects (401 after a new bearer token,
+    # 403, or no new bearer token at all) are taken out of rotation for the rest of the run.
+
+    def __init__(self, apis):
+        self.apis = list(apis)
+        self._lock = threading.Lock()
+
+    def choose(self, resource):
+
+        with self._lock:
+            apis = list(self.apis)
+
+        if not apis:
+            raise NoCredentialsLeft('All credentials have been rejected by Twitter.')
+
+        apis.sort(key=lambda api: zlib.crc32(f'{api.consumer_key}:{resource}'.encode()), reverse=True)
+
+        for api in apis:
+            if api.rate_limiter.seconds_until_available() == 0:
+                return api
+
+        return min(apis, key=lambda api: api.rate_limiter.seconds_until_available())
+
+    def remove(self, api, reason):
+
+        with self._lock:
+            if api in self.apis:
+                self.apis.remove(api)
+                logger.error(f'Credential {api.consumer_key} taken out of rotation: {reason}. '
+                             f'{len(self.apis)} credentials left.')
+
+    def request(self, resource, params=None, **kwargs):
+
+        while True:
+
+            api = self.choose(resource)
+            api.rate_limiter.wait()
+
+            try:
+                response = api.request(resource, params, **kwargs)
+            except CredentialRevoked as e:
+                self.remove(api, e)
+                continue
+
+            api.rate_limiter.update(response)
+
+            if response.status_code in (401, 403):
+                self.remove(api, f'HTTP status {response.status_code}')
+                continue
+
+            return response
 
 
 def save_credentials(path, consumer_key=None, consumer_secret=None, bearer_token=None):
@@ -14,23 +251,100 @@ def save_credentials(path, consumer_key=None, consumer_secret=None, bearer_token
             }
     }
 
-    with open(path, 'w') as file:
-        yaml.dump(content, file)
+    write_atomically(path, yaml.dump(content))
 
 
 def read_credentials(path):
+
+    # the first credential if several are given
+
+    return read_all_credentials(path)[0]
+
+
+def read_all_credentials(path):
+
+    # search_tweets_v2 is either one credential or a list of them, e.g.
+    # search_tweets_v2:
+    #   - consumer_key: …
+    #     consumer_secret: …
+    #   - consumer_key: …
+    #     consumer_secret: …
+
     with open(path, 'r') as file:
+        content = yaml.safe_load(file)
+
+    credentials = content['search_tweets_v2']
 
+    return credentials if isinstance(credentials, list) else [credentials]
+
+
+_credentials_file_lock = threading.Lock()
+
+
+def save_bearer_token(path, bearer_token, consumer_key=None):
+
+    with _credentials_file_lock:
+
+        with open(path, 'r') as file:
+            content = yaml.safe_load(file)
+
+        credentials = content['search_tweets_v2']
+
+        for credential in credentials if isinstance(credentials, list) else [credentials]:
+            if consumer_key is None or credential['consumer_key'] == consumer_key:
+                credential['bearer_token'] = bearer_token
+                break
+
+        write_atomically(path, yaml.dump(content))
+
+
+def read_connection_config(path):
+
+    # optional `connection` section in the credentials file, e.g.
+    # connection:
+    #   connect_timeout: 5
+    #   read_timeout: 5
+    #   pool_size: 10
+    #   api_url: http://localhost:8080  # only for testing against a mock server
+
+    with open(path, 'r') as file:
         content = yaml.safe_load(file)
 
-        return content['search_tweets_v2']
+    config = dict(CONNECTION_DEFAULTS)
+    config.update(content.get('connection') or {})
+
+    return config
+
+
+def get_api(path, pool_size=None):
+
+    # an ApiPool if the credentials file lists several credentials
 
+    connection_config = read_connection_config(path)
+    apis = [create_api(path, credentials, connection_config, pool_size) for credentials in read_all_credentials(path)]
 
-def get_api(path):
+    if len(apis) > 1:
+        return ApiPool(apis)
+
+    return apis[0]
+
+
+def create_api(path, credentials, connection_config, pool_size=None):
 
-    credentials = read_credentials(path)
     consumer_key = credentials['consumer_key']
     consumer_secret = credentials['consumer_secret']
 
-    return TwitterAPI(consumer_key, consumer_secret,
-                      auth_type='oAuth2', api_version='2')
+    api = TwitterAPI(consumer_key, consumer_secret,
+                     auth_type='oAuth2', api_version='2',
+                     bearer_token=credentials.get('bearer_token'),
+                     on_token_change=lambda bearer_token: save_bearer_token(path, bearer_token, consumer_key),
+                     pool_size=max(pool_size or 0, connection_config['pool_size']),
+                     api_url=connection_config['api_url'])
+
+    api.CONNECTION_TIMEOUT = connection_config['connect_timeout']
+    api.REST_TIMEOUT = connection_config['read_timeout']
+
+    # one limiter per credential, shared by all groups of a run
+    api.rate_limiter = get_rate_limiter(consumer_key)
+
+    return api
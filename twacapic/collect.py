@@ -1,61 +1,150 @@
+import itertools
 import json
 import os
-import shutil
 import time
-from datetime import datetime
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
 from glob import glob
 
 import twacapic.templates
 import yaml
 from loguru import logger
 from twacapic.auth import get_api
+from twacapic.config import GroupConfig
+from twacapic.dedup import DedupSink, SeenIndex
+from twacapic.durable import write_atomically
+from twacapic.integrity import check_group
+from twacapic.metrics import (PAGE_BYTES, PAGE_REQUESTS, PAGES, REGISTRY, RETRIES, TWEETS, USER_SECONDS, USERS,
+                              current_group, format_summary, set_group, summarize)
+from twacapic.pageindex import PageIndex
+from twacapic.pages import Page
+from twacapic.priority import REACHABLE, mark_unreachable, schedule_next_poll
+from twacapic.profiling import attach, current, span
+from twacapic.reader import iter_tweets
+from twacapic.sinks import PageWriter, get_sink, segment_end
+from twacapic.state import CHECKPOINT_COLUMNS, StateStore
 from TwitterAPI.TwitterError import TwitterConnectionError, TwitterRequestError
 
 logger.remove()
 
 
+def read_user_list(path):
+
+    with open(path, 'r') as file:
+        for line in file:
+            user_id = line.strip()
+            if user_id:
+                yield user_id
+
+
+class UserIds:
+
+    # The users of a group, read lazily on every iteration: those of the given user list,
+    # or all members of the group in the state store.
+
+    def __init__(self, state, path=None):
+        self.state = state
+        self.path = path
+
+    def __iter__(self):
+
+        if self.path is not None:
+            return read_user_list(self.path)
+
+        return self.state.members()
+
+    def __len__(self):
+
+        if self.path is not None:
+            return sum(1 for user_id in self)
+
+        return self.state.count_members()
+
+
 class UserGroup:
 
-    def __init__(self, path=None, name=None, config=None, get_all_the_tweets=False):
+    def __init__(self, path=None, name=None, config=None, get_all_the_tweets=False, sink='files', sink_options=None,
+                 shared=False, dedup=None):
+
+        # records of several processes appending to the same segment would interleave
+        if shared and sink == 'jsonl':
+            raise ValueError('Shared groups can not be written to jsonl segments, use the files sink.')
 
         self.source_path = path  # TODO: better naming, path is the path to the list of ids, not to the group folder
         self.path = f'results/{name}'
         self.name = name
 
         if path is not None:
-            self.user_ids = []
-            with open(path, 'r') as file:
-                for line in file:
-                    user_id = line.strip()
-                    os.makedirs(f'results/{name}/{user_id}', exist_ok=True)
-
-                    if get_all_the_tweets is True:
-                        meta_file_path = f'{self.path}/{user_id}/meta.yaml'
-                        user_metadata = {'newest_id': '0', 'oldest_id': '0'}
-
-                        with open(meta_file_path, 'w') as metafile:
-                            yaml.dump(user_metadata, metafile)
-
-                    self.user_ids.append(user_id)
-        else:
-            self.user_ids = [
-                item for item in os.listdir(self.path) if os.path.isdir(
-                    os.path.join(self.path, item)
-                    )
-            ]
+            os.makedirs(self.path, exist_ok=True)
+        elif not os.path.isdir(self.path):
+            raise FileNotFoundError(f'There is no group folder {self.path}.')
+
+        # pages are added to the page index by the sink, see pageindex.py
+        self.page_index = PageIndex(self.path)
+        self.sink = get_sink(self.path, sink, index=self.page_index, **(sink_options or {}))
+
+        # dedup: leave out included tweets (includes), or all tweets (all), that are already stored, see dedup.py
+        if dedup is not None:
+            self.sink = DedupSink(self.sink, SeenIndex(), name, timeline=dedup == 'all')
+
+        self.page_writer = PageWriter(self.sink)
+
+        # shared: collected by several processes at the same time, see workqueue.py
+        self.state = StateStore(f'{self.path}/state.sqlite', before_flush=self._flush_pages, shared=shared,
+                                after_flush=getattr(self.sink, 'flush_index', None))
+
+        # a collection that was killed can leave uncommitted pages and records behind
+        if not shared and self.state.get_info('collecting') is not None:
+            logger.warning(f'The last collection of {name} did not finish, checking its files …')
+            check_group(self.path, repair=True, state=self.state)
+            self.state.set_info('collecting', None)
+            # pages committed right before the crash can be missing from the index, and segments were rewritten
+            if self.page_index.complete:
+                self.page_index.set_complete(False)
+                logger.warning(f'Run `twacapic index -g {name}` to rebuild the page index of {name}.')
+        self.state.migrate(self.path)
+        self.state.index_user_directories(self.path)
+
+        # the segments of a group collected before their end was saved with the state are committed
+        if not shared and self.state.get_info('segment_end') is None:
+            self.state.set_info('segment_end', segment_end(self.path))
+
+        # members are kept in the state store, user folders are only created with the first page of a user
+        if path is not None and get_all_the_tweets is True:
+            self.state.add_members(read_user_list(path), newest_id='0', oldest_id='0')
+        elif path is not None:
+            self.state.add_members(read_user_list(path))
+
+        self.user_ids = UserIds(self.state, path)
 
         if config is not None:
-            shutil.copy(config, f'{self.path}/group_config.yaml')
+            # a malformed config is rejected before it replaces the one of the group
+            GroupConfig.load(config)
+            with open(config, 'r') as f:
+                write_atomically(f'{self.path}/group_config.yaml', f.read())
         elif not os.path.isfile(f'{self.path}/group_config.yaml'):
-            with open(f'{self.path}/group_config.yaml', 'w') as f:
-                yaml.dump(twacapic.templates.group_config, f)
+            write_atomically(f'{self.path}/group_config.yaml', yaml.dump(twacapic.templates.group_config))
+
+        self._config = None
+        self._config_version = None
+
+        # raises ConfigError now instead of in the middle of a run
+        self.config
 
     @property
     def config(self):
-        with open(f'{self.path}/group_config.yaml', 'r') as f:
-            config = yaml.safe_load(f)
 
-            return config
+        # parsed once and again only after group_config.yaml changed, e.g. between scheduled runs
+        with span('state'):
+
+            stat = os.stat(f'{self.path}/group_config.yaml')
+            version = (stat.st_mtime_ns, stat.st_size)
+
+            if version != self._config_version:
+                self._config = GroupConfig.load(f'{self.path}/group_config.yaml')
+                self._config_version = version
+
+        return self._config
 
     @property
     def tweet_files(self):
@@ -64,21 +153,33 @@ class UserGroup:
             files[user_id] = glob(f'{self.path}/{user_id}/*.json')
         return files
 
+    def tweets(self, user_ids=None, start=None, end=None, since_id=None, until_id=None, fields=None, includes=True):
+        # streams the collected tweets with what they refer to, see reader.iter_tweets
+        return iter_tweets(self.path, user_ids, start, end, since_id, until_id, fields, includes)
+
     @property
     def meta(self):
-        meta = {}
-        for user_id in self.user_ids:
-            with open(f'{self.path}/{user_id}/meta.yaml', 'r') as f:
-                meta[user_id] = yaml.safe_load(f)
-        return meta
+        state = self.state.all()
+        return {user_id: state[user_id] for user_id in self.user_ids if user_id in state}
 
-    def request_tweets(self, api, user_id, params, get_all_pages=False):
+    def request_tweets(self, api, user_id, params, get_all_pages=False, resume=None):
+
+        # resume: the checkpoint of an interrupted pagination of the user (see state.CHECKPOINT_COLUMNS),
+        # requests continue with the same query after the last page saved before the interruption
+
+        rate_limiter = getattr(api, 'rate_limiter', None)
 
         @retry
         def get_page(params):
 
+            if rate_limiter is not None:
+                rate_limiter.wait()
+
             response = api.request(f'users/:{user_id}/tweets', params)
 
+            if rate_limiter is not None:
+                rate_limiter.update(response)
+
             try:
                 assert response.status_code == 200
                 logger.debug(response.text)
@@ -86,145 +187,295 @@ class UserGroup:
                 logger.warning(response.text)
                 raise e
 
-            tweets = json.loads(response.text)
+            page = Page(response.text)
 
-            if 'errors' in tweets and 'data' not in tweets:
+            if page.has_errors:
 
-                logger.warning(tweets["errors"])
+                tweets = page.data
 
-                if tweets['errors'][0]['title'] == 'Not Found Error':
-                    logger.warning(f'{user_id} not found.')
-                elif tweets['errors'][0]['title'] == 'Forbidden':
-                    logger.warning(f'{user_id} forbidden.')
-                elif tweets['errors'][0]['title'] == 'Authorization Error':
-                    logger.warning(f'{user_id} Authorization Error.')
-                else:
-                    raise TwitterRequestError(200, f"{tweets['errors']}")
+                if 'errors' in tweets and 'data' not in tweets:
 
-                return None
+                    logger.warning(tweets["errors"])
 
-            if 'errors' in tweets and 'data' in tweets:
+                    if tweets['errors'][0]['title'] == 'Not Found Error':
+                        logger.warning(f'{user_id} not found.')
+                        raise UserUnavailable(user_id, 'not_found')
+                    elif tweets['errors'][0]['title'] == 'Forbidden':
+                        logger.warning(f'{user_id} forbidden.')
+                        raise UserUnavailable(user_id, 'forbidden')
+                    elif tweets['errors'][0]['title'] == 'Authorization Error':
+                        logger.warning(f'{user_id} Authorization Error.')
+                        raise UserUnavailable(user_id, 'unauthorized')
+                    else:
+                        raise TwitterRequestError(200, f"{tweets['errors']}")
 
-                for error in tweets['errors']:
-                    logger.warning(error)
+                if 'errors' in tweets and 'data' in tweets:
 
-            result_count = tweets['meta']['result_count']
+                    for error in tweets['errors']:
+                        logger.warning(error)
 
-            if result_count == 0 and 'next_token' not in tweets['meta']:
+            result_count = page.meta['result_count']
+
+            if result_count == 0 and 'next_token' not in page.meta:
                 logger.info(f'No new tweets found for {user_id}.')
                 return None
             else:
                 logger.info(f'{result_count} tweets found for {user_id}')
 
-            oldest_id = tweets['meta']['oldest_id']
-            newest_id = tweets['meta']['newest_id']
+            # the bytes as received, response.text is decoded from them
+            PAGE_BYTES.inc(len(response.response.content), group=self.name)
 
-            with open(f'results/{self.name}/{user_id}/{newest_id}_{oldest_id}.json', 'w',
-                      encoding='utf8') as f:
-                json.dump(tweets, f, ensure_ascii=False)
+            return page
 
-            return oldest_id, newest_id, tweets
+        def save_checkpoint(checkpoint):
+            return lambda: self.state.checkpoint(user_id, **checkpoint)
 
-        try:
-            oldest_id, newest_id, tweets = get_page(params)
-        except TypeError:
+        # pages are saved by the page writer while the next page is requested,
+        # the ids are only returned once all pages are saved
+        batch = self.page_writer.batch()
+
+        if resume is not None:
+            # checkpoints of older versions did not save the query
+            if 'pagination_query' in resume:
+                params = json.loads(resume['pagination_query'])
+            params['pagination_token'] = resume['pagination_token']
+            newest_id = resume['pagination_newest_id']
+            oldest_id = resume['pagination_oldest_id']
+            tweet_count = resume['pagination_tweet_count']
+            logger.info(f'Resuming collection of {user_id} after {tweet_count} tweets.')
+        else:
+            newest_id, oldest_id, tweet_count = None, None, 0
+
+        query = json.dumps({key: value for key, value in params.items() if key != 'pagination_token'})
+
+        while True:
+
+            try:
+                with PAGE_REQUESTS.time(group=self.name):
+                    page = get_page(params)
+            except UserUnavailable:
+                if newest_id is None:
+                    raise
+                # keep what has been collected so far, the user is checked again next time
+                break
+
+            if page is None:
+                break
+
+            meta = page.meta
+            paginate = get_all_pages is True and 'next_token' in meta
+
+            PAGES.inc(group=self.name)
+            TWEETS.inc(meta['result_count'], group=self.name)
+
+            if meta['result_count'] > 0:
+
+                newest_id = newest_id or meta['newest_id']
+                oldest_id = meta['oldest_id']
+                tweet_count += meta['result_count']
+
+                # once this page is saved, a new run continues with the next one
+                checkpoint = {
+                    'pagination_token': meta['next_token'], 'pagination_newest_id': newest_id,
+                    'pagination_oldest_id': oldest_id, 'pagination_tweet_count': tweet_count,
+                    'pagination_query': query
+                } if paginate else None
+
+                batch.write(user_id, page, save_checkpoint(checkpoint) if checkpoint else None)
+
+            if not paginate:
+                break
+
+            params['pagination_token'] = meta['next_token']
+
+        batch.wait()
+
+        if newest_id is None:
             return None
 
-        if get_all_pages is True:
-            while 'next_token' in tweets['meta']:
+        return oldest_id, newest_id, tweet_count
 
-                params['pagination_token'] = tweets['meta']['next_token']
+    def select_user_ids(self, adaptive=False):
 
-                next_page = get_page(params)
+        if adaptive:
+            # only users that are due according to their tweet rate, the most active first
+            user_ids = self.state.due_members(time.time())
+            logger.info(f'{len(user_ids)} of {self.state.count_members()} users of {self.name} are due.')
+            return user_ids
 
-                if next_page is not None:
-                    oldest_id, new_newest_id, tweets = next_page
-                else:
-                    break
+        # users that were unreachable recently are skipped until their recheck is due
+        unreachable = self.state.unreachable(time.time())
 
-        return oldest_id, newest_id
+        if unreachable:
+            logger.info(f'Skipping {len(unreachable)} unreachable users of {self.name}.')
 
-    def collect(self, credential_path='twitter_keys.yaml', max_results_per_call=100, days=None):
+        return (user_id for user_id in self.user_ids if user_id not in unreachable)
 
-        api = get_api(credential_path)
+    def collect(self, credential_path='twitter_keys.yaml', max_results_per_call=100, days=None, workers=1, api=None,
+                adaptive=False, user_ids=None):
 
-        field_config = self.config['fields']
+        if api is None:
+            api = get_api(credential_path, pool_size=workers)
 
-        fields = [
-            field for field in field_config if field_config[field]
-        ]
+        # the same for all users of the run
+        params = dict(self.config.params, max_results=max_results_per_call)
 
-        expansions_config = self.config['expansions']
+        if days is not None:
+            start_time = datetime.now(timezone.utc) - timedelta(days=days)
+            params['start_time'] = start_time.strftime('%Y-%m-%dT%H:%M:%SZ')
 
-        expansions = [
-            expansion for expansion in expansions_config if expansions_config[expansion]
-        ]
+        if user_ids is None:
+            user_ids = self.select_user_ids(adaptive)
 
-        user_field_config = self.config['user.fields']
+        # shared groups are collected by several processes at once, see workqueue.py
+        if not self.state.shared:
+            self.state.set_info('collecting', str(os.getpid()))
 
-        user_fields = [
-            user_field for user_field in user_field_config if user_field_config[user_field]
-        ]
+        before = REGISTRY.snapshot()
+        started = time.time()
 
-        iterlist = self.user_ids.copy()
-        # copy needed because self.user_ids changes during iteration … what a bedbug …
+        previous_group = current_group()
+        set_group(self.name)
 
-        for user_id in iterlist:
+        self.page_writer.start()
 
-            params = {}
-            params['tweet.fields'] = ','.join(fields)
-            params['expansions'] = ','.join(expansions)
-            params['user.fields'] = ','.join(user_fields)
+        try:
+            self.collect_users(api, user_ids, params, workers)
+        finally:
+            self.page_writer.close()
+            self.state.flush()
+            self.sink.close()
 
-            if days is not None:
+            if not self.state.shared:
+                self.state.set_info('segment_end', segment_end(self.path))
+                self.state.set_info('collecting', None)
 
-                seconds = days * 24 * 3600
-                earliest_timestamp = time.time() - seconds
-                dt_object = datetime.fromtimestamp(earliest_timestamp)
-                param_date_string = f'{dt_object.isoformat(timespec="seconds")}Z'
-                params['start_time'] = param_date_string
+            set_group(previous_group)
 
-            logger.info(f"Collecting tweets for user {user_id} …")
+        summary = summarize(self.name, before, time.time() - started)
+        logger.info(format_summary(summary))
 
-            meta_file_path = f'{self.path}/{user_id}/meta.yaml'
+        return summary
 
-            if not os.path.isfile(meta_file_path):
+    def collect_users(self, api, user_ids, params, workers=1):
 
-                params['max_results'] = max_results_per_call
-                collected_ids = self.request_tweets(api, user_id, params)
+        if workers > 1:
+
+            user_ids = iter(user_ids)
+
+            with ThreadPoolExecutor(max_workers=workers, initializer=self._start_worker,
+                                    initargs=(current(),)) as executor:
+
+                # users are submitted as workers become free instead of all at once
+                futures = set()
+
+                try:
+                    while True:
+
+                        for user_id in itertools.islice(user_ids, 2 * workers - len(futures)):
+                            futures.add(executor.submit(self.collect_user, api, user_id, params))
+
+                        if not futures:
+                            break
+
+                        done, futures = wait(futures, return_when=FIRST_COMPLETED)
+
+                        for future in done:
+                            future.result()
+
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+
+        else:
+
+            for user_id in user_ids:
+                self.collect_user(api, user_id, params)
 
-                user_metadata = {}
+    def _flush_pages(self):
 
-                if collected_ids is not None:
-                    oldest_id, newest_id = collected_ids
-                    user_metadata['newest_id'] = newest_id
-                    user_metadata['oldest_id'] = oldest_id
+        # The end of the segments once the pages are durable is saved with the state of their users, a
+        # crashed run is cut back to it. The ids of stored tweets (--dedup) are only saved after the
+        # state, so that a crash can not leave out a tweet that is collected again.
 
-                    with open(meta_file_path, 'w') as metafile:
-                        yaml.dump(user_metadata, metafile)
+        flush = getattr(self.sink, 'flush_pages', self.sink.flush)
+        end = flush()
+
+        return None if end is None else {'segment_end': end}
+
+    def _start_worker(self, profiler):
+
+        # the workers are part of the run: profiled with it, and their metrics count for the group
+        attach(profiler)
+        set_group(self.name)
+
+    def collect_user(self, api, user_id, params):
+
+        # request_tweets adds the pagination parameters of the user
+        params = dict(params)
+
+        logger.info(f"Collecting tweets for user {user_id} …")
+
+        user_metadata = self.state.get(user_id)
+        polled_at = time.time()
+        started = time.perf_counter()
+
+        try:
+
+            if user_metadata is None or 'newest_id' not in user_metadata:
+
+                collected_ids = self.request_tweets(api, user_id, params)
 
             else:
 
-                with open(meta_file_path, 'r') as metafile:
-                    user_metadata = yaml.safe_load(metafile)
+                if 'start_time' not in params:
+                    params['since_id'] = user_metadata['newest_id']
+
+                # an interrupted pagination is resumed with the query it was started with, e.g. of a run with -d
+                resume = user_metadata if 'pagination_token' in user_metadata else None
+
+                collected_ids = self.request_tweets(api, user_id, params, get_all_pages=True, resume=resume)
+
+        except UserUnavailable as e:
+
+            # without a next poll, only the recheck decides when the user is due again
+            self.state.update(user_id, last_polled_at=polled_at, next_poll_at=None,
+                              **mark_unreachable(user_metadata, e.reason, polled_at))
+            USERS.inc(group=self.name, outcome='unreachable')
+            USER_SECONDS.observe(time.perf_counter() - started, group=self.name)
+            return
+
+        metadata = dict.fromkeys(CHECKPOINT_COLUMNS)
+
+        if user_metadata is not None and 'unreachable_reason' in user_metadata:
+            logger.info(f'{user_id} is reachable again.')
+            metadata.update(REACHABLE)
+
+        if collected_ids is None:
+            metadata.update(schedule_next_poll(user_metadata, 0, None, polled_at))
+        else:
+            oldest_id, newest_id, tweet_count = collected_ids
+            metadata.update(schedule_next_poll(user_metadata, tweet_count, oldest_id, polled_at))
+            metadata['newest_id'] = newest_id
+
+            if user_metadata is None or 'newest_id' not in user_metadata:
+                metadata['oldest_id'] = oldest_id
 
-                params['max_results'] = max_results_per_call
+        self.state.update(user_id, **metadata)
 
-                if days is None:
-                    try:
-                        params['since_id'] = user_metadata['newest_id']
-                    except KeyError:
-                        pass
+        USERS.inc(group=self.name, outcome='no_new_tweets' if collected_ids is None else 'new_tweets')
+        USER_SECONDS.observe(time.perf_counter() - started, group=self.name)
 
-                collected_ids = self.request_tweets(api, user_id, params, get_all_pages=True)
 
-                if collected_ids is not None:
-                    oldest_id, newest_id = collected_ids
+class UserUnavailable(Exception):
 
-                    user_metadata['newest_id'] = newest_id
+    # raised for users whose tweets Twitter does not show, reason is a key of priority.RECHECK_INTERVALS
 
-                    with open(meta_file_path, 'w') as metafile:
-                        yaml.dump(user_metadata, metafile)
+    def __init__(self, user_id, reason):
+        super().__init__(f'{user_id} is not available: {reason}')
+        self.user_id = user_id
+        self.reason = reason
 
 
 def retry(func):
@@ -245,6 +496,7 @@ def retry(func):
                 if tries < max_tries:
 
                     tries += 1
+                    RETRIES.inc(group=current_group(), error=type(e).__name__)
 
                     sleep_seconds = min(((tries * 2) ** 2), max(900 - total_sleep_seconds, 30))
                     total_sleep_seconds = total_sleep_seconds + sleep_seconds
@@ -0,0 +1,82 @@
+import twacapic.templates
+import yaml
+from loguru import logger
+
+# sections of group_config.yaml and the request parameters they are sent as
+SECTIONS = {'fields': 'tweet.fields', 'expansions': 'expansions', 'user.fields': 'user.fields'}
+
+
+class ConfigError(ValueError):
+    pass
+
+
+class GroupConfig:
+
+    # group_config.yaml, parsed and checked once. Every section switches names on (Yes) or off (No).
+    # Anything else is rejected before the first request: Twitter answers a malformed config with
+    # 400 Bad Request, which would fail every user of a run after all retries. Names missing from the
+    # template are only warned about, the API gets new ones that twacapic does not know yet.
+
+    def __init__(self, data, source='group config'):
+
+        if not isinstance(data, dict):
+            raise ConfigError(f'{source}: expected the sections {", ".join(SECTIONS)}, got {data!r}.')
+
+        unknown_sections = set(data) - set(SECTIONS)
+
+        if unknown_sections:
+            raise ConfigError(f'{source}: unknown sections {", ".join(sorted(unknown_sections))}. '
+                              f'Use {", ".join(SECTIONS)}.')
+
+        self.data = {}
+
+        for section in SECTIONS:
+
+            if section not in data:
+                raise ConfigError(f'{source}: the section {section} is missing.')
+
+            # an empty section is read as None
+            switches = data[section] or {}
+
+            if not isinstance(switches, dict):
+                raise ConfigError(f'{source}: {section} must map names to Yes or No, got {switches!r}.')
+
+            for name, switch in switches.items():
+                if not isinstance(name, str):
+                    raise ConfigError(f'{source}: {section} must map names to Yes or No, got the name {name!r}.')
+                if not isinstance(switch, bool):
+                    raise ConfigError(f'{source}: {section}.{name} must be Yes or No, got {switch!r}.')
+
+            known = twacapic.templates.group_config[section]
+            unknown = [name for name, switch in switches.items() if switch and name not in known]
+
+            if unknown:
+                logger.warning(f'{source}: {section} {", ".join(unknown)} are not in the template of twacapic. '
+                               f'Twitter rejects the requests if they are misspelled.')
+
+            self.data[section] = switches
+
+        self.fields = [name for name, switch in self.data['fields'].items() if switch]
+        self.expansions = [name for name, switch in self.data['expansions'].items() if switch]
+        self.user_fields = [name for name, switch in self.data['user.fields'].items() if switch]
+
+        # the same for every request of the group
+        self.params = {
+            'tweet.fields': ','.join(self.fields),
+            'expansions': ','.join(self.expansions),
+            'user.fields': ','.join(self.user_fields),
+        }
+
+    @classmethod
+    def load(cls, path):
+
+        try:
+            with open(path, 'r') as f:
+                data = yaml.safe_load(f)
+        except yaml.YAMLError as e:
+            raise ConfigError(f'{path} is not valid YAML: {e}')
+
+        return cls(data, path)
+
+    def __getitem__(self, section):
+        return self.data[section]
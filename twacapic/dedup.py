@@ -0,0 +1,266 @@
+import math
+import mmap
+import os
+import sqlite3
+import threading
+
+from loguru import logger
+from twacapic.pages import as_page
+
+INDEX_PATH = 'results/seen_tweets.sqlite'
+MASK = 2 ** 64 - 1
+
+
+def mix(value):
+
+    # splitmix64 finalizer, spreads the bits of tweet ids, whose low bits are mostly a sequence number
+    value = (value ^ (value >> 30)) * 0xBF58476D1CE4E5B9 & MASK
+    value = (value ^ (value >> 27)) * 0x94D049BB133111EB & MASK
+
+    return value ^ (value >> 31)
+
+
+class SeenIndex:
+
+    # The ids of all tweets saved under results/, across users and groups. The ids are kept in a SQLite
+    # table (the exact store), with a Bloom filter in front of it in a memory mapped file next to it, so
+    # that tweets that were not seen before are recognised without a query. The filter is shared by all
+    # processes on a machine. A bit that is lost in a crash or a race only lets a tweet be stored once more,
+    # a tweet is never taken as stored unless it is in the store. Ids are written to the store on flush,
+    # after the sink has made their pages durable, once batch_size of them are pending. Ids that are lost
+    # in a crash before that are stored once more as well.
+
+    def __init__(self, path=INDEX_PATH, capacity=10_000_000, error_rate=0.01, batch_size=10000):
+
+        self.path = path
+        self.batch_size = batch_size
+        self.bloom_path = f'{os.path.splitext(path)[0]}.bloom'
+        self.capacity = capacity
+        self.error_rate = error_rate
+
+        self._pending = {}
+        self._connection = None
+        self._bloom = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+
+        if self._connection is not None:
+            return
+
+        # a rollback journal like the work queue, the results folder can be shared by several machines
+        self._connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=DELETE')
+
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS tweets (id INTEGER PRIMARY KEY, group_name TEXT, user_id TEXT)'
+            )
+            self._connection.execute('CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value INTEGER)')
+            self._connection.execute(
+                'INSERT OR IGNORE INTO info (key, value) VALUES (?, ?), (?, ?)',
+                ('bloom_blocks', self._bloom_blocks(), 'bloom_hashes', self._bloom_hashes())
+            )
+
+        info = dict(self._connection.execute('SELECT key, value FROM info'))
+        self.blocks, self.hashes = info['bloom_blocks'], info['bloom_hashes']
+
+        size = self.blocks * 8
+        rebuild = not os.path.isfile(self.bloom_path) or os.path.getsize(self.bloom_path) != size
+
+        with open(self.bloom_path, 'a+b') as file:
+            if rebuild:
+                file.truncate(size)
+            self._bloom = mmap.mmap(file.fileno(), size)
+
+        # the bits of an id in its word are one of these masks, picked by its hash
+        self._masks = [self._mask(mix(number)) for number in range(4096)]
+
+        if rebuild:
+            self._rebuild_bloom()
+
+    def _bloom_blocks(self):
+        # bits for the error rate of a classic Bloom filter, blocking raises it a little
+        return math.ceil(-self.capacity * math.log(self.error_rate) / math.log(2) ** 2 / 64)
+
+    def _bloom_hashes(self):
+        return min(max(round(self._bloom_blocks() * 64 / self.capacity * math.log(2)), 1), 10)
+
+    def _rebuild_bloom(self):
+
+        count = 0
+
+        self._bloom[:] = bytes(len(self._bloom))
+
+        for (tweet_id,) in self._connection.execute('SELECT id FROM tweets'):
+            self._set(tweet_id)
+            count += 1
+
+        if count:
+            logger.info(f'Rebuilt the Bloom filter of {self.path} from {count} tweet ids.')
+
+    def _mask(self, bits):
+
+        mask = 0
+
+        for i in range(self.hashes):
+            mask |= 1 << (bits >> 6 * i & 63)
+
+        return mask
+
+    def _block(self, tweet_id):
+
+        # a blocked Bloom filter: all bits of an id are in one 64 bit word, which takes one read to check
+        value = mix(tweet_id)
+
+        return value % self.blocks * 8, self._masks[value >> 52]
+
+    def _set(self, tweet_id):
+        offset, mask = self._block(tweet_id)
+        word = int.from_bytes(self._bloom[offset:offset + 8], 'little')
+        self._bloom[offset:offset + 8] = (word | mask).to_bytes(8, 'little')
+
+    def _maybe_seen(self, tweet_id):
+        offset, mask = self._block(tweet_id)
+        return int.from_bytes(self._bloom[offset:offset + 8], 'little') & mask == mask
+
+    def stored(self, tweet_ids):
+
+        # the ids of tweet_ids that are already stored, or added but not flushed yet
+
+        with self._lock:
+
+            self._open()
+
+            stored = set()
+            query = []
+
+            for tweet_id in map(int, tweet_ids):
+                if tweet_id in self._pending:
+                    stored.add(tweet_id)
+                elif self._maybe_seen(tweet_id):
+                    query.append(tweet_id)
+
+            for start in range(0, len(query), 500):
+                chunk = query[start:start + 500]
+                stored.update(row[0] for row in self._connection.execute(
+                    f'SELECT id FROM tweets WHERE id IN ({",".join("?" * len(chunk))})', chunk
+                ))
+
+        return stored
+
+    def add(self, tweet_ids, group_name=None, user_id=None):
+
+        with self._lock:
+
+            self._open()
+
+            for tweet_id in map(int, tweet_ids):
+                if tweet_id not in self._pending:
+                    self._pending[tweet_id] = (group_name, user_id)
+                    self._set(tweet_id)
+
+    def flush(self, force=False):
+
+        with self._lock:
+
+            if not self._pending or len(self._pending) < self.batch_size and not force:
+                return
+
+            with self._connection:
+                self._connection.executemany(
+                    'INSERT OR IGNORE INTO tweets (id, group_name, user_id) VALUES (?, ?, ?)',
+                    ((tweet_id, group_name, user_id) for tweet_id, (group_name, user_id) in self._pending.items())
+                )
+
+            self._pending = {}
+
+    def count(self):
+
+        with self._lock:
+            self._open()
+            return self._connection.execute('SELECT COUNT(*) FROM tweets').fetchone()[0] + len(self._pending)
+
+    def close(self):
+
+        self.flush(force=True)
+
+        with self._lock:
+
+            if self._connection is not None:
+                self._bloom.close()
+                self._connection.close()
+                self._bloom = self._connection = None
+
+
+class DedupSink:
+
+    # Wraps a sink and leaves out tweets that any group already stored: included tweets, which the
+    # tweets of the page still reference by id, and with timeline, also tweets of the timeline of the
+    # user, e.g. of authors that are members of several groups. The ids of left out timeline tweets are
+    # kept in meta.stored_tweet_ids of the page. Pages without stored tweets are written as they came.
+
+    def __init__(self, sink, index, group_name, timeline=False):
+
+        self.sink = sink
+        self.index = index
+        self.group_name = group_name
+        self.timeline = timeline
+        self.skipped = 0
+
+    def write_page(self, user_id, page):
+
+        page = as_page(page)
+        data = page.data
+
+        tweets = data.get('data', [])
+        included = data.get('includes', {}).get('tweets', [])
+
+        stored = self.index.stored(tweet['id'] for tweet in tweets + included)
+
+        if stored:
+
+            new_included = [tweet for tweet in included if int(tweet['id']) not in stored]
+            new_tweets = [tweet for tweet in tweets if int(tweet['id']) not in stored] if self.timeline else tweets
+
+            if len(new_included) < len(included) or len(new_tweets) < len(tweets):
+
+                data = dict(data)
+
+                if len(new_included) < len(included):
+                    data['includes'] = dict(data['includes'], tweets=new_included)
+
+                if len(new_tweets) < len(tweets):
+                    data['data'] = new_tweets
+                    data['meta'] = dict(data['meta'], stored_tweet_ids=[
+                        tweet['id'] for tweet in tweets if int(tweet['id']) in stored
+                    ])
+
+                self.skipped += len(included) - len(new_included) + len(tweets) - len(new_tweets)
+                tweets, included = new_tweets, new_included
+                page = as_page(data)
+
+        self.sink.write_page(user_id, page)
+        self.index.add((tweet['id'] for tweet in tweets + included), self.group_name, user_id)
+
+    def flush(self):
+        end = self.flush_pages()
+        self.flush_index()
+        return end
+
+    # the ids of stored tweets are best saved after the state of their users, see UserGroup
+
+    def flush_pages(self):
+        return self.sink.flush()
+
+    def flush_index(self):
+        self.index.flush()
+
+    def close(self):
+
+        self.sink.close()
+        self.index.close()
+
+        if self.skipped:
+            logger.info(f'Left out {self.skipped} tweets of {self.group_name} that were already stored.')
+            self.skipped = 0
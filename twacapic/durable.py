@@ -0,0 +1,35 @@
+import os
+
+
+def fsync_file(path):
+
+    fd = os.open(path, os.O_RDONLY)
+
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_directory(path):
+
+    # makes new names in the folder (created or renamed files) durable, folders can not be opened on Windows
+
+    if os.name != 'nt':
+        fsync_file(path)
+
+
+def write_atomically(path, text, fsync=True):
+
+    # readers and crashes see either the old or the new content, never a truncated file
+
+    with open(f'{path}.tmp', 'w', encoding='utf8') as file:
+        file.write(text)
+        if fsync:
+            file.flush()
+            os.fsync(file.fileno())
+
+    os.replace(f'{path}.tmp', path)
+
+    if fsync:
+        fsync_directory(os.path.dirname(path) or '.')
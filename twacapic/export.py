@@ -0,0 +1,354 @@
+import json
+import os
+import sqlite3
+import time
+from datetime import datetime, timezone
+from glob import glob
+
+from loguru import logger
+from twacapic.config import GroupConfig
+from twacapic.sinks import open_segment, segment_paths
+from twacapic.utils import get_date_from_tweet_id
+
+# Columns of the exported tables. Nested objects without a fixed structure are kept as JSON strings.
+COLUMNS = {
+    'tweets': {
+        'id': 'int64', 'text': 'string', 'author_id': 'int64', 'conversation_id': 'int64',
+        'created_at': 'timestamp', 'lang': 'string', 'source': 'string', 'reply_settings': 'string',
+        'possibly_sensitive': 'bool', 'in_reply_to_user_id': 'int64',
+        'retweet_count': 'int64', 'reply_count': 'int64', 'like_count': 'int64', 'quote_count': 'int64',
+        'referenced_tweets': 'json', 'attachments': 'json', 'entities': 'json',
+        'context_annotations': 'json', 'geo': 'json', 'withheld': 'json',
+        'is_included': 'bool', 'collected_for_user_id': 'int64',
+    },
+    'users': {
+        'id': 'int64', 'username': 'string', 'name': 'string', 'created_at': 'timestamp',
+        'description': 'string', 'location': 'string', 'url': 'string', 'profile_image_url': 'string',
+        'verified': 'bool', 'protected': 'bool', 'pinned_tweet_id': 'int64',
+        'followers_count': 'int64', 'following_count': 'int64', 'tweet_count': 'int64', 'listed_count': 'int64',
+        'entities': 'json', 'withheld': 'json', 'collected_for_user_id': 'int64',
+    },
+    'media': {
+        'media_key': 'string', 'type': 'string', 'url': 'string', 'preview_image_url': 'string',
+        'duration_ms': 'int64', 'height': 'int64', 'width': 'int64', 'alt_text': 'string',
+        'view_count': 'int64', 'collected_for_user_id': 'int64',
+    },
+    'places': {
+        'id': 'string', 'full_name': 'string', 'name': 'string', 'country': 'string',
+        'country_code': 'string', 'place_type': 'string', 'geo': 'json', 'contained_within': 'json',
+        'collected_for_user_id': 'int64',
+    },
+}
+
+# expansions in group_config.yaml that put objects of a table into the includes of a page
+EXPANSIONS = {
+    'tweets': ['referenced_tweets.id'],
+    'users': ['author_id', 'in_reply_to_user_id', 'entities.mentions.username', 'referenced_tweets.id.author_id'],
+    'media': ['attachments.media_keys'],
+    'places': ['geo.place_id'],
+}
+
+
+def import_pyarrow():
+
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('Exporting to Parquet needs the pyarrow package: pip install pyarrow')
+
+    return pyarrow
+
+
+def get_schema(table):
+
+    pyarrow = import_pyarrow()
+
+    types = {
+        'int64': pyarrow.int64(),
+        'string': pyarrow.string(),
+        'json': pyarrow.string(),
+        'bool': pyarrow.bool_(),
+        'timestamp': pyarrow.timestamp('ms', tz='UTC'),
+    }
+
+    return pyarrow.schema([(column, types[column_type]) for column, column_type in COLUMNS[table].items()])
+
+
+def parse_timestamp(value):
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=timezone.utc)
+
+
+def flatten(table, item, collected_for_user_id, month, is_included=False):
+
+    item = dict(item)
+    item.update(item.pop('public_metrics', {}))
+
+    row = {}
+
+    for column, column_type in COLUMNS[table].items():
+
+        value = item.get(column)
+
+        if value is None:
+            row[column] = None
+        elif column_type == 'int64':
+            row[column] = int(value)
+        elif column_type == 'timestamp':
+            row[column] = parse_timestamp(value)
+        elif column_type == 'json':
+            row[column] = json.dumps(value, ensure_ascii=False)
+        else:
+            row[column] = value
+
+    row['collected_for_user_id'] = int(collected_for_user_id)
+    row['month'] = month
+
+    if table == 'tweets':
+        row['is_included'] = is_included
+
+    return row
+
+
+def get_month(tweet_id):
+    return get_date_from_tweet_id(tweet_id)['date'][:7]
+
+
+def flatten_page(page, user_id, tables):
+
+    rows = {table: [] for table in tables}
+
+    if 'meta' not in page or 'newest_id' not in page['meta']:
+        return rows
+
+    page_month = get_month(page['meta']['newest_id'])
+
+    for tweet in page.get('data', []):
+        rows['tweets'].append(flatten('tweets', tweet, user_id, get_month(tweet['id'])))
+
+    for table, table_rows in flatten_includes(page.get('includes', {}), user_id, tables, page_month).items():
+        rows[table].extend(table_rows)
+
+    return rows
+
+
+def flatten_includes(includes, user_id, tables, month):
+
+    rows = {
+        table: [flatten(table, item, user_id, month) for item in includes.get(table, [])]
+        for table in tables if table != 'tweets'
+    }
+
+    rows['tweets'] = [
+        flatten('tweets', tweet, user_id, get_month(tweet['id']), is_included=True)
+        for tweet in includes.get('tweets', [])
+    ]
+
+    return rows
+
+
+class ExportManifest:
+
+    # Remembers which page files and how many records of each segment have been exported already,
+    # and the Parquet parts that hold them. Parts are written as NAME.parquet.tmp and only get their
+    # names once the manifest has saved them together with their sources, so a crash in between does
+    # not leave rows behind that the next export writes again.
+
+    def __init__(self, path):
+
+        self._connection = sqlite3.connect(path)
+
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS exported (source TEXT PRIMARY KEY, records INTEGER)'
+            )
+            self._connection.execute('CREATE TABLE IF NOT EXISTS parts (path TEXT PRIMARY KEY)')
+
+    def exported_records(self, source):
+
+        row = self._connection.execute('SELECT records FROM exported WHERE source = ?', (source,)).fetchone()
+
+        return 0 if row is None else row[0]
+
+    def save(self, sources, parts=()):
+
+        with self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO exported (source, records) VALUES (?, ?)', sources.items()
+            )
+            self._connection.executemany('INSERT OR IGNORE INTO parts (path) VALUES (?)', ((part,) for part in parts))
+
+    def saved_part(self, path):
+        return self._connection.execute('SELECT 1 FROM parts WHERE path = ?', (path,)).fetchone() is not None
+
+    def close(self):
+        self._connection.close()
+
+
+class ParquetWriter:
+
+    # Collects rows of all tables and writes them as Parquet files partitioned by month,
+    # e.g. OUTPUT/tweets/month=2021-03/part-1617000000000000000-00001.parquet, whenever
+    # batch_size rows have been collected. write() leaves the parts as .tmp files and returns
+    # their paths relative to OUTPUT, see ExportManifest.
+
+    def __init__(self, output_path, tables, batch_size=50000):
+
+        self.output_path = output_path
+        self.tables = tables
+        self.batch_size = batch_size
+        self.run_id = time.time_ns()
+        self.part = 0
+        self.rows_written = 0
+
+        self._rows = {table: [] for table in tables}
+        self._row_count = 0
+
+    def add(self, rows):
+
+        for table, table_rows in rows.items():
+            self._rows[table].extend(table_rows)
+            self._row_count += len(table_rows)
+
+        return self._row_count >= self.batch_size
+
+    def write(self):
+
+        pyarrow = import_pyarrow()
+        parts = []
+
+        for table, rows in self._rows.items():
+
+            partitions = {}
+
+            for row in rows:
+                partitions.setdefault(row.pop('month'), []).append(row)
+
+            for month, partition_rows in partitions.items():
+
+                directory = f'{table}/month={month}'
+                os.makedirs(f'{self.output_path}/{directory}', exist_ok=True)
+
+                self.part += 1
+                path = f'{directory}/part-{self.run_id}-{self.part:05d}.parquet'
+
+                arrow_table = pyarrow.Table.from_pylist(partition_rows, schema=get_schema(table))
+                pyarrow.parquet.write_table(arrow_table, f'{self.output_path}/{path}.tmp')
+                parts.append(path)
+
+        self.rows_written += self._row_count
+        self._rows = {table: [] for table in self.tables}
+        self._row_count = 0
+
+        return parts
+
+
+def recover_parts(output_path, manifest):
+
+    # parts of an export that was killed: saved ones get their names, the others are removed
+
+    for temporary_path in glob(f'{output_path}/*/month=*/part-*.parquet.tmp'):
+
+        path = temporary_path[:-len('.tmp')]
+
+        if manifest.saved_part(os.path.relpath(path, output_path)):
+            os.replace(temporary_path, path)
+        else:
+            os.remove(temporary_path)
+
+
+def configured_tables(group_path):
+
+    expansions = GroupConfig.load(f'{group_path}/group_config.yaml')['expansions']
+
+    return ['tweets'] + [
+        table for table in ('users', 'media', 'places')
+        if any(expansions.get(expansion) for expansion in EXPANSIONS[table])
+    ]
+
+
+def iter_page_files(group_path):
+
+    for user_path in sorted(glob(f'{group_path}/*/')):
+
+        user_id = os.path.basename(os.path.dirname(user_path))
+
+        if not user_id.isdigit():
+            continue
+
+        for page_path in sorted(glob(f'{user_path}*.json')):
+            yield user_id, page_path
+
+
+def export_group(group_path, output_path, batch_size=50000, incremental=True):
+
+    import_pyarrow()
+
+    os.makedirs(output_path, exist_ok=True)
+
+    tables = configured_tables(group_path)
+    manifest = ExportManifest(f'{output_path}/manifest.sqlite')
+    writer = ParquetWriter(output_path, tables, batch_size)
+
+    recover_parts(output_path, manifest)
+
+    pending_sources = {}
+
+    def commit():
+
+        parts = writer.write()
+        manifest.save(pending_sources, parts)
+
+        for part in parts:
+            os.replace(f'{output_path}/{part}.tmp', f'{output_path}/{part}')
+
+        pending_sources.clear()
+
+    def add(rows, source, records):
+
+        pending_sources[source] = records
+
+        if writer.add(rows):
+            commit()
+
+    for user_id, page_path in iter_page_files(group_path):
+
+        if incremental and manifest.exported_records(page_path) > 0:
+            continue
+
+        with open(page_path, 'r', encoding='utf8') as f:
+            page = json.load(f)
+
+        add(flatten_page(page, user_id, tables), page_path, 1)
+
+    for segment_path in segment_paths(group_path):
+
+        skip = manifest.exported_records(segment_path) if incremental else 0
+        month = time.strftime('%Y-%m', time.gmtime())
+
+        with open_segment(segment_path) as segment:
+
+            for number, line in enumerate(segment, start=1):
+
+                if number <= skip or not line.strip():
+                    continue
+
+                record = json.loads(line)
+
+                if 'page' in record:
+                    rows = flatten_page(record['page'], record['user_id'], tables)
+                elif 'tweet' in record:
+                    month = get_month(record['tweet']['id'])
+                    rows = {'tweets': [flatten('tweets', record['tweet'], record['user_id'], month)]}
+                else:
+                    # includes of a page written with --sink_records tweets follow the tweets of that page
+                    rows = flatten_includes(record['includes'], record['user_id'], tables, month)
+
+                add(rows, segment_path, number)
+
+    commit()
+    manifest.close()
+
+    logger.info(f'Exported {writer.rows_written} rows of {group_path} to {output_path}.')
+
+    return writer.rows_written
@@ -0,0 +1,81 @@
+import os
+from glob import glob
+
+from loguru import logger
+from twacapic.pages import loads
+from twacapic.sinks import (check_segment, rewrite_segment, segment_end, segment_paths, truncate_segments,
+                            uncommitted_segments)
+
+
+def check_group(group_path, repair=False, full=False, state=None):
+
+    # Finds what a crash can leave behind in a group folder: .tmp files of pages that were never
+    # committed and a last segment that was not closed. With full, all segments are checked and all
+    # page files are read, older versions wrote them in place and could leave truncated ones.
+    # With repair, .tmp files are removed, damaged segments are rewritten with their complete
+    # records (the last one always, see rewrite_segment) and broken pages are renamed to .corrupt.
+    # With the state store of the group, records after the end of the segments saved with the state
+    # of the users are found too, they belong to pages the state does not know of. With repair, they
+    # are cut off before the segments are rewritten, and the end of the rewritten segments is saved.
+
+    report = {'temporary_files': [], 'damaged_segments': [], 'corrupt_pages': [], 'uncommitted_segments': []}
+
+    report['temporary_files'] = sorted(
+        glob(f'{group_path}/*/*.tmp') + glob(f'{group_path}/*.tmp') + glob(f'{group_path}/segments/tmp-*')
+    )
+
+    if repair:
+        for path in report['temporary_files']:
+            os.remove(path)
+
+    end = None if state is None else state.get_info('segment_end')
+
+    if end is not None:
+        if repair:
+            report['uncommitted_segments'] = truncate_segments(group_path, end)
+        else:
+            report['uncommitted_segments'] = uncommitted_segments(group_path, end)
+
+    segments = segment_paths(group_path)
+
+    for path in segments if full else segments[-1:]:
+
+        if repair and path == segments[-1]:
+            records, complete = rewrite_segment(path)
+        else:
+            records, complete = check_segment(path)
+
+            if repair and not complete:
+                rewrite_segment(path)
+
+        if not complete:
+            report['damaged_segments'].append(path)
+            logger.warning(f'Segment {path} ends in an incomplete chunk after {records} records.')
+
+    if repair and state is not None:
+        state.set_info('segment_end', segment_end(group_path))
+
+    for path in report['uncommitted_segments']:
+        logger.warning(f'Segment {path} {"was cut back to" if repair else "goes on after"} the end saved '
+                       f'with the state of the users.')
+
+    for path in sorted(glob(f'{group_path}/*/*.json')) if full else []:
+
+        with open(path, 'r', encoding='utf8') as file:
+            text = file.read()
+
+        try:
+            page = loads(text)
+            assert isinstance(page, dict) and 'meta' in page
+        except (ValueError, AssertionError):
+            report['corrupt_pages'].append(path)
+            logger.warning(f'Page {path} is not a complete page.')
+
+            if repair:
+                os.replace(path, f'{path}.corrupt')
+
+    if report['temporary_files']:
+        logger.info(f'{"Removed" if repair else "Found"} {len(report["temporary_files"])} temporary files '
+                    f'of uncommitted pages in {group_path}.')
+
+    return report
@@ -1,15 +1,27 @@
 import argparse
+import asyncio
+import itertools
 import os
 import socket
 import sys
 import time
+from contextlib import nullcontext
+from datetime import datetime, timezone
 
-import schedule
 from loguru import logger
 from twacapic import __version__
-from twacapic.auth import save_credentials
+from twacapic.auth import get_api, save_credentials
 from twacapic.collect import UserGroup
+from twacapic.config import ConfigError, GroupConfig
+from twacapic.export import export_group
+from twacapic.integrity import check_group
+from twacapic.metrics import serve
 from twacapic.notifications import send_mail
+from twacapic.pageindex import INDEX_NAME, PageIndex
+from twacapic.profiling import Profiler
+from twacapic.scheduler import Scheduler
+from twacapic.state import StateStore
+from twacapic.workqueue import LEASE_SECONDS, WorkQueue, coordinate, work
 
 logger.remove()
 
@@ -26,7 +38,7 @@ def run():
                         Results will be saved in folder `results/GROUPNAME/`.\
                         Can be used to poll for new tweets of a group.\
                         Default: "users"',
-                        default='users')
+                        default=['users'])
     parser.add_argument(
         '-c', '--group_config',
         help='Path to a custom group config file to define tweet data to be retrieved, \
@@ -45,8 +57,14 @@ def run():
         help='Path to logfile. Defaults to standard output.',
     )
     parser.add_argument(
-        '-s', '--schedule',
-        help='If given, repeat every SCHEDULE minutes.'
+        '-s', '--schedule', nargs='+', type=float,
+        help='If given, repeat every SCHEDULE minutes. Give one SCHEDULE for all groups, or one per group \
+        in the same order as in the --groupname argument. Every group runs on its own, a run is skipped \
+        if the previous run of the group is still going.'
+    )
+    parser.add_argument(
+        '--jitter', type=float, default=0,
+        help='Start scheduled runs up to JITTER minutes later at random, to spread out requests. Default: 0'
     )
     parser.add_argument(
         '-n', '--notify',
@@ -61,21 +79,195 @@ def run():
         '-d', '--days',
         help='Use only together with -a. Only get tweets posted in the last DAYS days.'
     )
+    parser.add_argument(
+        '-w', '--workers',
+        help='Number of users to collect concurrently within a group. Default: 1',
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        '--adaptive',
+        action='store_true',
+        help='Only poll users that are due according to how often they tweet, the most active ones first. \
+        Dormant users are polled less and less often, up to once a week, unreachable ones when their recheck is due.'
+    )
+    parser.add_argument(
+        '--sink',
+        help='Where to save collected pages: `files` writes one JSON file per page into the user folders, \
+        `jsonl` appends to compressed JSON lines segments in `results/GROUPNAME/segments/`. Default: files',
+        choices=['files', 'jsonl'],
+        default='files'
+    )
+    parser.add_argument(
+        '--compression',
+        help='Compression of jsonl segments (gzip, zstd). zstd needs the zstandard package. Default: gzip',
+        choices=['gzip', 'zstd'],
+        default='gzip'
+    )
+    parser.add_argument(
+        '--sink_records',
+        help='Write whole pages or single tweets as records of jsonl segments. Default: pages',
+        choices=['pages', 'tweets'],
+        default='pages'
+    )
+    parser.add_argument(
+        '--dedup',
+        help='Leave out tweets that are already stored by any group: `includes` only leaves out included tweets, \
+        e.g. retweeted or quoted ones, `all` also tweets of users that are members of several groups. \
+        The ids of stored tweets are kept in `results/seen_tweets.sqlite`. Default: keep all tweets',
+        choices=['includes', 'all']
+    )
+    parser.add_argument(
+        '--metrics_port', type=int,
+        help='If given, serve metrics (requests, pages, rate limits, retries, write times, …) for Prometheus \
+        at http://127.0.0.1:METRICS_PORT/metrics.'
+    )
+    parser.add_argument(
+        '--profile',
+        help='Profile every collection of a group: `sampling` writes folded stacks for flame graphs, \
+        `deterministic` a cProfile file. Both write the time spent on network, rate limit, JSON, state and \
+        file system to a JSON file.',
+        choices=['sampling', 'deterministic']
+    )
+    parser.add_argument(
+        '--profile_allocations',
+        action='store_true',
+        help='With --profile, also trace memory allocations and save the top allocation sites. Slows runs down.'
+    )
+    parser.add_argument(
+        '--profile_dir',
+        help='Folder for the files of --profile. Default: profiles',
+        default='profiles'
+    )
     parser.add_argument(
         '-v', '--version',
         action='store_true',
         help='Print version of twacapic.'
     )
 
+    subparsers = parser.add_subparsers(dest='command', metavar='{export,unreachable,check,index,coordinate,work}')
+
+    export_parser = subparsers.add_parser(
+        'export',
+        help='Export collected tweets of groups to Parquet files. Needs the pyarrow package.'
+    )
+    export_parser.add_argument(
+        '-g', '--groupname', nargs='+', required=True,
+        help='Name(s) of the group(s) to export.'
+    )
+    export_parser.add_argument(
+        '-o', '--output',
+        help='Folder to write the Parquet files to, one subfolder per group. Default: exports',
+        default='exports'
+    )
+    export_parser.add_argument(
+        '-b', '--batch_size', type=int,
+        help='Number of rows to keep in memory before writing Parquet files. Default: 50000',
+        default=50000
+    )
+    export_parser.add_argument(
+        '--full', action='store_true',
+        help='Export all collected pages, not only the ones added since the last export.'
+    )
+
+    unreachable_parser = subparsers.add_parser(
+        'unreachable',
+        help='List users of groups that are not polled because they were not found, forbidden or unauthorized.'
+    )
+    unreachable_parser.add_argument(
+        '-g', '--groupname', nargs='+', required=True,
+        help='Name(s) of the group(s) to report on.'
+    )
+    unreachable_parser.add_argument(
+        '--all', action='store_true',
+        help='Also list users that are due for a recheck.'
+    )
+
+    check_parser = subparsers.add_parser(
+        'check',
+        help='Check the files of groups for pages and segments left incomplete by a crash.'
+    )
+    check_parser.add_argument(
+        '-g', '--groupname', nargs='+', required=True,
+        help='Name(s) of the group(s) to check.'
+    )
+    check_parser.add_argument(
+        '--repair', action='store_true',
+        help='Remove uncommitted pages, rewrite damaged segments with their complete records \
+        and rename incomplete pages to NAME.json.corrupt.'
+    )
+
+    index_parser = subparsers.add_parser(
+        'index',
+        help='Build the page index of groups, which finds pages by user and time without reading all files.'
+    )
+    index_parser.add_argument(
+        '-g', '--groupname', nargs='+', required=True,
+        help='Name(s) of the group(s) to index.'
+    )
+
+    coordinate_parser = subparsers.add_parser(
+        'coordinate',
+        help='Queue the users of groups for workers on one or several machines, see `twacapic work`.'
+    )
+    coordinate_parser.add_argument(
+        '-g', '--groupname', nargs='+', required=True,
+        help='Name(s) of the group(s) to queue.'
+    )
+    coordinate_parser.add_argument(
+        '-u', '--userlist', nargs='*',
+        help='Path(s) to list(s) of user IDs to create or extend the group(s) with, as for a collection run.'
+    )
+    coordinate_parser.add_argument(
+        '-c', '--group_config',
+        help='Path to a custom group config file, as for a collection run.'
+    )
+    coordinate_parser.add_argument(
+        '-a', '--get_all_the_tweets', action='store_true',
+        help='Get all available tweets (max. 3200) for users added with --userlist.'
+    )
+    coordinate_parser.add_argument(
+        '--adaptive', action='store_true',
+        help='Only queue users that are due according to how often they tweet, the most active ones first.'
+    )
+    coordinate_parser.add_argument(
+        '-s', '--schedule', type=int,
+        help='If given, queue due users again every SCHEDULE minutes.'
+    )
+
+    work_parser = subparsers.add_parser(
+        'work',
+        help='Collect users of groups queued by `twacapic coordinate`. Several workers can run at the same time, \
+        also on several machines sharing the results folder.'
+    )
+    work_parser.add_argument(
+        '-g', '--groupname', nargs='+', required=True,
+        help='Name(s) of the group(s) to collect.'
+    )
+    work_parser.add_argument(
+        '-w', '--workers', type=int, default=1,
+        help='Number of users to collect concurrently. Default: 1'
+    )
+    work_parser.add_argument(
+        '-b', '--batch_size', type=int,
+        help='Number of users to lease from the queue at once. Default: 10 per worker'
+    )
+    work_parser.add_argument(
+        '--lease_seconds', type=int, default=LEASE_SECONDS,
+        help=f'Seconds after which users leased by a worker that stopped responding are handed out again. \
+        Default: {LEASE_SECONDS}'
+    )
+    work_parser.add_argument(
+        '--wait', type=int,
+        help='If given, keep checking the queues every WAIT seconds instead of stopping once they are empty.'
+    )
+
     args = parser.parse_args()
 
     if args.version:
         print(__version__)
         return 0
 
-    if args.userlist is not None:
-        assert len(args.userlist) == len(args.groupname), 'Not all userlist paths have been defined.'
-
     if args.log_file is None:
         logger.add(sys.stdout, level=args.log_level)
     else:
@@ -84,9 +276,43 @@ def run():
     logger.add('errors.log', level='ERROR')
     logger.add('warnings.log', level='WARNING')
 
+    if args.metrics_port is not None:
+        serve(args.metrics_port)
+
+    # a config with a typo would otherwise only fail at the first request of every user
+    if getattr(args, 'group_config', None) is not None:
+        try:
+            GroupConfig.load(args.group_config)
+        except ConfigError as e:
+            logger.error(e)
+            return 1
+
+    if args.command == 'export':
+        return export(args)
+
+    if args.command == 'unreachable':
+        return report_unreachable(args)
+
+    if args.command == 'check':
+        return check(args)
+
+    if args.command == 'index':
+        return index(args)
+
+    if args.command == 'coordinate':
+        return run_coordinator(args)
+
+    if args.command == 'work':
+        return run_worker(args)
+
+    if args.userlist is not None:
+        assert len(args.userlist) == len(args.groupname), 'Not all userlist paths have been defined.'
+
     if args.days is not None:
         args.days = int(args.days)
 
+    assert args.workers >= 1, 'Number of workers must be at least 1.'
+
     print("Hello friend …")
 
     if not os.path.isfile('twitter_keys.yaml'):
@@ -95,7 +321,12 @@ def run():
 
         save_credentials('twitter_keys.yaml', consumer_key, consumer_secret)
 
-    def one_run(userlist, groupname, config, get_all_the_tweets=False, days=None):
+    sink_options = get_sink_options(args)
+
+    # one API object for all groups and runs, it holds the bearer token and the connection pool
+    api = get_api('twitter_keys.yaml', pool_size=args.workers)
+
+    def one_run(userlist, groupname, config, get_all_the_tweets=False, days=None, workers=1):
 
         if userlist is None:
             userlist = [None] * len(groupname)
@@ -105,66 +336,278 @@ def run():
         for userlist, groupname in userlists_and_groupnames:
 
             user_group = UserGroup(path=userlist, name=groupname,
-                                   config=config, get_all_the_tweets=get_all_the_tweets)
+                                   config=config, get_all_the_tweets=get_all_the_tweets,
+                                   sink=args.sink, sink_options=sink_options, dedup=args.dedup)
 
             logger.info(f"Starting collection of {groupname}.")
 
-            user_group.collect(days=days)
+            profiler = nullcontext()
+
+            if args.profile:
+                profiler = Profiler(groupname, args.profile_dir, args.profile, allocations=args.profile_allocations)
+
+            with profiler:
+                summary = user_group.collect(days=days, workers=workers, api=api, adaptive=args.adaptive)
+                if args.profile:
+                    profiler.summary = summary
 
             logger.info(f"Finished collection of {groupname}.")
 
     if args.schedule is None:
-        one_run(args.userlist, args.groupname, args.group_config, args.get_all_the_tweets, args.days)
+        one_run(args.userlist, args.groupname, args.group_config, args.get_all_the_tweets, args.days,
+                args.workers)
     else:
 
+        assert len(args.schedule) in (1, len(args.groupname)), 'Give one schedule, or one per group.'
+
         if args.notify is not None:
             send_mail(args.notify, 'Hello friend …',
                       f'Notifications from {socket.gethostname()} work as expected.')
 
-        logger.info(f"Scheduling job for every {args.schedule} minutes")
-        schedule.every(int(args.schedule)).minutes.do(
-            one_run, None, args.groupname, args.group_config)
+        def notify(job, e):
+            send_mail(args.notify, f'Unexpected Error on {socket.gethostname()}', f'{job.name}: {e}')
 
-        previous = overwrite('Wake up, samurai, we have work to do …', 0)
+        scheduler = Scheduler(on_error=notify if args.notify is not None else None)
 
-        one_run(args.userlist, args.groupname, args.group_config, args.get_all_the_tweets, args.days)
+        userlists = args.userlist or [None] * len(args.groupname)
+        intervals = args.schedule * len(args.groupname) if len(args.schedule) == 1 else args.schedule
 
-        while True:
-            try:
+        def group_run(userlist, groupname):
+
+            runs = itertools.count()
+
+            def run_group():
+                # the user list, -a and -d only apply to the first run
+                if next(runs) == 0:
+                    one_run([userlist], [groupname], args.group_config, args.get_all_the_tweets, args.days,
+                            args.workers)
+                else:
+                    one_run(None, [groupname], args.group_config, workers=args.workers)
+
+            return run_group
+
+        for userlist, groupname, interval in zip(userlists, args.groupname, intervals):
+            logger.info(f"Scheduling collection of {groupname} for every {interval} minutes")
+            scheduler.every(interval * 60, group_run(userlist, groupname), name=groupname, jitter=args.jitter * 60)
+
+        async def report():
+
+            previous = overwrite('Wake up, samurai, we have work to do …', 0)
+            quotes = itertools.cycle([
+                'The concept of waiting bewilders me. There are always deadlines.',
+                'Every day we change the world. It’s slow. It’s methodical. It’s exhausting.',
+            ])
+
+            while True:
+                await asyncio.sleep(20)
+                previous = overwrite(f'{next(quotes)} {format_schedule(scheduler.status())}', previous)
+
+        try:
+            scheduler.run_forever(report())
+        except KeyboardInterrupt:
+            logger.info("KeyboardInterrupt received. Stopping collection.")
+
+    print("\nExciting time in the world right now … exciting time … ")
+
+
+def export(args):
+
+    missing = 0
+
+    for groupname in args.groupname:
+
+        if not os.path.isdir(f'results/{groupname}'):
+            logger.error(f'There is no group folder results/{groupname}.')
+            missing += 1
+            continue
+
+        logger.info(f"Starting export of {groupname}.")
+
+        rows = export_group(f'results/{groupname}', f'{args.output}/{groupname}',
+                            batch_size=args.batch_size, incremental=not args.full)
+
+        print(f'Exported {rows} rows of {groupname} to {args.output}/{groupname}.')
+
+    return 1 if missing else 0
+
+
+def report_unreachable(args):
+
+    print('group\tuser_id\treason\tunreachable_since\tchecks\tnext_check')
+
+    for groupname in args.groupname:
+
+        if not os.path.isfile(f'results/{groupname}/state.sqlite'):
+            logger.error(f'There is no collected group {groupname} in results/.')
+            continue
+
+        state = StateStore(f'results/{groupname}/state.sqlite')
+
+        for user_id, metadata in state.unreachable(None if args.all else time.time()).items():
+            print('\t'.join([
+                groupname, user_id, metadata['unreachable_reason'],
+                format_time(metadata['unreachable_since']), str(metadata['unreachable_checks']),
+                format_time(metadata['recheck_at'])
+            ]))
+
+        state.close()
+
+    return 0
+
+
+def check(args):
+
+    damaged = 0
+
+    for groupname in args.groupname:
+
+        if not os.path.isdir(f'results/{groupname}'):
+            logger.error(f'There is no group folder results/{groupname}.')
+            continue
+
+        # the state, if any, tells where the segments ended when the state of the users was last saved
+        state = None
+        if os.path.isfile(f'results/{groupname}/state.sqlite'):
+            state = StateStore(f'results/{groupname}/state.sqlite')
+
+        report = check_group(f'results/{groupname}', repair=args.repair, full=True, state=state)
+
+        if state is not None:
+            state.close()
+
+        for problem, paths in report.items():
+            print(f'{groupname}: {len(paths)} {problem.replace("_", " ")}')
+            for path in paths:
+                print(f'  {path}')
 
-                previous = overwrite(
-                    'The concept of waiting bewilders me. There are always deadlines.',
-                    previous
-                )
+        damaged += sum(len(paths) for paths in report.values())
 
-                time.sleep(20)
+        # repaired segments are rewritten, which moves their records
+        if args.repair and os.path.isfile(f'results/{groupname}/{INDEX_NAME}'):
+            page_index = PageIndex(f'results/{groupname}')
+            page_index.rebuild()
+            page_index.close()
 
-                previous = overwrite(
-                    'Every day we change the world. It’s slow. It’s methodical. It’s exhausting.',
-                    previous)
+    return 1 if damaged and not args.repair else 0
 
-                try:
 
-                    schedule.run_pending()
+def index(args):
 
-                except Exception as e:
+    for groupname in args.groupname:
 
-                    if args.notify is not None:
+        if not os.path.isdir(f'results/{groupname}'):
+            logger.error(f'There is no group folder results/{groupname}.')
+            continue
 
-                        logger.error(e)
+        started = time.time()
 
-                        send_mail(args.notify,
-                                  f'Unexpected Error on {socket.gethostname()}',
-                                  str(e)
-                                  )
-                    else:
-                        raise
+        page_index = PageIndex(f'results/{groupname}')
+        pages = page_index.rebuild()
+        page_index.close()
 
-            except KeyboardInterrupt:
-                logger.info("KeyboardInterrupt received. Stopping collection.")
+        print(f'Indexed {pages} pages of {groupname} in {time.time() - started:.1f} s.')
+
+    return 0
+
+
+def get_sink_options(args):
+    return {'compression': args.compression, 'records': args.sink_records} if args.sink == 'jsonl' else None
+
+
+def run_coordinator(args):
+
+    if args.userlist is not None:
+        assert len(args.userlist) == len(args.groupname), 'Not all userlist paths have been defined.'
+
+    assert args.sink != 'jsonl', 'Groups collected by workers can not use --sink jsonl, use --sink files.'
+
+    queues = {}
+
+    # user lists and -a only apply to the first round
+    for userlist, groupname in zip(args.userlist or [None] * len(args.groupname), args.groupname):
+        user_group = UserGroup(path=userlist, name=groupname, config=args.group_config,
+                               get_all_the_tweets=args.get_all_the_tweets, sink=args.sink,
+                               sink_options=get_sink_options(args), shared=True)
+        queues[groupname] = WorkQueue(f'{user_group.path}/queue.sqlite')
+        coordinate(user_group, queues[groupname], args.adaptive)
+
+    while args.schedule is not None:
+
+        try:
+            time.sleep(args.schedule * 60)
+        except KeyboardInterrupt:
+            logger.info("KeyboardInterrupt received. Stopping coordinator.")
+            break
+
+        for groupname, queue in queues.items():
+            coordinate(UserGroup(name=groupname, sink=args.sink, sink_options=get_sink_options(args), shared=True),
+                       queue, args.adaptive)
+
+    for groupname, queue in queues.items():
+        print(f'{groupname}: {queue.stats()}')
+        queue.close()
+
+    return 0
+
+
+def run_worker(args):
+
+    assert args.workers >= 1, 'Number of workers must be at least 1.'
+    assert args.sink != 'jsonl', 'Workers can not share jsonl segments, use --sink files.'
+
+    api = get_api('twitter_keys.yaml', pool_size=args.workers)
+    groups = []
+
+    for groupname in args.groupname:
+        if os.path.isfile(f'results/{groupname}/queue.sqlite'):
+            user_group = UserGroup(name=groupname, sink=args.sink, sink_options=get_sink_options(args), shared=True,
+                                   dedup=args.dedup)
+            queue = WorkQueue(f'results/{groupname}/queue.sqlite', lease_seconds=args.lease_seconds)
+            groups.append((user_group, queue))
+        else:
+            logger.error(f'There is no queue for {groupname}, start `twacapic coordinate -g {groupname}` first.')
+
+    try:
+        while True:
+
+            collected = 0
+
+            for user_group, queue in groups:
+                collected += work(user_group, queue, api, workers=args.workers, batch_size=args.batch_size)
+
+            print(f'Collected {collected} users.')
+
+            if args.wait is None:
                 break
 
-    print("\nExciting time in the world right now … exciting time … ")
+            if collected == 0:
+                time.sleep(args.wait)
+
+    except KeyboardInterrupt:
+        logger.info("KeyboardInterrupt received. Stopping worker.")
+
+    finally:
+        for user_group, queue in groups:
+            queue.close()
+
+    return 0
+
+
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def format_schedule(status):
+
+    jobs = []
+
+    for job in status:
+        if job['running']:
+            jobs.append(f"{job['name']}: running")
+        else:
+            jobs.append(f"{job['name']}: next run in {job['next_run_in'] / 60:.0f} min")
+
+    return ' | '.join(jobs)
 
 
 def overwrite(text, previous):
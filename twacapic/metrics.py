@@ -0,0 +1,369 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from loguru import logger
+
+# upper bounds in seconds, from a fast local request to a wait for the next rate limit window
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+
+
+class Metric:
+
+    # Values by label values, e.g. by group. Updates take a lock, which costs about a microsecond.
+
+    type = None
+
+    def __init__(self, name, description, labels=()):
+
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def values(self):
+        with self._lock:
+            return {key: self._copy(value) for key, value in self._values.items()}
+
+    def _copy(self, value):
+        return value
+
+    def _select(self, values, labels):
+        # the values of all label values that match labels, e.g. all error classes of one group
+        return [
+            value for key, value in values.items()
+            if all(key[self.labels.index(label)] == str(wanted) for label, wanted in labels.items())
+        ]
+
+    def samples(self, values):
+        for key, value in values.items():
+            yield self.name, list(zip(self.labels, key)), value
+
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def total(self, values, **labels):
+        return sum(self._select(values, labels))
+
+    def difference(self, before, after):
+        return {key: value - before.get(key, 0) for key, value in after.items()}
+
+
+class Gauge(Metric):
+
+    # set directly or, with set_function, read at every scrape from a function returning {label values: value}
+
+    type = 'gauge'
+
+    def __init__(self, name, description, labels=()):
+        super().__init__(name, description, labels)
+        self._function = None
+
+    def set(self, value, **labels):
+
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function):
+        self._function = function
+
+    def values(self):
+
+        values = super().values()
+
+        if self._function is not None:
+            values.update(self._function())
+
+        return values
+
+    def difference(self, before, after):
+        return after
+
+
+class Histogram(Metric):
+
+    type = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=SECONDS_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+
+            counts, total, count = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0, 0)
+            counts[index] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels):
+
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _copy(self, value):
+        counts, total, count = value
+        return list(counts), total, count
+
+    def difference(self, before, after):
+
+        difference = {}
+
+        for key, (counts, total, count) in after.items():
+            previous_counts, previous_total, previous_count = before.get(key) or ([0] * len(counts), 0, 0)
+            difference[key] = (
+                [value - previous for value, previous in zip(counts, previous_counts)],
+                total - previous_total, count - previous_count
+            )
+
+        return difference
+
+    def total(self, values, **labels):
+        return sum(total for counts, total, count in self._select(values, labels))
+
+    def count(self, values, **labels):
+        return sum(count for counts, total, count in self._select(values, labels))
+
+    def quantile(self, values, quantile, **labels):
+
+        # estimated from the buckets like Prometheus' histogram_quantile, None without observations
+
+        selected = self._select(values, labels)
+        counts = [sum(bucket) for bucket in zip(*(counts for counts, total, count in selected))]
+
+        if not counts or sum(counts) == 0:
+            return None
+
+        rank = quantile * sum(counts)
+        cumulative = 0
+
+        for index, count in enumerate(counts):
+
+            if count and cumulative + count >= rank:
+
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+
+                lower = self.buckets[index - 1] if index > 0 else 0
+
+                return lower + (self.buckets[index] - lower) * (rank - cumulative) / count
+
+            cumulative += count
+
+        return self.buckets[-1]
+
+    def samples(self, values):
+
+        for key, (counts, total, count) in values.items():
+
+            cumulative = 0
+
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket', list(zip(self.labels, key)) + [('le', str(bound))], cumulative
+
+            yield f'{self.name}_sum', list(zip(self.labels, key)), total
+            yield f'{self.name}_count', list(zip(self.labels, key)), count
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _add(self, metric):
+
+        with self._lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, description, labels=()):
+        return self._add(Counter(name, description, labels))
+
+    def gauge(self, name, description, labels=()):
+        return self._add(Gauge(name, description, labels))
+
+    def histogram(self, name, description, labels=(), buckets=SECONDS_BUCKETS):
+        return self._add(Histogram(name, description, labels, buckets))
+
+    def snapshot(self):
+        return {name: metric.values() for name, metric in list(self.metrics.items())}
+
+    def difference(self, before, after=None):
+
+        # what changed between two snapshots, gauges keep their latest values
+
+        after = self.snapshot() if after is None else after
+
+        return {name: metric.difference(before.get(name, {}), after.get(name, {}))
+                for name, metric in self.metrics.items()}
+
+    def render(self):
+
+        # the Prometheus text exposition format
+
+        lines = []
+
+        for name, metric in list(self.metrics.items()):
+
+            lines.append(f'# HELP {name} {metric.description}')
+            lines.append(f'# TYPE {name} {metric.type}')
+
+            for sample_name, labels, value in metric.samples(metric.values()):
+
+                label_text = ','.join(f'{label}="{escape(label_value)}"' for label, label_value in labels)
+
+                lines.append(f'{sample_name}{{{label_text}}} {value}' if label_text else f'{sample_name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+REGISTRY = Registry()
+
+# the group a thread collects, the label of metrics updated by code that does not know the group
+_local = threading.local()
+
+
+def current_group():
+    return getattr(_local, 'group', '')
+
+
+def set_group(group):
+    _local.group = group
+
+
+# the metrics of twacapic, updated where the work is done
+
+HTTP_REQUESTS = REGISTRY.histogram(
+    'twacapic_http_request_seconds', 'Duration of HTTP requests to the Twitter API', ['group', 'status'])
+RATE_LIMIT_WAITS = REGISTRY.histogram(
+    'twacapic_rate_limit_wait_seconds', 'Time requests were held back to stay within the rate limit', ['group'])
+RATE_LIMIT_REMAINING = REGISTRY.gauge(
+    'twacapic_rate_limit_remaining', 'Requests left in the current rate limit window', ['credential'])
+RATE_LIMIT_RESET = REGISTRY.gauge(
+    'twacapic_rate_limit_reset_seconds', 'Seconds until the current rate limit window resets', ['credential'])
+RETRIES = REGISTRY.counter('twacapic_retries_total', 'Retried requests by error class', ['group', 'error'])
+PAGE_REQUESTS = REGISTRY.histogram(
+    'twacapic_page_seconds', 'Time to get a page, including rate limit waits and retries', ['group'])
+PAGES = REGISTRY.counter('twacapic_pages_total', 'Pages received', ['group'])
+TWEETS = REGISTRY.counter('twacapic_tweets_total', 'Tweets received', ['group'])
+PAGE_BYTES = REGISTRY.counter('twacapic_page_bytes_total', 'Bytes of pages received', ['group'])
+USERS = REGISTRY.counter('twacapic_users_total', 'Users collected, by outcome', ['group', 'outcome'])
+USER_SECONDS = REGISTRY.histogram('twacapic_user_seconds', 'Time to collect all new tweets of a user', ['group'])
+PAGE_WRITES = REGISTRY.histogram('twacapic_page_write_seconds', 'Time to write a page to the sink', ['group'])
+PAGE_QUEUE = REGISTRY.gauge('twacapic_page_queue_depth', 'Pages waiting for the page writer')
+SINK_FLUSHES = REGISTRY.histogram('twacapic_sink_flush_seconds', 'Time to make written pages durable', ['group'])
+STATE_FLUSHES = REGISTRY.histogram('twacapic_state_flush_seconds', 'Time to save the state of users', ['group'])
+WORK_QUEUE = REGISTRY.gauge('twacapic_work_queue_users', 'Users in the work queue of a group', ['group', 'state'])
+
+
+def summarize(group, before, seconds):
+
+    # what happened to the group since the snapshot before, network, rate limit and disk times are
+    # summed over all threads of the group (see set_group)
+
+    changes = REGISTRY.difference(before)
+
+    return {
+        'group': group,
+        'seconds': seconds,
+        'users': USERS.total(changes[USERS.name], group=group),
+        'unreachable_users': USERS.total(changes[USERS.name], group=group, outcome='unreachable'),
+        'pages': PAGES.total(changes[PAGES.name], group=group),
+        'tweets': TWEETS.total(changes[TWEETS.name], group=group),
+        'bytes': PAGE_BYTES.total(changes[PAGE_BYTES.name], group=group),
+        'requests': HTTP_REQUESTS.count(changes[HTTP_REQUESTS.name], group=group),
+        'request_seconds': HTTP_REQUESTS.total(changes[HTTP_REQUESTS.name], group=group),
+        'request_p50': HTTP_REQUESTS.quantile(changes[HTTP_REQUESTS.name], 0.5, group=group),
+        'request_p95': HTTP_REQUESTS.quantile(changes[HTTP_REQUESTS.name], 0.95, group=group),
+        'rate_limit_wait_seconds': RATE_LIMIT_WAITS.total(changes[RATE_LIMIT_WAITS.name], group=group),
+        'retries': {
+            error: count for (retried_group, error), count in changes[RETRIES.name].items()
+            if retried_group == group and count
+        },
+        'write_seconds': PAGE_WRITES.total(changes[PAGE_WRITES.name], group=group),
+        'flush_seconds': SINK_FLUSHES.total(changes[SINK_FLUSHES.name], group=group),
+        'state_seconds': STATE_FLUSHES.total(changes[STATE_FLUSHES.name], group=group),
+    }
+
+
+def format_summary(summary):
+
+    def milliseconds(seconds):
+        return '-' if seconds is None else f'{seconds * 1000:.0f} ms'
+
+    retries = ', '.join(f'{count} {error}' for error, count in summary['retries'].items()) or 'none'
+
+    return (
+        f"{summary['group']}: {summary['users']} users ({summary['unreachable_users']} unreachable) "
+        f"in {summary['seconds']:.1f} s, {summary['pages']} pages, {summary['tweets']} tweets, "
+        f"{summary['bytes'] / 1024 ** 2:.1f} MB. "
+        f"Requests: {summary['requests']} in {summary['request_seconds']:.1f} s "
+        f"(p50 {milliseconds(summary['request_p50'])}, p95 {milliseconds(summary['request_p95'])}), "
+        f"rate limit waits {summary['rate_limit_wait_seconds']:.1f} s, retries: {retries}. "
+        f"Disk: writes {summary['write_seconds']:.1f} s, flushes {summary['flush_seconds']:.1f} s, "
+        f"state {summary['state_seconds']:.1f} s."
+    )
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = REGISTRY.render().encode('utf8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f'Metrics request: {format % args}')
+
+
+def serve(port, address='127.0.0.1'):
+
+    # serves the metrics for Prometheus at http://ADDRESS:PORT/metrics from a background thread
+
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+
+    threading.Thread(target=server.serve_forever, name='twacapic-metrics', daemon=True).start()
+
+    logger.info(f'Serving metrics at http://{address}:{server.server_port}/metrics')
+
+    return server
@@ -0,0 +1,254 @@
+import os
+import re
+import sqlite3
+import threading
+
+from loguru import logger
+from twacapic.pages import extract_meta, loads
+from twacapic.sinks import RECORD_START, segment_lines, segment_paths
+from twacapic.utils import TIMESTAMP_SHIFT, TWITTER_EPOCH
+
+INDEX_NAME = 'pages.sqlite'
+PAGE_NAME = re.compile(r'(\d+)_(\d+)\.json')
+
+
+def page_files(user_path):
+
+    # the pages of a user folder, newest first, as (newest_id, oldest_id, path) from their names
+
+    try:
+        with os.scandir(user_path) as entries:
+            names = [(PAGE_NAME.fullmatch(entry.name), entry.path) for entry in entries]
+    except FileNotFoundError:
+        return []
+
+    return sorted(((int(match.group(1)), int(match.group(2)), path) for match, path in names if match),
+                  reverse=True)
+
+
+def user_folders(group_path):
+
+    with os.scandir(group_path) as entries:
+        for entry in entries:
+            if entry.name.isdigit() and entry.is_dir():
+                yield entry.name
+
+
+def page_locations(path):
+
+    # (user_id, newest_id, oldest_id, member_offset, line_offset, records) of the pages in a segment,
+    # tweet records (--sink_records tweets) of a page are followed by its includes
+
+    tweets = None
+
+    def tweet_page():
+        return (tweets['user_id'], max(tweets['ids']), min(tweets['ids']), tweets['member_offset'],
+                tweets['line_offset'], tweets['records'])
+
+    for member_offset, line_offset, line in segment_lines(path):
+
+        line = line.decode('utf8').strip()
+        start = RECORD_START.match(line)
+
+        if not line:
+            continue
+
+        if start is not None and start.group(2) == 'page':
+            user_id, kind, meta = start.group(1), 'page', extract_meta(line[:-1])
+        else:
+            record = loads(line)
+            user_id, kind, meta = record['user_id'], next(key for key in record if key != 'user_id'), None
+
+        same_page = tweets is not None and (tweets['user_id'], tweets['member_offset']) == (user_id, member_offset)
+
+        if tweets is not None and not (same_page and kind != 'page'):
+            yield tweet_page()
+            tweets = None
+            same_page = False
+
+        if kind == 'page':
+
+            if meta is None:
+                meta = loads(line)['page'].get('meta') or {}
+
+            if 'newest_id' in meta:
+                yield user_id, int(meta['newest_id']), int(meta['oldest_id']), member_offset, line_offset, 1
+
+        elif kind == 'tweet':
+
+            if not same_page:
+                tweets = {'user_id': user_id, 'ids': [], 'member_offset': member_offset, 'line_offset': line_offset,
+                          'records': 0}
+
+            tweets['ids'].append(int(record['tweet']['id']))
+            tweets['records'] += 1
+
+        elif same_page:
+            tweets['records'] += 1
+            yield tweet_page()
+            tweets = None
+
+    if tweets is not None:
+        yield tweet_page()
+
+
+def id_timestamp(tweet_id):
+    return (tweet_id >> TIMESTAMP_SHIFT) + TWITTER_EPOCH
+
+
+class PageIndex:
+
+    # Where the pages of a group are: results/GROUP/pages.sqlite has a row per page with its user, the
+    # range of its tweet ids and of their creation times (ms since 1970), and its location relative to
+    # the group folder: a page file, or a segment with the offsets of the records of the page (see
+    # sinks.segment_lines). Sinks add pages when they flush, after the pages are durable. An index that
+    # does not list every page, because it was created for a group collected before, or because of a
+    # crash, is incomplete until it is rebuilt, and readers do not use it.
+
+    def __init__(self, group_path):
+
+        self.group_path = group_path
+        self.path = f'{group_path}/{INDEX_NAME}'
+
+        self._pending = []
+        self._lock = threading.Lock()
+
+        new = not os.path.isfile(self.path)
+
+        # a rollback journal like the work queue, the group can be collected by several machines
+        self._connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=DELETE')
+
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS pages (user_id INTEGER, newest_id INTEGER, oldest_id INTEGER, '
+                'newest_at INTEGER, oldest_at INTEGER, path TEXT, member_offset INTEGER, line_offset INTEGER, '
+                'records INTEGER, PRIMARY KEY (path, member_offset, line_offset))'
+            )
+            self._connection.execute('CREATE INDEX IF NOT EXISTS pages_by_user ON pages (user_id, newest_id)')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS pages_by_newest_id ON pages (newest_id)')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS pages_by_oldest_id ON pages (oldest_id)')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value INTEGER)')
+
+        if new:
+            has_pages = bool(segment_paths(group_path)) or next(user_folders(group_path), None) is not None
+            self.set_complete(not has_pages)
+
+            if has_pages:
+                logger.warning(f'The page index of {group_path} does not list the pages collected so far, '
+                               f'run `twacapic index -g {os.path.basename(group_path)}` to build it.')
+
+    @property
+    def complete(self):
+        row = self._connection.execute("SELECT value FROM info WHERE key = 'complete'").fetchone()
+        return row is not None and bool(row[0])
+
+    def set_complete(self, complete):
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO info (key, value) VALUES ('complete', ?)",
+                                     (int(complete),))
+
+    def add(self, user_id, meta, path, member_offset=0, line_offset=0, records=1):
+
+        newest_id, oldest_id = int(meta['newest_id']), int(meta['oldest_id'])
+
+        with self._lock:
+            self._pending.append((int(user_id), newest_id, oldest_id, id_timestamp(newest_id),
+                                  id_timestamp(oldest_id), path, member_offset, line_offset, records))
+
+    def flush(self):
+
+        with self._lock:
+
+            if not self._pending:
+                return
+
+            with self._connection:
+                self._insert(self._pending)
+
+            self._pending = []
+
+    def _insert(self, rows):
+        self._connection.executemany('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def rebuild(self):
+
+        # lists all pages of the group again, page files by their names, segments by reading them
+
+        with self._lock, self._connection:
+
+            self._pending = []
+            self._connection.execute('DELETE FROM pages')
+
+            for user_id in user_folders(self.group_path):
+                self._insert(
+                    (int(user_id), newest_id, oldest_id, id_timestamp(newest_id), id_timestamp(oldest_id),
+                     f'{user_id}/{os.path.basename(path)}', 0, 0, 1)
+                    for newest_id, oldest_id, path in page_files(f'{self.group_path}/{user_id}')
+                )
+
+            for path in segment_paths(self.group_path):
+                self._insert(
+                    (int(user_id), newest_id, oldest_id, id_timestamp(newest_id), id_timestamp(oldest_id),
+                     f'segments/{os.path.basename(path)}', member_offset, line_offset, records)
+                    for user_id, newest_id, oldest_id, member_offset, line_offset, records in page_locations(path)
+                )
+
+            self._connection.execute("INSERT OR REPLACE INTO info (key, value) VALUES ('complete', 1)")
+
+        return self.count()
+
+    def pages(self, user_ids=None, since_id=None, until_id=None):
+
+        # (user_id, path, member_offset, line_offset, records) of the pages of user_ids with tweets between
+        # since_id and until_id (both excluded): page files by user, newest first, then segment records in
+        # the order they were written
+
+        conditions, parameters = [], []
+
+        if since_id is not None:
+            conditions.append('newest_id > ?')
+            parameters.append(int(since_id))
+
+        if until_id is not None:
+            conditions.append('oldest_id < ?')
+            parameters.append(int(until_id))
+
+        user_ids = [None] if user_ids is None else sorted({int(user_id) for user_id in user_ids})
+
+        for files, order in ((True, 'user_id, newest_id DESC'), (False, 'path, member_offset, line_offset')):
+            for start in range(0, len(user_ids), 500):
+
+                chunk = [user_id for user_id in user_ids[start:start + 500] if user_id is not None]
+                where = conditions + [f"path {'' if files else 'NOT '}GLOB '*.json'"]
+
+                if chunk:
+                    where.append(f'user_id IN ({",".join("?" * len(chunk))})')
+
+                with self._lock:
+                    cursor = self._connection.execute(
+                        f'SELECT user_id, path, member_offset, line_offset, records FROM pages '
+                        f'WHERE {" AND ".join(where)} ORDER BY {order}', parameters + chunk
+                    )
+
+                while True:
+
+                    with self._lock:
+                        rows = cursor.fetchmany(1000)
+
+                    if not rows:
+                        break
+
+                    for user_id, path, member_offset, line_offset, records in rows:
+                        yield str(user_id), path, member_offset, line_offset, records
+
+    def count(self):
+        return self._connection.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+
+    def close(self):
+
+        self.flush()
+
+        with self._lock:
+            self._connection.close()
+
@@ -0,0 +1,94 @@
+import json
+import re
+
+from twacapic.profiling import span
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+META_KEY = re.compile(r'"meta"\s*:\s*')
+WHITESPACE = ' \t\r\n'
+
+_decoder = json.JSONDecoder()
+
+
+def loads(text):
+
+    with span('json'):
+
+        if orjson is not None:
+            return orjson.loads(text)
+
+        return json.loads(text)
+
+
+def extract_meta(text):
+
+    # Twitter puts meta last in the response object, so it can be decoded on its own
+    # without decoding all the tweets and includes in front of it.
+
+    start = text.rfind('"meta"')
+
+    if start == -1:
+        return None
+
+    key = META_KEY.match(text, start)
+
+    if key is None:
+        return None
+
+    try:
+        meta, end = _decoder.raw_decode(text, key.end())
+    except ValueError:
+        return None
+
+    # only the closing brace of the response may follow, otherwise this was not the top level meta
+    if not isinstance(meta, dict) or text[end:].strip(WHITESPACE) != '}':
+        return None
+
+    return meta
+
+
+class Page:
+
+    # One page of an API response. The raw JSON text is kept and written to the sinks as is,
+    # meta is extracted from the text and the whole page is only decoded when data is needed,
+    # e.g. for error responses or sinks that split pages into tweets.
+
+    __slots__ = ('text', 'meta', 'has_errors', '_data')
+
+    def __init__(self, text, data=None):
+
+        self.text = text
+        self._data = data
+        self.has_errors = '"errors"' in text
+        self.meta = None
+
+        if data is None and not self.has_errors:
+            with span('json'):
+                self.meta = extract_meta(text)
+
+        if self.meta is None:
+            self.meta = self.data.get('meta')
+
+    @classmethod
+    def from_dict(cls, data):
+
+        with span('json'):
+            text = json.dumps(data, ensure_ascii=False)
+
+        return cls(text, data)
+
+    @property
+    def data(self):
+
+        if self._data is None:
+            self._data = loads(self.text)
+
+        return self._data
+
+
+def as_page(page):
+    return page if isinstance(page, Page) else Page.from_dict(page)
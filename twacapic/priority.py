@@ -0,0 +1,85 @@
+from twacapic.utils import get_date_from_tweet_id
+
+# Adaptive polling: the tweet rate of every user is estimated from what the polls of the user
+# found, and the user is due again once about TARGET_NEW_TWEETS new tweets can be expected.
+# Dormant users find nothing, so their rate decays and they are polled less and less often, up
+# to MAX_INTERVAL. Unreachable users have no next poll, they are due when their recheck is.
+
+MIN_INTERVAL = 0
+MAX_INTERVAL = 7 * 24 * 3600
+TARGET_NEW_TWEETS = 1
+SMOOTHING = 0.5
+
+# Users that are not found (deleted), forbidden (suspended) or unauthorized (protected) are not
+# polled at all until their recheck is due. The interval starts at the one for the reason and
+# doubles with every check that finds the user still unreachable, up to MAX_RECHECK_INTERVAL.
+RECHECK_INTERVALS = {
+    'not_found': 24 * 3600,
+    'forbidden': 24 * 3600,
+    'unauthorized': 6 * 3600,
+}
+MAX_RECHECK_INTERVAL = 30 * 24 * 3600
+
+# state store columns of the negative cache, all set to None once a user is reachable again
+REACHABLE = {'unreachable_reason': None, 'unreachable_since': None, 'unreachable_checks': None, 'recheck_at': None}
+
+
+def tweet_time(tweet_id):
+    return get_date_from_tweet_id(tweet_id)['timestamp'] / 1000
+
+
+def estimate_tweet_rate(previous_rate, tweet_count, since, now):
+
+    observed_rate = tweet_count / max(now - since, 1)
+
+    if previous_rate is None:
+        return observed_rate
+
+    return SMOOTHING * observed_rate + (1 - SMOOTHING) * previous_rate
+
+
+def poll_interval(tweet_rate, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL):
+
+    if not tweet_rate:
+        return max_interval
+
+    return min(max(TARGET_NEW_TWEETS / tweet_rate, min_interval), max_interval)
+
+
+def schedule_next_poll(user_metadata, tweet_count, oldest_id, now):
+
+    # state store columns of a user that has just been polled and found tweet_count tweets
+
+    user_metadata = user_metadata or {}
+    previous_rate = user_metadata.get('tweet_rate')
+    since = user_metadata.get('last_polled_at')
+    newest_id = user_metadata.get('newest_id')
+
+    if since is None:
+        # first poll: the tweets found cover the time since the oldest of them
+        since = tweet_time(oldest_id) if tweet_count else now
+
+    if previous_rate is None and tweet_count == 0 and newest_id not in (None, '0'):
+        # nothing new, but the age of the latest known tweet still tells how active the user is
+        tweet_count, since = 1, tweet_time(newest_id)
+
+    tweet_rate = estimate_tweet_rate(previous_rate, tweet_count, since, now)
+
+    return {'last_polled_at': now, 'next_poll_at': now + poll_interval(tweet_rate), 'tweet_rate': tweet_rate}
+
+
+def recheck_interval(reason, checks):
+    return min(RECHECK_INTERVALS[reason] * 2 ** (checks - 1), MAX_RECHECK_INTERVAL)
+
+
+def mark_unreachable(user_metadata, reason, now):
+
+    user_metadata = user_metadata or {}
+    checks = user_metadata.get('unreachable_checks', 0) + 1
+
+    return {
+        'unreachable_reason': reason,
+        'unreachable_since': user_metadata.get('unreachable_since', now),
+        'unreachable_checks': checks,
+        'recheck_at': now + recheck_interval(reason, checks),
+    }
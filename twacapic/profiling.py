@@ -0,0 +1,329 @@
+import cProfile
+import json
+import os
+import platform
+import pstats
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import nullcontext
+
+from loguru import logger
+
+# what the time of a thread is spent on, see span()
+SPANS = ('network', 'rate_limit', 'json', 'state', 'filesystem')
+
+# the profiler of the run a thread works for, see attach()
+_local = threading.local()
+_no_span = nullcontext()
+
+# tracemalloc and, since Python 3.12, cProfile are process wide and shared by the profilers that run at once
+_lock = threading.Lock()
+_tracing_profilers = set()
+_started_tracemalloc = False
+_shared_profile = None
+_shared_profile_users = 0
+
+
+def current():
+    return getattr(_local, 'profiler', None)
+
+
+def attach(profiler):
+
+    # Makes the calling thread work for the run of profiler (None: for no run), e.g. the threads a
+    # profiled run starts. Spans of the thread count for that run, and sampling only looks at the
+    # threads of its run, so that groups collected at once get a profile each.
+
+    _local.profiler = profiler
+
+    if profiler is not None:
+        profiler._attach()
+
+
+def span(name):
+
+    # Marks code that does one kind of work, e.g. span('network'), while the run of the thread is
+    # profiled. The time is exclusive, a span inside another one is not counted for the outer span.
+    # Costs next to nothing when no profiler runs.
+
+    profiler = getattr(_local, 'profiler', None)
+
+    if profiler is None:
+        return _no_span
+
+    return _Span(profiler, name)
+
+
+class _Span:
+
+    __slots__ = ('profiler', 'name')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+
+        now = time.perf_counter()
+        stack = self.profiler._span_stacks.setdefault(threading.get_ident(), [])
+
+        if stack:
+            self.profiler._add_span_time(stack[-1][0], now - stack[-1][1])
+
+        stack.append([self.name, now])
+
+    def __exit__(self, *args):
+
+        now = time.perf_counter()
+        stack = self.profiler._span_stacks[threading.get_ident()]
+
+        name, start = stack.pop()
+        self.profiler._add_span_time(name, now - start)
+
+        if stack:
+            stack[-1][1] = now
+
+
+def frame_name(code):
+    return f'{os.path.splitext(os.path.basename(code.co_filename))[0]}:{code.co_name}'
+
+
+def thread_group(name):
+    # ThreadPoolExecutor-0_3 and ThreadPoolExecutor-0_4 end up in the same flame graph
+    return re.sub(r'[-_]\d+$', '', name)
+
+
+class Profiler:
+
+    # Profiles one collection run of a group with all its threads (see attach). Several runs can be
+    # profiled at once, e.g. groups on a schedule. sampling looks at the stacks of the threads of the
+    # run every interval seconds and writes them as folded stacks (NAME.folded, for flamegraph.pl,
+    # speedscope or inferno), with the span of the thread as the first frame below the thread.
+    # deterministic records every call with cProfile (NAME.pstats, e.g. for snakeviz), in the threads
+    # of the run, or, since Python 3.12, in all threads. Both write the time per span to NAME.json,
+    # with allocations also the top allocation sites of a tracemalloc snapshot (of the whole process)
+    # taken when the most memory was in use. Sampling makes a run up to a tenth slower, deterministic
+    # profiling about twice and tracing allocations about three times as slow.
+
+    def __init__(self, name, directory='profiles', mode='sampling', allocations=False, interval=0.005, top=25):
+
+        if mode not in ('sampling', 'deterministic'):
+            raise ValueError(f'Unknown profiling mode {mode}. Use sampling or deterministic.')
+
+        self.name = name
+        self.directory = directory
+        self.mode = mode
+        self.allocations = allocations
+        self.interval = interval
+        self.top = top
+
+        self.path = f'{directory}/{name}-{time.strftime("%Y%m%d-%H%M%S")}'
+        self.samples = Counter()
+        self.span_seconds = dict.fromkeys(SPANS, 0.0)
+        self.summary = None  # of the run, e.g. the one UserGroup.collect returns, is saved with the profile
+        self.report = None
+
+        self._span_stacks = {}
+        self._thread_idents = set()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._threads = []
+        self._profiles = []
+        self._snapshot = None
+        self._snapshot_size = 0
+
+    def _add_span_time(self, name, seconds):
+        with self._lock:
+            self.span_seconds[name] = self.span_seconds.get(name, 0.0) + seconds
+
+    def __enter__(self):
+
+        global _shared_profile, _shared_profile_users, _started_tracemalloc
+
+        if current() is not None:
+            raise RuntimeError('The run of this thread is profiled already.')
+
+        with _lock:
+
+            if self.allocations:
+                _tracing_profilers.add(self)
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    _started_tracemalloc = True
+
+            # since Python 3.12, only one cProfile can be enabled at a time, and it sees all threads
+            if self.mode == 'deterministic' and sys.version_info >= (3, 12):
+                if _shared_profile is None:
+                    _shared_profile = cProfile.Profile()
+                    _shared_profile.enable()
+                _shared_profile_users += 1
+
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+
+        if self.allocations:
+            self._threads.append(threading.Thread(target=self._watch_memory, name='twacapic-profiler', daemon=True))
+
+        if self.mode == 'sampling':
+            self._threads.append(threading.Thread(target=self._sample, name='twacapic-profiler', daemon=True))
+
+        attach(self)
+
+        for thread in self._threads:
+            thread.start()
+
+        return self
+
+    def _attach(self):
+
+        self._thread_idents.add(threading.get_ident())
+
+        # before Python 3.12, a cProfile only sees the thread that enabled it
+        if self.mode == 'deterministic' and sys.version_info < (3, 12):
+            profile = cProfile.Profile()
+            self._profiles.append(profile)
+            profile.enable()
+
+    def _take_snapshot(self):
+
+        # keeps the snapshot with the most memory in use, a new one is taken once it grew by a tenth
+        size = tracemalloc.get_traced_memory()[0]
+
+        if size > self._snapshot_size * 1.1:
+            self._snapshot = tracemalloc.take_snapshot()
+            self._snapshot_size = size
+
+    def _watch_memory(self):
+        while not self._stopped.wait(1):
+            self._take_snapshot()
+
+    def _sample(self):
+
+        names = {}
+        frame_names = {}
+
+        while not self._stopped.wait(self.interval):
+
+            frames = sys._current_frames()
+
+            if frames.keys() - names.keys():
+                names = {thread.ident: thread_group(thread.name) for thread in threading.enumerate()}
+
+            for ident, frame in frames.items():
+
+                if ident not in self._thread_idents:
+                    continue
+
+                stack = []
+
+                while frame is not None:
+                    code = frame.f_code
+                    if code not in frame_names:
+                        frame_names[code] = frame_name(code)
+                    stack.append(frame_names[code])
+                    frame = frame.f_back
+
+                span_stack = self._span_stacks.get(ident)
+                current_span = span_stack[-1][0] if span_stack else 'other'
+
+                self.samples[';'.join([names.get(ident, 'thread'), f'span:{current_span}'] + stack[::-1])] += 1
+
+    def __exit__(self, *args):
+
+        global _shared_profile, _shared_profile_users, _started_tracemalloc
+
+        seconds = time.perf_counter() - self._started
+
+        self._stopped.set()
+        attach(None)
+
+        for thread in self._threads:
+            thread.join()
+
+        stats = None
+
+        if self.mode == 'deterministic' and sys.version_info < (3, 12):
+            for profile in self._profiles:
+                profile.disable()
+            stats = pstats.Stats(*self._profiles)
+        elif self.mode == 'deterministic':
+            with _lock:
+                # taking the stats disables the profile, runs still going on need it again
+                stats = pstats.Stats(_shared_profile)
+                _shared_profile_users -= 1
+                if _shared_profile_users:
+                    _shared_profile.enable()
+                else:
+                    _shared_profile = None
+
+        allocations = []
+
+        if self.allocations:
+
+            self._take_snapshot()
+
+            snapshot = self._snapshot.filter_traces([
+                tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)
+            ])
+
+            allocations = [
+                {'site': str(statistic.traceback), 'size': statistic.size, 'count': statistic.count}
+                for statistic in snapshot.statistics('lineno')[:self.top]
+            ]
+
+        with _lock:
+            _tracing_profilers.discard(self)
+            if _started_tracemalloc and not _tracing_profilers:
+                tracemalloc.stop()
+                _started_tracemalloc = False
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        files = [f'{self.path}.json']
+
+        if self.mode == 'sampling':
+            with open(f'{self.path}.folded', 'w', encoding='utf8') as f:
+                for stack, count in sorted(self.samples.items()):
+                    f.write(f'{stack} {count}\n')
+            files.append(f'{self.path}.folded')
+        else:
+            stats.dump_stats(f'{self.path}.pstats')
+            files.append(f'{self.path}.pstats')
+
+        self.report = {
+            'name': self.name,
+            'mode': self.mode,
+            'started_at': self.started_at,
+            'seconds': seconds,
+            'span_seconds': self.span_seconds,
+            'samples': sum(self.samples.values()),
+            'allocations': allocations,
+            'snapshot_traced_bytes': self._snapshot_size if self.allocations else None,
+            'summary': self.summary,
+            'python': sys.version,
+            'platform': platform.platform(),
+            'argv': sys.argv,
+        }
+
+        with open(f'{self.path}.json', 'w', encoding='utf8') as f:
+            json.dump(self.report, f, indent=2)
+
+        logger.info(f'Profile of {self.name} written to {", ".join(files)}.')
+        logger.info(format_profile(self.report))
+
+
+def format_profile(report):
+
+    spans = ', '.join(f'{name} {seconds:.1f} s' for name, seconds in report['span_seconds'].items())
+    text = f"{report['name']}: {report['seconds']:.1f} s, time in spans (summed over threads): {spans}."
+
+    if report['allocations']:
+        text += ' Largest allocations: ' + ', '.join(
+            f"{allocation['site']} {allocation['size'] / 1024 ** 2:.1f} MB" for allocation in report['allocations'][:3]
+        ) + '.'
+
+    return text
@@ -0,0 +1,130 @@
+import threading
+import time
+
+from loguru import logger
+from twacapic.metrics import RATE_LIMIT_REMAINING, RATE_LIMIT_RESET, RATE_LIMIT_WAITS, current_group
+from twacapic.profiling import span
+
+
+class RateLimiter:
+
+    # Token bucket that is refilled at the pace the current rate limit window allows.
+    # Twitter tells us in every response how many requests are left (x-rate-limit-remaining)
+    # and when the window resets (x-rate-limit-reset, epoch seconds), so the refill rate is
+    # simply remaining requests / seconds until reset. A small burst is allowed so that short
+    # runs do not get slowed down needlessly.
+
+    def __init__(self, burst=10):
+
+        self.burst = burst
+        self.remaining = None
+        self.reset = None
+        self.tokens = burst
+        self.last_refill = time.time()
+        self._lock = threading.Lock()
+
+    def update(self, response):
+
+        try:
+            remaining = int(response.headers['x-rate-limit-remaining'])
+            reset = int(response.headers['x-rate-limit-reset'])
+        except (KeyError, TypeError, ValueError):
+            return
+
+        with self._lock:
+
+            self.remaining = remaining
+            self.reset = reset
+
+            if response.status_code == 429:
+                self.remaining = 0
+
+    def wait(self):
+
+        with self._lock:
+
+            now = time.time()
+
+            if self.reset is None or now >= self.reset:
+                # no information about the current window, nothing to pace against
+                self.remaining = None
+                self.reset = None
+                return 0
+
+            if self.remaining <= 0:
+                sleep_seconds = self.reset - now + 1
+                self.tokens = 0
+                self.last_refill = self.reset
+            else:
+                rate = self.remaining / (self.reset - now)
+                self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * rate)
+                self.last_refill = now
+
+                if self.tokens >= 1:
+                    sleep_seconds = 0
+                else:
+                    sleep_seconds = (1 - self.tokens) / rate
+
+                self.tokens -= 1
+                self.remaining -= 1
+
+        RATE_LIMIT_WAITS.observe(sleep_seconds, group=current_group())
+
+        if sleep_seconds > 0:
+            logger.debug(f'Rate limit: waiting {sleep_seconds:.2f} seconds before next request …')
+            with span('rate_limit'):
+                time.sleep(sleep_seconds)
+
+        return sleep_seconds
+
+    def headroom(self):
+
+        # requests left and seconds until the reset of the current window, None if unknown
+
+        with self._lock:
+
+            if self.reset is None:
+                return None, None
+
+            return self.remaining, max(self.reset - time.time(), 0)
+
+    def seconds_until_available(self):
+
+        # 0 unless the current window is used up
+
+        with self._lock:
+
+            now = time.time()
+
+            if self.reset is None or now >= self.reset or self.remaining > 0:
+                return 0
+
+            return self.reset - now
+
+
+rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def rate_limit_headroom():
+
+    with _rate_limiters_lock:
+        headroom = {(key,): rate_limiter.headroom() for key, rate_limiter in rate_limiters.items()}
+
+    return headroom
+
+
+RATE_LIMIT_REMAINING.set_function(lambda: {
+    key: remaining for key, (remaining, reset) in rate_limit_headroom().items() if remaining is not None
+})
+RATE_LIMIT_RESET.set_function(lambda: {
+    key: reset for key, (remaining, reset) in rate_limit_headroom().items() if reset is not None
+})
+
+
+def get_rate_limiter(key):
+
+    with _rate_limiters_lock:
+        if key not in rate_limiters:
+            rate_limiters[key] = RateLimiter()
+        return rate_limiters[key]
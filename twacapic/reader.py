@@ -0,0 +1,229 @@
+import json
+import os
+
+from loguru import logger
+from twacapic.pageindex import INDEX_NAME, PageIndex, page_files, user_folders
+from twacapic.pages import extract_meta, loads
+from twacapic.sinks import RECORD_START, RecordReader, open_segment, segment_paths
+from twacapic.utils import get_id_bounds
+
+
+def id_range(start=None, end=None, since_id=None, until_id=None):
+
+    # the tightest since_id and until_id (both excluded) of a time window and id bounds, -1 and None if open
+
+    bounds = get_id_bounds(start, end)
+    since_ids = [int(value) for value in (since_id, bounds.get('since_id')) if value is not None]
+    until_ids = [int(value) for value in (until_id, bounds.get('until_id')) if value is not None]
+
+    return max(since_ids, default=-1), min(until_ids, default=None)
+
+
+def in_range(tweet_id, since_id, until_id):
+    return since_id < tweet_id and (until_id is None or tweet_id < until_id)
+
+
+def overlaps(newest_id, oldest_id, since_id, until_id):
+    return newest_id > since_id and (until_id is None or oldest_id < until_id)
+
+
+def iter_pages(group_path, user_ids=None, since_id=None, until_id=None):
+
+    # The pages of a group, from page files and jsonl segments, that can hold tweets of user_ids with
+    # ids between since_id and until_id (both excluded, like the parameters of the API). With a complete
+    # page index, only those pages are read when filters are given. Otherwise, page files are picked by
+    # the id range in their names without opening them, lines of segments are skipped by their user and
+    # meta before the page is decoded. Only one page is kept in memory at a time.
+
+    since_id = -1 if since_id is None else int(since_id)
+    until_id = None if until_id is None else int(until_id)
+    user_ids = None if user_ids is None else sorted({str(user_id) for user_id in user_ids})
+
+    # reading everything is faster without the index
+    filtered = user_ids is not None or since_id >= 0 or until_id is not None
+
+    if filtered and os.path.isfile(f'{group_path}/{INDEX_NAME}'):
+
+        index = PageIndex(group_path)
+
+        try:
+            if index.complete:
+                yield from indexed_pages(group_path, index, user_ids, since_id, until_id)
+                return
+        finally:
+            index.close()
+
+    for user_id in user_folders(group_path) if user_ids is None else user_ids:
+        for newest_id, oldest_id, path in page_files(f'{group_path}/{user_id}'):
+
+            if not overlaps(newest_id, oldest_id, since_id, until_id):
+                continue
+
+            with open(path, 'r', encoding='utf8') as f:
+                yield user_id, loads(f.read())
+
+    for path in segment_paths(group_path):
+        yield from segment_pages(path, user_ids, since_id, until_id)
+
+
+def indexed_pages(group_path, index, user_ids, since_id, until_id):
+
+    records = RecordReader()
+
+    try:
+        for user_id, path, member_offset, line_offset, count in index.pages(user_ids, since_id, until_id):
+
+            if path.endswith('.json'):
+                with open(f'{group_path}/{path}', 'r', encoding='utf8') as f:
+                    yield user_id, loads(f.read())
+                continue
+
+            lines = [
+                loads(line) for line in records.read(f'{group_path}/{path}', member_offset, line_offset, count)
+            ]
+
+            if 'page' in lines[0]:
+                yield user_id, lines[0]['page']
+            else:
+                yield user_id, {
+                    'data': [line['tweet'] for line in lines if 'tweet' in line],
+                    'includes': next((line['includes'] for line in lines if 'includes' in line), {}),
+                }
+
+    finally:
+        records.close()
+
+
+def segment_pages(path, user_ids, since_id, until_id):
+
+    # Tweet records (--sink_records tweets) are put back together into pages of data and includes, the
+    # includes of a page follow its tweets. Tweets of pages without includes are kept until the next
+    # includes or the next user, so at most the tweets of one user are kept in memory.
+
+    user_ids = None if user_ids is None else set(user_ids)
+    pending_user, pending = None, []
+
+    with open_segment(path) as segment:
+        try:
+            for line in segment:
+
+                line = line.strip()
+                start = RECORD_START.match(line)
+
+                if not line or start and user_ids is not None and start.group(1) not in user_ids:
+                    continue
+
+                if start and start.group(2) == 'page':
+                    # the page is the last value of the record, its meta is followed by the closing braces
+                    meta = extract_meta(line[:-1])
+                    if meta and 'newest_id' in meta and not overlaps(
+                            int(meta['newest_id']), int(meta['oldest_id']), since_id, until_id):
+                        continue
+
+                record = loads(line)
+                user_id = record['user_id']
+
+                if user_ids is not None and user_id not in user_ids:
+                    continue
+
+                if pending and (user_id != pending_user or 'page' in record):
+                    yield pending_user, {'data': pending}
+                    pending = []
+
+                if 'tweet' in record:
+                    pending_user = user_id
+                    if in_range(int(record['tweet']['id']), since_id, until_id):
+                        pending.append(record['tweet'])
+                elif 'includes' in record:
+                    if pending:
+                        yield user_id, {'data': pending, 'includes': record['includes']}
+                    pending = []
+                else:
+                    yield user_id, record['page']
+
+        except (EOFError, json.JSONDecodeError):
+            # the last segment can end in an incomplete chunk, e.g. while it is written to
+            logger.warning(f'Segment {path} ends with an incomplete record, skipping the rest.')
+
+    if pending:
+        yield pending_user, {'data': pending}
+
+
+class Includes:
+
+    # the includes of a page by id, to look up the users, tweets, media, places and polls a tweet refers to
+
+    def __init__(self, includes):
+
+        self.users = {user['id']: user for user in includes.get('users', [])}
+        self.usernames = {user['username'].lower(): user for user in self.users.values() if 'username' in user}
+        self.tweets = {tweet['id']: tweet for tweet in includes.get('tweets', [])}
+        self.media = {media['media_key']: media for media in includes.get('media', [])}
+        self.places = {place['id']: place for place in includes.get('places', [])}
+        self.polls = {poll['id']: poll for poll in includes.get('polls', [])}
+
+    def resolve(self, tweet):
+
+        tweets = [
+            self.tweets[reference['id']] for reference in tweet.get('referenced_tweets', [])
+            if reference['id'] in self.tweets
+        ]
+
+        users = {}
+
+        for user_id in [tweet.get('author_id'), tweet.get('in_reply_to_user_id')] + [
+                referenced.get('author_id') for referenced in tweets]:
+            if user_id in self.users:
+                users[user_id] = self.users[user_id]
+
+        for mention in tweet.get('entities', {}).get('mentions', []):
+            user = self.usernames.get(mention.get('username', '').lower())
+            if user is not None:
+                users[user['id']] = user
+
+        attachments = tweet.get('attachments', {})
+        place_id = tweet.get('geo', {}).get('place_id')
+
+        includes = {
+            'users': list(users.values()),
+            'tweets': tweets,
+            'media': [self.media[key] for key in attachments.get('media_keys', []) if key in self.media],
+            'places': [self.places[place_id]] if place_id in self.places else [],
+            'polls': [self.polls[key] for key in attachments.get('poll_ids', []) if key in self.polls],
+        }
+
+        return {name: objects for name, objects in includes.items() if objects}
+
+
+def iter_tweets(group_path, user_ids=None, start=None, end=None, since_id=None, until_id=None, fields=None,
+                includes=True):
+
+    # The tweets collected for a group as records {'user_id': …, 'tweet': …, 'includes': …}, like those
+    # of a jsonl sink with --sink_records tweets, but includes holds only what the tweet refers to.
+    # start and end (datetimes, UTC if without tzinfo, or timestamps in ms) select tweets by their ids,
+    # end is excluded. fields: the fields of tweets to keep besides id. Tweets of the same user come
+    # newest first from page files; the order of users is that of the file system.
+
+    since_id, until_id = id_range(start, end, since_id, until_id)
+    fields = None if fields is None else set(fields) | {'id'}
+
+    for user_id, page in iter_pages(group_path, user_ids, since_id, until_id):
+
+        tweets = [tweet for tweet in page.get('data', []) if in_range(int(tweet['id']), since_id, until_id)]
+
+        if not tweets:
+            continue
+
+        lookup = Includes(page.get('includes', {})) if includes else None
+
+        for tweet in tweets:
+
+            record = {'user_id': user_id, 'tweet': tweet}
+
+            if lookup is not None:
+                record['includes'] = lookup.resolve(tweet)
+
+            if fields is not None:
+                record['tweet'] = {field: value for field, value in tweet.items() if field in fields}
+
+            yield record
@@ -0,0 +1,147 @@
+import asyncio
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+
+class Job:
+
+    # A function run every interval seconds, each run delayed by up to jitter seconds at random.
+    # Runs stay on the grid of the first run, so a late run does not shift all later ones.
+    # A run that is due while the previous one is still running is skipped.
+
+    def __init__(self, name, func, interval, jitter=0, start_at=None):
+
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+
+        self.scheduled_at = time.time() if start_at is None else start_at
+        self.next_run_at = self.scheduled_at  # including jitter
+
+        self.running = False
+        self.runs = 0
+        self.skipped = 0
+        self.lag = None  # seconds the latest run started after its time
+        self.started_at = None
+        self.duration = None
+        self.error = None
+
+    def advance(self, now):
+
+        # to the first point of the grid after now
+        self.scheduled_at += self.interval * ((now - self.scheduled_at) // self.interval + 1)
+        self.next_run_at = self.scheduled_at + random.uniform(0, self.jitter)
+
+    def status(self, now=None):
+
+        now = time.time() if now is None else now
+
+        return {
+            'name': self.name,
+            'running': self.running,
+            'next_run_at': self.next_run_at,
+            'next_run_in': max(self.next_run_at - now, 0),
+            'lag': self.lag,
+            'runs': self.runs,
+            'skipped': self.skipped,
+            'duration': self.duration,
+            'error': self.error,
+        }
+
+
+class Scheduler:
+
+    # Runs every job on its own schedule in a thread of its own, so a slow job neither delays
+    # the others nor piles up runs of itself. Without on_error, the first failing run stops the
+    # scheduler with its exception, otherwise on_error is called with the job and the exception.
+
+    def __init__(self, on_error=None):
+        self.jobs = []
+        self.on_error = on_error
+        self._failed = None
+
+    def every(self, interval, func, name=None, jitter=0, start_at=None):
+
+        job = Job(name or func.__name__, func, interval, jitter, start_at)
+        self.jobs.append(job)
+
+        return job
+
+    def status(self):
+        now = time.time()
+        return [job.status(now) for job in self.jobs]
+
+    def run_forever(self, *coroutines):
+        asyncio.run(self.run(*coroutines))
+
+    async def run(self, *coroutines):
+
+        # coroutines run alongside the jobs, e.g. to report the status
+
+        self._failed = asyncio.get_running_loop().create_future()
+
+        executor = ThreadPoolExecutor(max_workers=max(len(self.jobs), 1), thread_name_prefix='twacapic-job')
+        tasks = [asyncio.create_task(self._schedule(job, executor)) for job in self.jobs]
+        tasks += [asyncio.create_task(coroutine) for coroutine in coroutines]
+
+        try:
+            await self._failed
+        finally:
+            for task in tasks:
+                task.cancel()
+            if any(job.running for job in self.jobs):
+                logger.info('Waiting for running jobs to finish …')
+            executor.shutdown(wait=False)
+
+    async def _schedule(self, job, executor):
+
+        runs = set()
+
+        while True:
+
+            await asyncio.sleep(max(job.next_run_at - time.time(), 0))
+
+            now = time.time()
+
+            if job.running:
+                job.skipped += 1
+                logger.warning(f'Skipping run of {job.name}, the previous one is still running.')
+            else:
+                job.running = True
+                job.lag = now - job.next_run_at
+                run = asyncio.create_task(self._execute(job, executor))
+                runs.add(run)
+                run.add_done_callback(runs.discard)
+
+            job.advance(now)
+
+    async def _execute(self, job, executor):
+
+        loop = asyncio.get_running_loop()
+
+        job.started_at = time.time()
+
+        logger.info(f'Starting {job.name}, {job.lag:.1f} s late.')
+
+        try:
+            await loop.run_in_executor(executor, job.func)
+            job.error = None
+        except Exception as e:
+            job.error = repr(e)
+            logger.error(f'{job.name} failed: {e!r}')
+            if self.on_error is None:
+                if not self._failed.done():
+                    self._failed.set_exception(e)
+            else:
+                await loop.run_in_executor(None, self.on_error, job, e)
+        finally:
+            job.running = False
+            job.runs += 1
+            job.duration = time.time() - job.started_at
+
+        logger.info(f'Finished {job.name} after {job.duration:.1f} s, '
+                    f'next run in {max(job.next_run_at - time.time(), 0):.0f} s.')
@@ -0,0 +1,629 @@
+import gzip
+import io
+import itertools
+import json
+import os
+import queue
+import re
+import threading
+import zlib
+from glob import glob
+
+from loguru import logger
+from twacapic.durable import fsync_directory, fsync_file
+from twacapic.metrics import PAGE_QUEUE, PAGE_WRITES, current_group, set_group
+from twacapic.pages import as_page
+from twacapic.profiling import attach, current, span
+
+COMPRESSIONS = {'gzip': 'gz', 'zstd': 'zst'}
+
+# the start of a line of a segment, see page_record, up to the page, tweet or includes
+RECORD_START = re.compile(r'\{"user_id": "(\d+)", "(page|tweet|includes)": ')
+
+
+class FileSink:
+
+    # Default layout: one JSON file per API page, results/GROUP/USER_ID/NEWEST_ID_OLDEST_ID.json
+    # Pages are written to NAME.json.tmp and renamed on flush, i.e. before the state of their users
+    # is saved, after one fsync per page and one per folder for all pages since the last flush.
+    # A crash leaves complete pages and .tmp files of pages that were never committed.
+    # With an index (see pageindex.py), pages are added to it once they are renamed.
+
+    def __init__(self, group_path, fsync=True, index=None):
+        self.group_path = group_path
+        self.fsync = fsync
+        self.index = index
+        self._written = []
+        self._created_folders = False
+        self._lock = threading.Lock()
+
+    def write_page(self, user_id, page):
+
+        page = as_page(page)
+
+        newest_id = page.meta['newest_id']
+        oldest_id = page.meta['oldest_id']
+
+        path = f'{self.group_path}/{user_id}/{newest_id}_{oldest_id}.json'
+
+        try:
+            file = open(f'{path}.tmp', 'w', encoding='utf8')
+        except FileNotFoundError:
+            # the folder of a user is created with the first page of the user
+            os.makedirs(f'{self.group_path}/{user_id}', exist_ok=True)
+            self._created_folders = True
+            file = open(f'{path}.tmp', 'w', encoding='utf8')
+
+        with file:
+            file.write(page.text)
+
+        with self._lock:
+            self._written.append(path)
+            if self.index is not None:
+                self.index.add(user_id, page.meta, f'{user_id}/{newest_id}_{oldest_id}.json')
+
+    def flush(self):
+
+        with self._lock:
+
+            if self.fsync:
+                for path in self._written:
+                    fsync_file(f'{path}.tmp')
+
+            for path in self._written:
+                os.replace(f'{path}.tmp', path)
+
+            if self.fsync:
+                for folder in {os.path.dirname(path) for path in self._written}:
+                    fsync_directory(folder)
+                if self._created_folders:
+                    fsync_directory(self.group_path)
+
+            self._written = []
+            self._created_folders = False
+
+            if self.index is not None:
+                self.index.flush()
+
+    def close(self):
+        self.flush()
+
+
+class JsonlSink:
+
+    # Appends pages (or single tweets) as JSON lines to compressed segment files in
+    # results/GROUP/segments/. Lines are buffered in memory and written in chunks of
+    # about buffer_size bytes; a new segment is started once a segment has grown to
+    # about segment_size bytes of uncompressed JSON. flush() writes the buffer and, with
+    # fsync, makes it durable before the state of the users is saved, and returns where the
+    # segments end then (see segment_end). With an index (see pageindex.py), the pages are
+    # added to it with the offsets of their records.
+
+    def __init__(self, group_path, compression='gzip', records='pages',
+                 segment_size=256 * 1024 ** 2, buffer_size=1024 ** 2, fsync=True, index=None):
+
+        if compression not in COMPRESSIONS:
+            raise ValueError(f'Unknown compression {compression}. Use one of {", ".join(COMPRESSIONS)}.')
+
+        if records not in ('pages', 'tweets'):
+            raise ValueError(f'Unknown record type {records}. Use pages or tweets.')
+
+        self.directory = f'{group_path}/segments'
+        self.compression = compression
+        self.records = records
+        self.segment_size = segment_size
+        self.buffer_size = buffer_size
+        self.fsync = fsync
+        self.index = index
+
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._buffered_pages = []
+        self._file = None
+        self._segment_path = None
+        self._segment_bytes = 0
+        self._member_offset = 0
+        self._member_bytes = 0
+        self._lock = threading.Lock()
+
+    def write_page(self, user_id, page):
+
+        page = as_page(page)
+
+        if self.records == 'pages':
+            lines = [page_record(user_id, page)]
+        else:
+            tweets = page.data.get('data', [])
+            with span('json'):
+                lines = [json.dumps({'user_id': user_id, 'tweet': tweet}, ensure_ascii=False) for tweet in tweets]
+                if 'includes' in page.data:
+                    includes = {'user_id': user_id, 'includes': page.data['includes']}
+                    lines.append(json.dumps(includes, ensure_ascii=False))
+
+        with self._lock:
+
+            if self.index is not None and 'newest_id' in (page.meta or {}):
+                self._buffered_pages.append((len(self._buffer), len(lines), user_id, page.meta))
+
+            for line in lines:
+                self._buffer.append(line)
+                self._buffered_bytes += len(line) + 1
+
+            if self._buffered_bytes >= self.buffer_size:
+                self._write_buffer()
+
+    def flush(self):
+
+        with self._lock:
+
+            self._write_buffer()
+
+            if self._file is not None:
+                # ends the gzip member or zstd frame, so that everything up to here can be read back
+                # even if the process dies while writing the next one
+                self._file.close()
+                self._file = None
+
+                if self.fsync:
+                    fsync_file(self._segment_path)
+
+            if self.index is not None:
+                self.index.flush()
+
+            if self._segment_path is not None:
+                return f'{os.path.basename(self._segment_path)}:{os.path.getsize(self._segment_path)}'
+
+    def close(self):
+        self.flush()
+
+    def _write_buffer(self):
+
+        if not self._buffer:
+            return
+
+        if self._file is None or self._segment_bytes >= self.segment_size:
+            self._open_segment()
+
+        chunk = '\n'.join(self._buffer) + '\n'
+        self._file.write(chunk)
+        self._segment_bytes += self._buffered_bytes
+
+        if self.index is not None:
+            self._index_buffer()
+
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._buffered_pages = []
+
+    def _index_buffer(self):
+
+        # the offsets of the lines in the decompressed gzip member or zstd frame, in bytes of UTF-8
+        offsets = list(itertools.accumulate(
+            (len(line) if line.isascii() else len(line.encode('utf8')) for line in self._buffer),
+            lambda offset, length: offset + length + 1, initial=self._member_bytes
+        ))
+
+        path = f'segments/{os.path.basename(self._segment_path)}'
+
+        for position, records, user_id, meta in self._buffered_pages:
+            self.index.add(user_id, meta, path, self._member_offset, offsets[position], records)
+
+        self._member_bytes = offsets[-1]
+
+    def _open_segment(self):
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        full = self._segment_bytes >= self.segment_size
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+        if full:
+            logger.debug(f'Segment {self._segment_path} is full.')
+
+        # continue the segment of the last flush, or the latest segment of a previous run if there is
+        # room left, concatenated gzip members and zstd frames are read back as one stream
+        if self._segment_path is None or full:
+
+            extension = COMPRESSIONS[self.compression]
+            segments = sorted(glob(f'{self.directory}/segment-*.jsonl.{extension}'))
+
+            # segment_size counts uncompressed JSON, so the latest segment is decompressed to measure it
+            size = None
+
+            if self._segment_path is None and segments:
+                size = uncompressed_size(segments[-1], self.segment_size)
+
+            if size is not None and size < self.segment_size:
+                self._segment_path = segments[-1]
+                self._segment_bytes = size
+            else:
+                index = segment_index(segments[-1]) + 1 if segments else 0
+                self._segment_path = f'{self.directory}/segment-{index:06d}.jsonl.{extension}'
+                self._segment_bytes = 0
+
+        new_segment = not os.path.exists(self._segment_path)
+
+        # appending starts a new gzip member or zstd frame at the end of the file
+        self._member_offset = 0 if new_segment else os.path.getsize(self._segment_path)
+        self._member_bytes = 0
+
+        self._file = open_segment(self._segment_path, 'at')
+
+        if new_segment and self.fsync:
+            fsync_directory(self.directory)
+
+
+class PageBatch:
+
+    # Pages of one request_tweets call. wait() returns once all of them are saved
+    # and raises the first error that occurred while saving them. The checkpoint of a page
+    # is called once the page and all pages before it are flushed to the sink.
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.error = None
+        self._saved = threading.Event()
+
+    def write(self, user_id, page, checkpoint=None):
+        self.writer.put((self, user_id, page, checkpoint))
+
+    def wait(self):
+
+        self.writer.put((self, None, None, None))
+        self._saved.wait()
+
+        if self.error is not None:
+            raise self.error
+
+
+class PageWriter:
+
+    # Saves pages to a sink on a separate thread, so that the next page can already be
+    # requested while the previous one is still being serialized and written. At most
+    # max_queued_pages pages wait in memory, further writes block until there is room.
+    # Without a running thread, pages are saved right away in the calling thread.
+
+    def __init__(self, sink, max_queued_pages=32):
+
+        self.sink = sink
+        self._queue = queue.Queue(maxsize=max_queued_pages)
+        self._thread = None
+
+    def batch(self):
+        return PageBatch(self)
+
+    def start(self):
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=(current(), current_group()),
+                                            name='twacapic-page-writer', daemon=True)
+            self._thread.start()
+
+    def close(self):
+
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def put(self, item):
+
+        if self._thread is None:
+            self._save(*item)
+        else:
+            self._queue.put(item)
+            PAGE_QUEUE.set(self._queue.qsize())
+
+    def _run(self, profiler, group):
+
+        attach(profiler)
+        set_group(group)
+
+        while True:
+
+            item = self._queue.get()
+
+            if item is None:
+                break
+
+            self._save(*item)
+
+    def _save(self, batch, user_id, page, checkpoint):
+
+        if page is None:
+            batch._saved.set()
+            return
+
+        if batch.error is not None:
+            return
+
+        try:
+            with PAGE_WRITES.time(group=current_group()), span('filesystem'):
+                self.sink.write_page(user_id, page)
+            if checkpoint is not None:
+                # the state store flushes the sink before it saves the checkpoint
+                checkpoint()
+        except Exception as e:
+            batch.error = e
+
+
+def page_record(user_id, page):
+
+    text = page.text.strip()
+
+    # the raw page can be embedded as is unless it is pretty printed over several lines
+    if '\n' in text or '\r' in text:
+        text = json.dumps(page.data, ensure_ascii=False)
+
+    return f'{{"user_id": {json.dumps(user_id)}, "page": {text}}}'
+
+
+def segment_index(path):
+    return int(re.search(r'segment-(\d+)\.jsonl', os.path.basename(path)).group(1))
+
+
+def segment_end(group_path):
+
+    # where the segments of a group end, as 'NAME:SIZE' of the last one, '' without segments
+
+    segments = segment_paths(group_path)
+
+    if not segments:
+        return ''
+
+    return f'{os.path.basename(segments[-1])}:{os.path.getsize(segments[-1])}'
+
+
+def uncommitted_segments(group_path, end):
+
+    # the segments that go on after end (see segment_end), e.g. where they ended when the state of the
+    # users was last saved: the one that was cut at end and has grown since, and all later ones
+
+    name, size = end.rsplit(':', 1) if end else (None, 0)
+
+    return [
+        path for path in segment_paths(group_path)
+        if name is None or segment_index(path) > segment_index(name)
+        or os.path.basename(path) == name and os.path.getsize(path) > int(size)
+    ]
+
+
+def truncate_segments(group_path, end):
+
+    # Cuts the segments of a group back to end. Records written after it belong to pages the state
+    # does not know of, which are collected again. Later segments are removed. Returns the segments
+    # that were cut or removed.
+
+    name, size = end.rsplit(':', 1) if end else (None, 0)
+    paths = uncommitted_segments(group_path, end)
+
+    for path in paths:
+
+        if os.path.basename(path) == name:
+            with open(path, 'r+b') as file:
+                file.truncate(int(size))
+                os.fsync(file.fileno())
+        else:
+            os.remove(path)
+
+    if paths:
+        fsync_directory(f'{group_path}/segments')
+
+    return paths
+
+
+def import_zstandard():
+
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('zstd compressed segments need the zstandard package: pip install zstandard')
+
+    return zstandard
+
+
+def open_segment(path, mode='rt', file=None):
+
+    # file: the segment opened in binary mode, e.g. at the start of a gzip member or zstd frame
+
+    encoding = 'utf8' if 't' in mode else None
+    source = path if file is None else file
+
+    if path.endswith('.gz'):
+        return gzip.open(source, mode, encoding=encoding)
+
+    if path.endswith('.zst'):
+        return import_zstandard().open(source, mode, encoding=encoding)
+
+    return open(path, mode, encoding=encoding) if file is None else file
+
+
+def uncompressed_size(path, limit=None):
+
+    # the size of a segment once decompressed, counting stops at limit
+
+    size = 0
+
+    with open_segment(path, 'rb') as segment:
+        for chunk in iter(lambda: segment.read(1024 ** 2), b''):
+            size += len(chunk)
+            if limit is not None and size >= limit:
+                break
+
+    return size
+
+
+def segment_paths(group_path):
+    return sorted(glob(f'{group_path}/segments/segment-*.jsonl*'), key=segment_index)
+
+
+def read_segments(group_path):
+
+    for path in segment_paths(group_path):
+
+        with open_segment(path) as segment:
+            try:
+                for line in segment:
+                    if line.strip():
+                        yield json.loads(line)
+            except (EOFError, json.JSONDecodeError):
+                # the last segment can end in an incomplete chunk if a run was killed
+                logger.warning(f'Segment {path} ends with an incomplete record, skipping the rest.')
+
+
+def segment_lines(path, chunk_size=1024 ** 2):
+
+    # The complete lines of a segment as (member_offset, line_offset, line), the offsets the page index
+    # keeps: where the gzip member or zstd frame of the line starts in the file and where the line starts
+    # in the decompressed member. Stops at the first chunk that can not be decompressed.
+
+    def decompressor():
+
+        if path.endswith('.gz'):
+            return zlib.decompressobj(wbits=31)
+
+        if path.endswith('.zst'):
+            return import_zstandard().ZstdDecompressor().decompressobj()
+
+        return None
+
+    member = decompressor()
+    member_offset = line_offset = offset = 0
+    rest = b''
+
+    with open(path, 'rb') as file:
+        for data in iter(lambda: file.read(chunk_size), b''):
+            while data:
+
+                try:
+                    output = data if member is None else member.decompress(data)
+                except Exception:
+                    # whatever the decompressor fails with, as in copy_complete_records
+                    return
+
+                unused = member.unused_data if member is not None and member.eof else b''
+
+                *lines, rest = (rest + output).split(b'\n')
+
+                for line in lines:
+                    yield member_offset, line_offset, line
+                    line_offset += len(line) + 1
+
+                offset += len(data) - len(unused)
+                data = unused
+
+                if member is not None and member.eof:
+                    member = decompressor()
+                    member_offset, line_offset, rest = offset, 0, b''
+
+
+class RecordReader:
+
+    # Reads records of segments at the offsets of the page index (see segment_lines) without
+    # decompressing the segment up to there. Reads further on in the same member continue
+    # where the last one stopped.
+
+    def __init__(self):
+        self._member = None
+        self._file = None
+        self._segment = None
+        self._position = 0
+
+    def read(self, path, member_offset, line_offset, count=1):
+
+        if self._member != (path, member_offset) or self._position > line_offset:
+
+            self.close()
+
+            self._file = open(path, 'rb')
+            self._file.seek(member_offset)
+            self._segment = io.BufferedReader(open_segment(path, 'rb', self._file))
+            self._member = (path, member_offset)
+            self._position = 0
+
+        while self._position < line_offset:
+
+            skipped = self._segment.read(min(line_offset - self._position, 1024 ** 2))
+
+            if not skipped:
+                raise EOFError(f'{path} ends before the record at {member_offset}:{line_offset}.')
+
+            self._position += len(skipped)
+
+        lines = []
+
+        for _ in range(count):
+            lines.append(self._segment.readline())
+            self._position += len(lines[-1])
+
+        return lines
+
+    def close(self):
+
+        if self._segment is not None:
+            self._segment.close()
+            self._file.close()
+            self._member = self._segment = self._file = None
+
+
+def copy_complete_records(path, output=None, chunk_size=64 * 1024):
+
+    # Counts, and writes to the binary file output, the complete records of a segment up to its end
+    # or up to where it can not be decompressed anymore, e.g. because of a chunk cut off by a crash.
+    # Returns the number of records and whether nothing else follows them.
+
+    records, rest = 0, b''
+
+    try:
+        with open_segment(path, 'rb') as segment:
+            # read1 returns what could be decompressed so far, up to the first broken chunk
+            for chunk in iter(lambda: segment.read1(chunk_size), b''):
+
+                *lines, rest = (rest + chunk).split(b'\n')
+                records += len(lines)
+
+                if output is not None and lines:
+                    output.write(b'\n'.join(lines) + b'\n')
+
+    except Exception:
+        # whatever the decompressor fails with (EOFError, zlib.error, zstandard.ZstdError, …)
+        return records, False
+
+    return records, rest == b''
+
+
+def check_segment(path):
+    return copy_complete_records(path)
+
+
+def rewrite_segment(path):
+
+    # Replaces a segment with a new one holding its complete records. Segments that were not closed,
+    # e.g. because of a crash, can end in an incomplete chunk or an unterminated zstd frame, and
+    # records appended after that could not be read back anymore.
+
+    directory, name = os.path.split(path)
+    temporary_path = f'{directory}/tmp-{name}'
+
+    with open_segment(temporary_path, 'wb') as rewritten:
+        records, complete = copy_complete_records(path, rewritten)
+
+    fsync_file(temporary_path)
+    os.replace(temporary_path, path)
+    fsync_directory(directory)
+
+    return records, complete
+
+
+def get_sink(group_path, sink='files', **options):
+
+    if sink == 'files':
+        return FileSink(group_path, **options)
+
+    if sink == 'jsonl':
+        return JsonlSink(group_path, **options)
+
+    raise ValueError(f'Unknown sink {sink}. Use files or jsonl.')
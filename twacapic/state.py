@@ -0,0 +1,374 @@
+import itertools
+import os
+import sqlite3
+import threading
+import time
+from glob import glob
+
+import yaml
+from loguru import logger
+from twacapic.metrics import SINK_FLUSHES, STATE_FLUSHES, current_group
+from twacapic.profiling import span
+
+# state kept per user; columns added in later versions are added to existing databases
+COLUMNS = {
+    'newest_id': 'TEXT',
+    'oldest_id': 'TEXT',
+    'last_polled_at': 'REAL',
+    'next_poll_at': 'REAL',
+    'tweet_rate': 'REAL',
+    'unreachable_reason': 'TEXT',
+    'unreachable_since': 'REAL',
+    'unreachable_checks': 'INTEGER',
+    'recheck_at': 'REAL',
+    'pagination_token': 'TEXT',
+    'pagination_newest_id': 'TEXT',
+    'pagination_oldest_id': 'TEXT',
+    'pagination_tweet_count': 'INTEGER',
+    'pagination_query': 'TEXT',
+}
+
+# progress of a pagination of a user, saved with the pages (see StateStore.checkpoint) and
+# cleared once the last page is saved, so that an interrupted pagination can be resumed
+CHECKPOINT_COLUMNS = ('pagination_token', 'pagination_newest_id', 'pagination_oldest_id', 'pagination_tweet_count',
+                      'pagination_query')
+
+INSERT_USER = (
+    f'INSERT OR REPLACE INTO users (user_id, {", ".join(COLUMNS)}) VALUES ({", ".join("?" * (len(COLUMNS) + 1))})'
+)
+
+
+# with several processes collecting a group, an older poll of a user must not overwrite a newer newest_id
+UPSERT_USER = (
+    INSERT_USER.replace('INSERT OR REPLACE', 'INSERT', 1) + ' ON CONFLICT (user_id) DO UPDATE SET ' + ', '.join(
+        'newest_id = CASE WHEN users.newest_id IS NULL '
+        'OR CAST(excluded.newest_id AS INTEGER) > CAST(users.newest_id AS INTEGER) '
+        'THEN excluded.newest_id ELSE users.newest_id END' if column == 'newest_id' else f'{column} = excluded.{column}'
+        for column in COLUMNS
+    )
+)
+
+
+def upsert_columns(metadata):
+
+    # sets the columns of metadata for a user, the other columns of a known user are kept
+
+    columns = ', '.join(metadata)
+    values = ', '.join('?' * (len(metadata) + 1))
+    updates = ', '.join(f'{column} = excluded.{column}' for column in metadata)
+
+    return f'INSERT INTO users (user_id, {columns}) VALUES ({values}) ON CONFLICT (user_id) DO UPDATE SET {updates}'
+
+
+def to_row(user_id, metadata):
+    return (user_id, *(metadata.get(column) for column in COLUMNS))
+
+
+def to_metadata(values):
+    return {column: value for column, value in zip(COLUMNS, values) if value is not None}
+
+
+class StateStore:
+
+    # Holds the members of a group and the state of all users (see COLUMNS) in one SQLite database
+    # in WAL mode. Updates are buffered and written in one transaction per batch.
+    # A shared store is used by several processes, possibly on several machines (see workqueue.py):
+    # it uses a rollback journal, as WAL does not work across machines, and never lowers newest_id.
+
+    def __init__(self, path, batch_size=100, before_flush=None, shared=False, checkpoint_pages=20,
+                 checkpoint_seconds=10, after_flush=None):
+
+        self.path = path
+        self.batch_size = batch_size
+        self.checkpoint_pages = checkpoint_pages
+        self.checkpoint_seconds = checkpoint_seconds
+        # e.g. to persist buffered pages before their ids are saved, info it returns is saved with them
+        self.before_flush = before_flush
+        self.after_flush = after_flush
+        self.shared = shared
+        self._pending = {}
+        self._checkpoints = 0
+        self._flushed_at = time.monotonic()
+        self._lock = threading.RLock()
+
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=60 if shared else 5)
+        self._connection.execute(f'PRAGMA journal_mode={"DELETE" if shared else "WAL"}')
+        self._connection.execute('PRAGMA synchronous=FULL')
+
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS users '
+                '(user_id TEXT PRIMARY KEY, newest_id TEXT, oldest_id TEXT)'
+            )
+
+            existing_columns = [row[1] for row in self._connection.execute('PRAGMA table_info(users)')]
+
+            for column, column_type in COLUMNS.items():
+                if column not in existing_columns:
+                    self._connection.execute(f'ALTER TABLE users ADD COLUMN {column} {column_type}')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)'
+            )
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS members (user_id TEXT PRIMARY KEY)'
+            )
+
+    def get(self, user_id):
+
+        with self._lock:
+
+            if user_id in self._pending:
+                return dict(self._pending[user_id])
+
+            with span('state'):
+                row = self._connection.execute(
+                    f'SELECT {", ".join(COLUMNS)} FROM users WHERE user_id = ?', (user_id,)
+                ).fetchone()
+
+        if row is None:
+            return None
+
+        return to_metadata(row)
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def update(self, user_id, **metadata):
+
+        with self._lock:
+
+            user_metadata = self.get(user_id) or {}
+            user_metadata.update(metadata)
+            self._pending[user_id] = user_metadata
+
+            if len(self._pending) >= self.batch_size:
+                self.flush()
+
+    def checkpoint(self, user_id, **metadata):
+
+        # the progress of a pagination, saved like other updates, but at the latest with the flush after
+        # checkpoint_pages checkpoints or checkpoint_seconds, so that a crash repeats only that many pages
+
+        with self._lock:
+
+            self.update(user_id, **metadata)
+            self._checkpoints += 1
+
+            if (self._checkpoints >= self.checkpoint_pages
+                    or time.monotonic() - self._flushed_at >= self.checkpoint_seconds):
+                self.flush()
+
+    def flush(self):
+
+        with self._lock:
+
+            self._checkpoints = 0
+            self._flushed_at = time.monotonic()
+
+            if not self._pending:
+                return
+
+            info = None
+
+            if self.before_flush is not None:
+                with SINK_FLUSHES.time(group=current_group()), span('filesystem'):
+                    info = self.before_flush()
+
+            with STATE_FLUSHES.time(group=current_group()), span('state'), self._connection:
+                self._connection.executemany(
+                    UPSERT_USER if self.shared else INSERT_USER,
+                    [to_row(user_id, metadata) for user_id, metadata in self._pending.items()]
+                )
+                self._connection.executemany(
+                    'INSERT OR REPLACE INTO info (key, value) VALUES (?, ?)', (info or {}).items()
+                )
+
+            logger.debug(f'Saved state of {len(self._pending)} users to {self.path}.')
+            self._pending = {}
+
+            if self.after_flush is not None:
+                self.after_flush()
+
+    def all(self):
+
+        with self._lock:
+
+            self.flush()
+
+            rows = self._connection.execute(f'SELECT user_id, {", ".join(COLUMNS)} FROM users').fetchall()
+
+        return {user_id: to_metadata(values) for user_id, *values in rows}
+
+    def add_members(self, user_ids, chunk_size=10000, **metadata):
+
+        # streams user ids into the member index, with metadata (e.g. newest_id='0' for -a)
+        # set for every added user, other columns of users already known are kept
+
+        user_ids = iter(user_ids)
+
+        with self._lock:
+            self.flush()
+
+        while True:
+
+            chunk = list(itertools.islice(user_ids, chunk_size))
+
+            if not chunk:
+                return
+
+            with self._lock, self._connection:
+
+                self._connection.executemany(
+                    'INSERT OR IGNORE INTO members (user_id) VALUES (?)', [(user_id,) for user_id in chunk]
+                )
+
+                if metadata:
+                    self._connection.executemany(upsert_columns(metadata),
+                                                 [(user_id, *metadata.values()) for user_id in chunk])
+
+    def members(self, chunk_size=10000):
+
+        # yields the members in the order they were added, reading chunk_size of them at a time
+
+        last_rowid = 0
+
+        while True:
+
+            with self._lock:
+                rows = self._connection.execute(
+                    'SELECT rowid, user_id FROM members WHERE rowid > ? ORDER BY rowid LIMIT ?',
+                    (last_rowid, chunk_size)
+                ).fetchall()
+
+            if not rows:
+                return
+
+            for last_rowid, user_id in rows:
+                yield user_id
+
+    def due_members(self, now):
+
+        # reachable members whose next poll is due, never polled ones first, then by the number of
+        # new tweets to be expected since their last poll
+
+        with self._lock:
+
+            self.flush()
+
+            rows = self._connection.execute(
+                'SELECT user_id FROM members LEFT JOIN users USING (user_id) '
+                'WHERE (next_poll_at IS NULL OR next_poll_at <= ?) AND (recheck_at IS NULL OR recheck_at <= ?) '
+                'ORDER BY last_polled_at IS NOT NULL, '
+                'COALESCE(tweet_rate, 0) * (? - COALESCE(last_polled_at, 0)) DESC, members.rowid',
+                (now, now, now)
+            ).fetchall()
+
+        return [user_id for user_id, in rows]
+
+    def unreachable(self, now=None):
+
+        # the negative cache: users found unreachable, with now only those not due for a recheck yet
+
+        with self._lock:
+
+            self.flush()
+
+            rows = self._connection.execute(
+                f'SELECT user_id, {", ".join(COLUMNS)} FROM users '
+                'WHERE unreachable_reason IS NOT NULL AND recheck_at > ? ORDER BY recheck_at',
+                (now if now is not None else float('-inf'),)
+            ).fetchall()
+
+        return {user_id: to_metadata(values) for user_id, *values in rows}
+
+    def count_members(self):
+
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM members').fetchone()[0]
+
+    def get_info(self, key):
+
+        with self._lock:
+            row = self._connection.execute('SELECT value FROM info WHERE key = ?', (key,)).fetchone()
+
+        return None if row is None else row[0]
+
+    def set_info(self, key, value):
+
+        # saved right away, None removes the key
+
+        with self._lock, self._connection:
+            if value is None:
+                self._connection.execute('DELETE FROM info WHERE key = ?', (key,))
+            else:
+                self._connection.execute('INSERT OR REPLACE INTO info (key, value) VALUES (?, ?)', (key, value))
+
+    def index_user_directories(self, group_path):
+
+        # one-time import of the members of groups of older twacapic versions,
+        # which were only known from their folders
+
+        with self._lock:
+
+            indexed = self._connection.execute(
+                "SELECT value FROM info WHERE key = 'indexed_user_directories'"
+            ).fetchone()
+
+            if indexed is not None:
+                return
+
+            with os.scandir(group_path) as entries:
+                user_ids = [entry.name for entry in entries if entry.name.isdigit() and entry.is_dir()]
+
+            self.add_members(sorted(user_ids))
+
+            with self._connection:
+                self._connection.execute(
+                    "INSERT INTO info (key, value) VALUES ('indexed_user_directories', '1')"
+                )
+
+            if user_ids:
+                logger.info(f'Indexed {len(user_ids)} user folders in {self.path}.')
+
+    def migrate(self, group_path):
+
+        # one-time import of the per-user meta.yaml files of older twacapic versions
+
+        with self._lock:
+
+            migrated = self._connection.execute(
+                "SELECT value FROM info WHERE key = 'migrated_meta_yaml'"
+            ).fetchone()
+
+            if migrated is not None:
+                return
+
+            meta_file_paths = glob(f'{group_path}/*/meta.yaml')
+
+            for meta_file_path in meta_file_paths:
+
+                user_id = os.path.basename(os.path.dirname(meta_file_path))
+
+                with open(meta_file_path, 'r') as metafile:
+                    user_metadata = yaml.safe_load(metafile) or {}
+
+                self._pending[user_id] = user_metadata
+
+            self.flush()
+
+            with self._connection:
+                self._connection.execute(
+                    "INSERT INTO info (key, value) VALUES ('migrated_meta_yaml', '1')"
+                )
+
+            for meta_file_path in meta_file_paths:
+                os.remove(meta_file_path)
+
+            if meta_file_paths:
+                logger.info(f'Migrated {len(meta_file_paths)} meta.yaml files to {self.path}.')
+
+    def close(self):
+
+        with self._lock:
+            self.flush()
+            self._connection.close()
@@ -1,10 +1,79 @@
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+
+# Tweet ids are snowflakes: milliseconds since TWITTER_EPOCH in the bits above the lowest 22,
+# then 5 bits datacenter, 5 bits worker and 12 bits sequence number.
+TWITTER_EPOCH = 1288834974657
+TIMESTAMP_SHIFT = 22
+UNIX_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def import_numpy():
+
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError('Decoding arrays of tweet ids needs the numpy package: pip install numpy')
+
+    return numpy
 
 
 def get_date_from_tweet_id(tweet_id):
 
-    shifted = int(tweet_id) >> 22
-    timestamp = shifted + 1288834974657
-    time_created = datetime.fromtimestamp(timestamp/1000).strftime('%Y-%m-%d')
+    shifted = int(tweet_id) >> TIMESTAMP_SHIFT
+    timestamp = shifted + TWITTER_EPOCH
+    time_created = datetime.fromtimestamp(timestamp/1000, timezone.utc).strftime('%Y-%m-%d')
 
     return {'timestamp': timestamp, 'date': time_created}
+
+
+def get_dates_from_tweet_ids(tweet_ids, fields=False):
+
+    # The same as get_date_from_tweet_id for a sequence or array of ids (ints or strings) at once:
+    # arrays of timestamps in ms and of dates (datetime64[D], UTC, numpy.datetime_as_string gives the
+    # strings of get_date_from_tweet_id). With fields, also datacenter, worker and sequence number.
+
+    numpy = import_numpy()
+
+    ids = numpy.asarray(tweet_ids).astype(numpy.uint64)
+
+    timestamps = (ids >> numpy.uint64(TIMESTAMP_SHIFT)).astype(numpy.int64) + TWITTER_EPOCH
+
+    result = {
+        'timestamp': timestamps,
+        'date': timestamps.astype('datetime64[ms]').astype('datetime64[D]'),
+    }
+
+    if fields:
+        result['datacenter'] = ((ids >> numpy.uint64(17)) & numpy.uint64(0x1F)).astype(numpy.int64)
+        result['worker'] = ((ids >> numpy.uint64(12)) & numpy.uint64(0x1F)).astype(numpy.int64)
+        result['sequence'] = (ids & numpy.uint64(0xFFF)).astype(numpy.int64)
+
+    return result
+
+
+def get_tweet_id_from_timestamp(timestamp):
+
+    # the smallest id of a tweet created at timestamp (ms since 1970), datetimes without tzinfo are UTC
+
+    if isinstance(timestamp, datetime):
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        timestamp = (timestamp - UNIX_EPOCH) // timedelta(milliseconds=1)
+
+    return max(int(timestamp) - TWITTER_EPOCH, 0) << TIMESTAMP_SHIFT
+
+
+def get_id_bounds(start=None, end=None):
+
+    # since_id and until_id parameters for the tweets created from start up to, not including, end
+
+    bounds = {}
+
+    if start is not None:
+        # since_id is exclusive
+        bounds['since_id'] = str(max(get_tweet_id_from_timestamp(start) - 1, 0))
+
+    if end is not None:
+        bounds['until_id'] = str(get_tweet_id_from_timestamp(end))
+
+    return bounds
@@ -0,0 +1,221 @@
+import itertools
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+from loguru import logger
+from twacapic.metrics import WORK_QUEUE
+
+LEASE_SECONDS = 600
+
+
+def worker_name():
+    return f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+
+class WorkQueue:
+
+    # Users of a group handed out as leased work items, so that several processes or machines
+    # can collect one group at the same time. The queue is a SQLite file in the group folder, e.g.
+    # on storage shared by all machines. It uses a rollback journal, as WAL does not work across
+    # machines. A worker leases a batch of users, renews its leases while collecting them and
+    # removes them from the queue when done. The leases of crashed workers expire and their users
+    # are leased again to the next worker asking for work.
+
+    def __init__(self, path, lease_seconds=LEASE_SECONDS):
+
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+
+        self._connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=DELETE')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS items ('
+            'user_id TEXT PRIMARY KEY, enqueued_at REAL, owner TEXT, lease_expires_at REAL, leases INTEGER DEFAULT 0)'
+        )
+
+    def _transaction(self, statements):
+
+        # BEGIN IMMEDIATE takes the write lock right away, so two workers never lease the same users
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                result = statements(self._connection)
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+            self._connection.execute('COMMIT')
+
+        return result
+
+    def enqueue(self, user_ids, chunk_size=10000):
+
+        # users that are still queued or leased are not added twice, returns the number of users added
+
+        user_ids = iter(user_ids)
+        added = 0
+
+        while True:
+
+            chunk = [(user_id, time.time()) for user_id in itertools.islice(user_ids, chunk_size)]
+
+            if not chunk:
+                return added
+
+            def insert(connection):
+                before = connection.total_changes
+                connection.executemany('INSERT OR IGNORE INTO items (user_id, enqueued_at) VALUES (?, ?)', chunk)
+                return connection.total_changes - before
+
+            added += self._transaction(insert)
+
+    def lease(self, owner, count):
+
+        now = time.time()
+
+        def lease(connection):
+
+            user_ids = [row[0] for row in connection.execute(
+                'SELECT user_id FROM items WHERE owner IS NULL OR lease_expires_at < ? ORDER BY rowid LIMIT ?',
+                (now, count)
+            )]
+
+            connection.executemany(
+                'UPDATE items SET owner = ?, lease_expires_at = ?, leases = leases + 1 WHERE user_id = ?',
+                [(owner, now + self.lease_seconds, user_id) for user_id in user_ids]
+            )
+
+            return user_ids
+
+        user_ids = self._transaction(lease)
+
+        if user_ids:
+            logger.debug(f'{owner} leased {len(user_ids)} users.')
+
+        return user_ids
+
+    def renew(self, owner):
+
+        def renew(connection):
+            return connection.execute(
+                'UPDATE items SET lease_expires_at = ? WHERE owner = ?', (time.time() + self.lease_seconds, owner)
+            ).rowcount
+
+        return self._transaction(renew)
+
+    def complete(self, owner, user_ids):
+
+        # users whose lease expired and went to another worker stay in the queue for that worker
+
+        def delete(connection):
+            connection.executemany('DELETE FROM items WHERE owner = ? AND user_id = ?',
+                                   [(owner, user_id) for user_id in user_ids])
+
+        self._transaction(delete)
+
+    def release(self, owner):
+
+        def release(connection):
+            connection.execute('UPDATE items SET owner = NULL, lease_expires_at = NULL WHERE owner = ?', (owner,))
+
+        self._transaction(release)
+
+    def stats(self):
+
+        with self._lock:
+            queued, leased, expired = self._connection.execute(
+                'SELECT COUNT(*), COUNT(owner), COALESCE(SUM(lease_expires_at < ?), 0) FROM items', (time.time(),)
+            ).fetchone()
+
+        return {'queued': queued - leased, 'leased': leased - expired, 'expired': expired}
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class LeaseRenewal:
+
+    # renews the leases of a worker in the background, while its users are collected
+
+    def __init__(self, queue, owner):
+        self.queue = queue
+        self.owner = owner
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='lease-renewal', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.queue.lease_seconds / 3):
+            try:
+                self.queue.renew(self.owner)
+            except sqlite3.Error as e:
+                logger.warning(f'Could not renew leases of {self.owner}: {e}')
+
+
+def queue_stats(user_group, queue):
+
+    # the stats of the queue of a group, also kept as metrics
+
+    stats = queue.stats()
+
+    for state, count in stats.items():
+        WORK_QUEUE.set(count, group=user_group.name, state=state)
+
+    return stats
+
+
+def coordinate(user_group, queue, adaptive=False):
+
+    # queues the users of a group that are due, returns the number of users added to the queue
+
+    added = queue.enqueue(user_group.select_user_ids(adaptive))
+
+    logger.info(f'Queued {added} users of {user_group.name}, queue: {queue_stats(user_group, queue)}')
+
+    return added
+
+
+def work(user_group, queue, api, workers=1, batch_size=None, **collect_options):
+
+    # collects leased users of a group until the queue is empty, returns the number of users collected
+
+    owner = worker_name()
+    batch_size = batch_size or 10 * workers
+    collected = 0
+
+    logger.info(f'Worker {owner} started on {user_group.name}.')
+
+    try:
+        with LeaseRenewal(queue, owner):
+            while True:
+
+                user_ids = queue.lease(owner, batch_size)
+
+                if not user_ids:
+                    break
+
+                user_group.collect(api=api, workers=workers, user_ids=user_ids, **collect_options)
+                queue.complete(owner, user_ids)
+                collected += len(user_ids)
+
+                queue_stats(user_group, queue)
+
+    finally:
+        # users that could not be collected go back to the queue right away
+        queue.release(owner)
+
+    logger.info(f'Worker {owner} collected {collected} users of {user_group.name}.')
+
+    return collected